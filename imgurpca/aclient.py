@@ -0,0 +1,210 @@
+from imgurpython.client import API_URL, MASHAPE_URL
+from imgurpython.client import ImgurClientRateLimitError, ImgurClientError
+from imgurpython.helpers.format import build_gallery_images_and_albums
+from imgurpython.helpers.format import format_comment_tree
+from imgurpython.imgur.models.account import Account
+from imgurpython.imgur.models.comment import Comment
+import asyncio
+import json
+import ssl
+from urllib.parse import urlsplit, urlencode
+
+# The AsyncClient class issues imgur API requests from asyncio coroutines. It
+# mirrors the read-only ImgurClient methods used by Post.download() and
+# User.download() and returns the same imgurpython model objects, so many
+# requests can be in flight at once without a thread per request. Requests share
+# a bounded pool of keep-alive HTTP/1.1 connections. Authentication headers and
+# rate limit credits are taken from/stored in the wrapped ImgurClient.
+
+async def gather(*coros):
+    """same as asyncio.gather(), but cancels the other coroutines as soon as one
+    raises, so no requests are left running after an error.
+    Returns a list of results.
+    """
+    tasks = [asyncio.ensure_future(c) for c in coros]
+    try:
+        return await asyncio.gather(*tasks)
+    except BaseException:
+        for t in tasks:
+            t.cancel()
+        raise
+
+
+
+class AsyncClient(object):
+
+    def __init__(self, client, connections=64, base_url=None, timeout=60):
+        """
+        @param client (ImgurClient): imgurpython.ImgurClient instance for
+                                    credentials.
+        @param connections (int): maximum number of open connections, i.e.
+                                    requests in flight.
+        @param base_url (str): OPTIONAL. API root URL. Defaults to the imgur (or
+                                    mashape) API URL used by client.
+        @param timeout (float): seconds to wait for a response.
+        """
+        self.client = client
+        if base_url is None:
+            base_url = MASHAPE_URL if client.mashape_key is not None else API_URL
+        url = urlsplit(base_url)
+        self.secure = url.scheme=='https'
+        self.host = url.hostname
+        self.port = url.port or (443 if self.secure else 80)
+        self.prefix = url.path.rstrip('/') + '/3/'
+        self.timeout = timeout
+        self.connections = connections
+        self._slots = asyncio.Semaphore(connections)
+        self._idle = []                 # open (reader, writer) connections not in use
+
+
+    async def close(self):
+        """closes all idle connections.
+        """
+        idle, self._idle = self._idle, []
+        for _, writer in idle:
+            writer.close()
+        for _, writer in idle:
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+
+    async def request(self, route, params=None):
+        """GET an API route, e.g. 'gallery/{id}'.
+        @param route (str): path relative to the API version root.
+        @param params (dict): OPTIONAL. Query string parameters.
+        Returns the 'data' field of the decoded JSON response.
+        """
+        path = self.prefix + route
+        if params:
+            path += '?' + urlencode(params)
+        status, headers, body = await self._get(path, self.client.prepare_headers())
+        if status==403 and self.client.auth is not None:
+            loop = asyncio.get_running_loop()
+            await loop.run_in_executor(None, self.client.auth.refresh)
+            status, headers, body = await self._get(path, self.client.prepare_headers())
+        self.client.credits = {
+            'UserLimit': headers.get('x-ratelimit-userlimit'),
+            'UserRemaining': headers.get('x-ratelimit-userremaining'),
+            'UserReset': headers.get('x-ratelimit-userreset'),
+            'ClientLimit': headers.get('x-ratelimit-clientlimit'),
+            'ClientRemaining': headers.get('x-ratelimit-clientremaining')
+        }
+        if status==429:
+            raise ImgurClientRateLimitError()
+        try:
+            data = json.loads(body.decode('utf-8'))
+        except ValueError:
+            raise ImgurClientError('JSON decoding of response failed.')
+        if 'data' in data and isinstance(data['data'], dict) and 'error' in data['data']:
+            raise ImgurClientError(data['data']['error'], status)
+        return data['data'] if 'data' in data else data
+
+
+    async def _get(self, path, headers):
+        """sends a GET request on a pooled connection.
+        Returns a tuple (status code, dict of lower case headers, body bytes).
+        """
+        async with self._slots:
+            for attempt in range(2):
+                reused = bool(self._idle)
+                reader, writer = self._idle.pop() if reused else await self._connect()
+                try:
+                    writer.write(self._format(path, headers))
+                    res = await asyncio.wait_for(self._read(reader), self.timeout)
+                except (ConnectionError, asyncio.IncompleteReadError):
+                    writer.close()
+                    if reused and attempt==0:   # server closed an idle connection
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                status, rheaders, body, keep = res
+                if keep:
+                    self._idle.append((reader, writer))
+                else:
+                    writer.close()
+                return status, rheaders, body
+
+
+    async def _connect(self):
+        context = ssl.create_default_context() if self.secure else None
+        return await asyncio.wait_for(asyncio.open_connection(self.host, self.port,
+                                      ssl=context), self.timeout)
+
+
+    def _format(self, path, headers):
+        """bytes of an HTTP/1.1 GET request.
+        """
+        lines = ['GET %s HTTP/1.1' % path, 'Host: %s' % self.host,
+                 'Accept-Encoding: identity', 'Connection: keep-alive']
+        lines.extend('%s: %s' % h for h in headers.items())
+        return ('\r\n'.join(lines) + '\r\n\r\n').encode('utf-8')
+
+
+    async def _read(self, reader):
+        """reads a response. Returns (status, headers, body, keep alive).
+        """
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError('Connection closed by server.')
+        version, status = line.decode('latin-1').split(None, 2)[:2]
+        headers = {}
+        while True:
+            line = (await reader.readline()).decode('latin-1').strip()
+            if not line:
+                break
+            key, _, value = line.partition(':')
+            headers[key.strip().lower()] = value.strip()
+        keep = headers.get('connection', '').lower()!='close' and version!='HTTP/1.0'
+        if headers.get('transfer-encoding', '').lower()=='chunked':
+            chunks = []
+            while True:
+                size = int((await reader.readline()).split(b';')[0], 16)
+                if size==0:
+                    await reader.readline()     # no trailers expected
+                    break
+                chunks.append(await reader.readexactly(size))
+                await reader.readline()
+            body = b''.join(chunks)
+        elif 'content-length' in headers:
+            body = await reader.readexactly(int(headers['content-length']))
+        else:                           # body until connection closes
+            body = await reader.read()
+            keep = False
+        return int(status), headers, body, keep
+
+
+    async def gallery_item(self, item_id):
+        return build_gallery_images_and_albums(await self.request('gallery/%s' % item_id))
+
+
+    async def gallery_item_comments(self, item_id, sort='best'):
+        return format_comment_tree(await self.request('gallery/%s/comments/%s' % (item_id, sort)))
+
+
+    async def get_account(self, username):
+        self.client.validate_user_context(username)
+        data = await self.request('account/%s' % username)
+        return Account(data['id'], data['url'], data['bio'], data['reputation'],
+                       data['created'], data['pro_expiration'])
+
+
+    async def get_account_submissions(self, username, page=0):
+        self.client.validate_user_context(username)
+        res = await self.request('account/%s/submissions/%d' % (username, page))
+        return build_gallery_images_and_albums(res)
+
+
+    async def get_account_comments(self, username, sort='newest', page=0):
+        self.client.validate_user_context(username)
+        res = await self.request('account/%s/comments/%s/%s' % (username, sort, page))
+        return [Comment(c) for c in res]
+
+
+    async def get_gallery_favorites(self, username, page=0):
+        self.client.validate_user_context(username)
+        res = await self.request('account/%s/gallery_favorites/%d' % (username, page))
+        return build_gallery_images_and_albums(res)
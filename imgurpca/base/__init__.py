@@ -4,9 +4,17 @@ from __future__ import absolute_import
 from . import utils
 from . import config
 from .parallel import Parallel
+from .parallel import WorkerPool
+from .parallel import POOL
 from .tree import DTree
+from .kdtree import KDTree
+from .neighbours import NeighbourIndex
+from .sparse import CSRMatrix
+from .vocabulary import Vocabulary
+from .vocabulary import VOCABULARY
 from .atomic import Atomic
 from .molecular import Molecular
+from . import validation
 from .baselearn import BaseLearner
 from .electronic import Electronic
 from .markov import Markov
@@ -2,6 +2,7 @@ from __future__ import unicode_literals
 from __future__ import absolute_import
 from . import utils
 from . import config
+from . import VOCABULARY
 import numpy as np
 
 # Atomic is the base class that represents a single data point for learning
@@ -11,21 +12,55 @@ import numpy as np
 
 class Atomic(object):
 
+    vocabulary = VOCABULARY         # shared word <-> id mapping
+
     def __init__(self, **kwargs):
-        self.wordcount = None       # np array of dtype=config.DT_WORD_WEIGHT
+        self.counts = None          # np array of dtype=config.DT_ID_WEIGHT
         self.word_weight = config.DEFAULT_WORD_WEIGHT
         self._content = None
 
         for attr in kwargs:
             setattr(self, attr, kwargs[attr])
 
+    def __getstate__(self):
+        # ids are only valid in this process's vocabulary, so words are pickled
+        # and interned again when unpickled.
+        state = dict(self.__dict__)
+        if state.get('counts') is not None:
+            state['counts'] = self.vocabulary.decode(state['counts'])
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.counts is not None:
+            self.counts = self.vocabulary.encode(self.counts)
+
+    @property
+    def wordcount(self):
+        """np array of dtype=config.DT_WORD_WEIGHT decoded from self.counts.
+        Can be set to an array of dtype=config.DT_WORD_WEIGHT/DT_ID_WEIGHT.
+        A new array on every access, so changes to it are not stored. Assign it
+        back, or change self.counts instead (e.g. self.counts['weight'] *= 2).
+        """
+        if self.counts is None:
+            return None
+        return self.vocabulary.decode(self.counts)
+
+    @wordcount.setter
+    def wordcount(self, wordcount):
+        self.counts = None if wordcount is None else self.vocabulary.encode(wordcount)
+
+    @property
+    def ids(self):
+        return self.counts['id']
+
     @property
     def words(self):
-        return self.wordcount['word']
+        return self.vocabulary[self.counts['id']]
 
     @property
     def weights(self):
-        return self.wordcount['weight']
+        return self.counts['weight']
 
     @property
     def content(self):
@@ -40,8 +75,8 @@ class Atomic(object):
 
 
     def generate_word_counts(self):
-        # populate self.wordcount with a np array of dtype=config.DT_WORD_WEIGHT
-        # using self.content
+        # populate self.counts with a np array of dtype=config.DT_ID_WEIGHT
+        # (or self.wordcount with config.DT_WORD_WEIGHT) using self.content
         pass
 
 
@@ -52,12 +87,12 @@ class Atomic(object):
         if minimum>maximum:
             raise ValueError('Minimum is less than maximum.')
         if not reverse:
-            self.wordcount = self.wordcount[self.wordcount['weight']<=maximum]
-            self.wordcount = self.wordcount[self.wordcount['weight']>=minimum]
+            self.counts = self.counts[self.counts['weight']<=maximum]
+            self.counts = self.counts[self.counts['weight']>=minimum]
         else:
-            temp = self.wordcount[self.wordcount['weight']>maximum]
-            self.wordcount = self.wordcount[self.wordcount['weight']<minimum]
-            self.wordcount = np.concatenate((self.wordcount, temp), axis=0)
+            temp = self.counts[self.counts['weight']>maximum]
+            self.counts = self.counts[self.counts['weight']<minimum]
+            self.counts = np.concatenate((self.counts, temp), axis=0)
 
 
     def filter_by_word(self, words, reverse=False):
@@ -66,26 +101,37 @@ class Atomic(object):
         
         @param words (list/array): a list of words in unicode
         """
-        self.wordcount = self.wordcount[np.in1d(self.wordcount['word'], words,
+        ids = self.vocabulary.lookup(words)
+        self.filter_by_id(ids[ids>=0], reverse)
+
+
+    def filter_by_id(self, ids, reverse=False):
+        """same as filter_by_word() but with word ids from self.vocabulary.
+        @param ids (array): an array of unique word ids
+        """
+        self.counts = self.counts[np.in1d(self.counts['id'], ids,
                                         assume_unique=True, invert=reverse)]
 
 
     def sort_by_word(self):
-        self.wordcount.sort(order=['word'])
+        self.counts = self.counts[np.argsort(self.words, kind='mergesort')]
 
 
     def sort_by_weight(self):
-        self.wordcount.sort(order=['weight'])
+        self.counts.sort(order=['weight'])
 
 
     def sort(self):
         """sorts according to whatever default sort order is set. Default order is
         used by Parser.consolidate() and Learner.project() functions as well.
         """
-        self.wordcount.sort(order=[config.DEFAULT_SORT_ORDER])
+        if config.DEFAULT_SORT_ORDER=='word':
+            self.sort_by_word()
+        else:
+            self.counts.sort(order=[config.DEFAULT_SORT_ORDER])
 
 
     def normalize(self):
         """normalize wordcount weights such that they sum to 1.
         """
-        self.wordcount['weight'] = self.weights / sum(self.weights)
+        self.counts['weight'] = self.weights / np.sum(self.weights)
@@ -5,8 +5,13 @@ from __future__ import division
 from . import Atomic
 from . import Molecular
 from . import DTree
+from . import KDTree
+from . import NeighbourIndex
+from . import CSRMatrix
 from . import utils
 from . import config
+from . import validation
+from . import VOCABULARY
 import numpy as np
 from csv import reader, writer
 from collections import deque
@@ -15,38 +20,112 @@ from collections import deque
 # perform further analyses. Axes are generated from the source which is a Molecular
 # subclass. They can also be saved to and loaded from file, or set programmatically.
 # The class does principal component analysis, linear and logistic regression and
-# prediction, and k-means clustering.
+# prediction, and k-means clustering. Configurations of these methods can be
+# compared by cross-validation in parallel processes.
+# The complete state of a learner can be saved to a single model bundle file. When
+# a bundle is loaded, each section (axes, cluster centers, ...) is only read or
+# memory-mapped when it is first accessed.
+
+class Section(object):
+    """descriptor for a BaseLearner attribute that can be stored in a model
+    bundle. After BaseLearner.load_model(), the value is loaded from the bundle
+    the first time the attribute is accessed.
+    """
+
+    def __init__(self, name):
+        self.name = name
+
+    def __get__(self, obj, cls):
+        if obj is None:
+            return self
+        try:
+            return obj.__dict__[self.name]
+        except KeyError:
+            value = obj.__dict__[self.name] = obj._load_section(self.name)
+            return value
+
+    def __set__(self, obj, value):
+        obj.__dict__[self.name] = value
+
+
 
 class BaseLearner(object):
 
+    vocabulary = VOCABULARY       # shared word <-> id mapping
+    axes = Section('axes')
+    ccenters = Section('ccenters')
+    lrc = Section('lrc')
+    lrf = Section('lrf')
+    dtree = Section('dtree')
+    _custom_ids = Section('_custom_ids')
+    _sections = ('axes', 'ccenters', 'lrc', 'lrf', 'dtree', '_custom_ids')
+
     def __init__(self, source=None, *args, **kwargs):
         """provide a source as a keyword argument
         @param source (Atomic/Molecular): a an instance of Atomic/Molecular subclass
         """
         self.source = source
         self.axes = None          # np.array 2D float [len(self.words) x # of axes]
-        self._custom_words = None # list of words if custom axes set, alternative
-                                  # to self.source.words. Set by self.set_axes()
+        self._custom_ids = None   # array of word ids if custom axes set, alternative
+                                  # to self.source.ids. Set by self.set_axes()
         self.ccenters = None      # 2D array of cluster centers [arbitrary x # of axes]
         self.lrc = None           # linear regression coefficients 1D array of a's in:
                                   # a0 + a1.x1 + a2.x2+...
-        self.lrf = None           # logistic regression function, result of
-                                  # Learner.logistic_regression()
+        self.lrf = None           # logistic regression coefficients 1D array of a's
+                                  # in: 1 / (1 + exp(-(a0 + a1.x1 + a2.x2+...)))
         self.dtree = None         # base.DTree instance after decision_tree() is
                                   # called. Used for prediction.
+        self._ipca = None         # (items seen, ids, mean, singular values, components)
+                                  # state of incremental PCA. Set by partial_fit()
+        self._rows_cache = None   # (self.ids, argsort of self.ids) used by project()
+        self._ctree = None        # (centers, base.KDTree over centers) used by
+                                  # assign_to_cluster(tree=True)
+        self.nindex = None        # base.NeighbourIndex after build_neighbour_index()
+                                  # is called. Used by nearest_neighbours()
+        self._bundle = None       # (file name, np.load() of file, mmap) of model
+                                  # bundle. Set by load_model()
 
         for attr in kwargs:
             setattr(self, attr, kwargs[attr])
 
+    def __getstate__(self):
+        for name in self._sections:     # read any sections not loaded yet
+            getattr(self, name)
+        state = dict(self.__dict__)
+        state['_bundle'] = None         # open files are not pickled
+        # ids are only valid in this process's vocabulary, so words are pickled
+        # and interned again when unpickled.
+        state['_rows_cache'] = None
+        if state['_custom_ids'] is not None:
+            state['_custom_ids'] = self.vocabulary[state['_custom_ids']]
+        if state.get('_ipca') is not None:
+            seen, ids, mean, sv, components = state['_ipca']
+            state['_ipca'] = (seen, self.vocabulary[ids], mean, sv, components)
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self._custom_ids is not None:
+            self._custom_ids = self.vocabulary.intern(self._custom_ids)
+        if self._ipca is not None:
+            seen, words, mean, sv, components = self._ipca
+            self._ipca = (seen, self.vocabulary.intern(words), mean, sv, components)
+
     @property
     def words(self):
         """returns an array of words in the source's wordcount. Useful for finding
         what words positions represent in covariance matrice, eigenvectors etc.
         """
-        if self._custom_words is None:      # i.e. custom axes not set then:
-            return self.source.wordcount['word']
+        return self.vocabulary[self.ids]
+
+    @property
+    def ids(self):
+        """returns an array of word ids corresponding to self.words.
+        """
+        if self._custom_ids is None:        # i.e. custom axes not set then:
+            return self.source.ids
         else:
-            return self._custom_words
+            return self._custom_ids
 
 
     def set_axes(self, axes, consolidated=False):
@@ -57,39 +136,49 @@ class BaseLearner(object):
         @param consolidated (bool): whether words and order in all axes is same.
         Returns 2D array (each row -> word weight in self.words, column -> axis vector)
         """
+        self._ipca = None
         if not consolidated:
             p = Molecular()
             p.items = [Atomic(wordcount=w) for w in axes]
             p.consolidate()
-            self._custom_words = p.words
-            self.axes = np.vstack((a.wordcount['weight'] for a in p.items)).T
+            self._custom_ids = p.ids
+            self.axes = np.vstack([a.weights for a in p.items]).T.astype(config.DT_FLOAT)
         else:
-            self._custom_words = axes[0]['word']
-            self.axes = np.vstack((a['weight'] for a in axes)).T
+            self._custom_ids = self.vocabulary.intern(axes[0]['word'])
+            self.axes = np.vstack([a['weight'] for a in axes]).T.astype(config.DT_FLOAT)
         return self.axes
 
 
-    def get_axes(self, n=-1):
+    def get_axes(self, n=-1, solver='auto', seed=None):
         """get the eignevectors describing the wordcounts of the items in the
         Molecular given to Learner. For comment-wise vectors, use get_comment_eigenvectors()
         Returns 2D array (each row -> word weight in self.words, column -> axis vector)
         @param n (int): Number of axes to get. Defaults to all eigenvectors.
+        @param solver (str): 'full' -> eigenvectors of the full covariance matrix,
+                            'gram' -> eigenvectors of the [items x items] Gram
+                            matrix mapped back to words. Same axes as 'full'
+                            when there are fewer items than words.
+                            'randomized' -> only the top n axes from a randomized
+                            SVD of the centered wordcounts. Approximate: axes
+                            are less accurate the slower the variance of the
+                            axes decays. 'auto' -> 'gram' if there are fewer
+                            items than words (so only non-null axes are
+                            returned), else 'full'.
+        @param seed (int/RandomState): OPTIONAL. Seed or np.random.RandomState
+                            for the randomized solver. If None, a new unseeded
+                            RandomState is used. numpy's global random state is
+                            never used.
         """
         if isinstance(self.source, Molecular):
             if self.source._consolidated:
-                self._custom_words = None           # default to using source words
-                counts = np.vstack((item.wordcount['weight'] for item in self.source.items))
-                counts = counts - np.mean(counts, axis=0)
-                cov = np.cov(counts.T)
-                eiw, eiv = np.linalg.eigh(cov)       # eiw=e-vals, eiv=e-vectors
-                # Note .eig returns complex due to floating point precision errors
-                order = eiw.argsort()[::-1]
-                eiw = eiw[order]
-                eiv = eiv[:, order]                 # vals/vecs ordered by largest eval
-                if n==-1:
-                    self.axes = eiv
+                self._custom_ids = None             # default to using source words
+                self._ipca = None
+                if self.source.matrix is not None:
+                    counts = self.source.matrix
                 else:
-                    self.axes = eiv[:, :n]
+                    self.source._pad_items()
+                    counts = np.vstack([item.weights for item in self.source.items])
+                self.axes = self._pca(counts, n, solver, seed)
                 return self.axes
             else:
                 raise config.PrematureFunctionCall('Consolidate first.')
@@ -97,71 +186,391 @@ class BaseLearner(object):
             raise Exception('Does not work on Atomic objects.')
 
 
-    def load_axes(self, fname):
-        """load axes stored using save_axes()
+    def partial_fit(self, source, n):
+        """update axes with a batch of items using incremental PCA. Only the
+        running mean and the top n singular values/vectors are kept between
+        batches, so a stream of corpora can be learned from without holding all
+        items in memory. New words in a batch are added to self.words. Calling
+        get_axes(), set_axes() or load_axes() discards the incremental state.
+        @param source (Molecular): a batch of items with wordcounts generated.
+                                Does not need to be consolidated.
+        @param n (int): number of axes to keep.
+        Returns 2D array (each row -> word weight in self.words, column -> axis vector)
+        """
+        if not isinstance(source, Molecular):
+            raise config.InvalidArgument('Source must be a Molecular instance.')
+        if n < 1:
+            raise config.InvalidArgument('Number of axes must be positive.')
+        counts, indptr = source._gather()
+        nitems = len(indptr) - 1
+        if nitems==0:
+            return self.axes
+        if self._ipca is None:
+            seen, ids = 0, np.zeros(0, dtype=config.DT_ID['id'])
+            mean, sv = np.zeros(0, dtype=config.DT_FLOAT), np.zeros(0, dtype=config.DT_FLOAT)
+            components = np.zeros((0, 0), dtype=config.DT_FLOAT)
+        else:
+            seen, ids, mean, sv, components = self._ipca
+        new = np.setdiff1d(counts['id'], ids)
+        if len(new):                        # new words -> zero mean & weights
+            ids = np.concatenate((ids, new))
+            mean = np.concatenate((mean, np.zeros(len(new), dtype=mean.dtype)))
+            components = np.hstack((components, np.zeros((len(components), len(new)),
+                                                          dtype=components.dtype)))
+        batch = np.zeros((nitems, len(ids)), dtype=config.DT_FLOAT)
+        rows = np.repeat(np.arange(nitems), np.diff(indptr))
+        batch[rows, utils.positions(ids, counts['id'])] = counts['weight']
+        # CALCULATIONS
+        # SVD of the previous components scaled by their singular values, the
+        # centered batch, and a correction for the shift in mean (Ross et al.)
+        bmean = np.mean(batch, axis=0)
+        total = seen + nitems
+        stack = [sv[:, None] * components, batch - bmean]
+        if seen:
+            stack.append(np.sqrt(seen * nitems / total) * (mean - bmean))
+        _, sv, vt = np.linalg.svd(np.vstack(stack), full_matrices=False)
+        sv, components = sv[:n], vt[:n]
+        mean = (seen * mean + nitems * bmean) / total
+        self._ipca = (total, ids, mean, sv, components)
+        self._custom_ids = ids
+        self.axes = self._flip_signs(components.T)
+        return self.axes
+
+
+    def _pca(self, counts, n=-1, solver='auto', seed=None):
+        """principal components of the columns of counts.
+        @param counts (ndarray/CSRMatrix): rows -> observations, columns -> words.
+        @param n (int): number of components. -1 for all.
+        @param solver (str): 'full', 'gram', 'randomized' or 'auto'. See get_axes().
+        @param seed (int/RandomState): OPTIONAL. For 'randomized'. See get_axes().
+        Returns 2D array (each row -> word, column -> component) ordered by
+        descending variance.
+        """
+        nrows, ncols = counts.shape
+        k = ncols if n==-1 else min(n, ncols)
+        if solver=='auto':
+            solver = self._auto_solver(nrows, ncols)
+        if solver=='full':
+            axes = self._full_pca(counts, k)
+        elif solver=='gram':
+            axes = self._gram_pca(counts, k)
+        elif solver=='randomized':
+            axes = self._randomized_pca(counts, k, seed=seed)
+        else:
+            raise config.InvalidArgument('Solver must be one of: auto, full, gram, randomized.')
+        return self._flip_signs(axes).astype(config.DT_FLOAT, copy=False)
+
+
+    def _auto_solver(self, nrows, ncols):
+        """picks the cheaper exact PCA solver for a [nrows x ncols] matrix. With
+        fewer items than words, only the (< nrows) non-null axes exist and the
+        [items x items] Gram matrix is solved instead of [words x words]. The
+        randomized solver is never picked: on noisy wordcounts, whose variance
+        decays slowly over many axes, its axes can be far from the exact ones.
+        Returns 'gram' or 'full'.
+        """
+        return 'gram' if nrows < ncols else 'full'
+
+
+    def _full_pca(self, counts, k):
+        """top k eigenvectors of the full [words x words] covariance matrix.
+        """
+        if isinstance(counts, CSRMatrix):
+            cov = self._sparse_cov(counts)
+        else:
+            counts = counts - np.mean(counts, axis=0)
+            cov = np.cov(counts.T, dtype=counts.dtype)
+        eiw, eiv = np.linalg.eigh(cov)       # eiw=e-vals, eiv=e-vectors
+        # Note .eig returns complex due to floating point precision errors
+        order = eiw.argsort()[::-1]
+        eiv = eiv[:, order]                 # vecs ordered by largest eval
+        return eiv[:, :k]
+
+
+    def _gram_pca(self, counts, k):
+        """top k principal components from the [items x items] Gram matrix of
+        the centered counts. If C = centered counts, eigenvectors u of C.C^T map
+        to eigenvectors C^T.u of the covariance C^T.C with the same eigenvalues.
+        Only the rank of C (< number of items) axes have non-zero variance, so
+        at most that many axes are returned.
+        """
+        if isinstance(counts, CSRMatrix):   # few rows: dense [items x words] is small
+            counts = counts.toarray()
+        centered = counts - np.mean(counts, axis=0)
+        gram = np.dot(centered, centered.T)
+        eiw, eiv = np.linalg.eigh(gram)
+        order = eiw.argsort()[::-1]
+        eiw, eiv = eiw[order], eiv[:, order]
+        k = min(k, int(np.sum(eiw > eiw[0] * max(gram.shape) * np.finfo(gram.dtype).eps)))
+        axes = np.dot(centered.T, eiv[:, :k]) / np.sqrt(eiw[:k])    # unit vectors
+        return axes
+
+
+    def _randomized_pca(self, counts, k, oversamples=10, iterations=4, seed=None):
+        """top k principal components from a randomized SVD (Halko et al.) of the
+        centered counts. Centering is implicit so sparse counts stay sparse.
+        Memory is O((rows + words) x k) instead of O(words^2).
+        @param oversamples (int): extra random vectors for accuracy.
+        @param iterations (int): number of power iterations.
+        @param seed (int/RandomState): OPTIONAL. Seed or np.random.RandomState
+                            for the random vectors.
+        """
+        rng = seed if isinstance(seed, np.random.RandomState) else np.random.RandomState(seed)
+        mean = counts.mean(axis=0)
+        size = min(k + oversamples, min(counts.shape))
+        omega = rng.normal(size=(counts.shape[1], size)).astype(mean.dtype)
+        Q = self._cdot(counts, mean, omega)
+        for _ in range(iterations):         # power iterations w/ re-orthonormalization
+            Q, _ = np.linalg.qr(Q)
+            Z, _ = np.linalg.qr(self._ctdot(counts, mean, Q))
+            Q = self._cdot(counts, mean, Z)
+        Q, _ = np.linalg.qr(Q)
+        B = self._ctdot(counts, mean, Q).T  # B = Q.T . centered counts
+        _, _, vt = np.linalg.svd(B, full_matrices=False)
+        return vt[:k].T
+
+
+    def _cdot(self, counts, mean, M):
+        """(counts - mean) . M without centering counts in memory.
+        """
+        return counts.dot(M) - np.dot(mean, M)
+
+
+    def _ctdot(self, counts, mean, M):
+        """(counts - mean).T . M without centering counts in memory.
+        """
+        if isinstance(counts, CSRMatrix):
+            prod = counts.tdot(M)
+        else:
+            prod = np.dot(counts.T, M)
+        return prod - np.outer(mean, np.sum(M, axis=0))
+
+
+    def _flip_signs(self, axes):
+        """eigenvectors are unique up to sign. Flips axes so the element with
+        the largest magnitude in each is positive. This way all solvers return
+        the same axes.
+        """
+        if not axes.size:
+            return axes
+        largest = np.argmax(np.abs(axes), axis=0)
+        signs = np.sign(axes[largest, np.arange(axes.shape[1])])
+        signs[signs==0] = 1
+        return axes * signs
+
+
+    def _sparse_cov(self, matrix, size=1024):
+        """computes the covariance matrix of the columns of a CSRMatrix. Rows are
+        densified in blocks so the full items x words array is never allocated.
+        @param matrix (CSRMatrix): rows -> observations, columns -> variables.
+        @param size (int): number of rows to densify at a time.
+        Returns a 2D array [columns x columns].
+        """
+        mean = matrix.mean(axis=0)
+        cov = np.zeros((matrix.shape[1], matrix.shape[1]), dtype=matrix.data.dtype)
+        for block in matrix.blocks(size):
+            block -= mean
+            cov += np.dot(block.T, block)
+        return cov / (matrix.shape[0] - 1)
+
+
+    def load_axes(self, fname, mmap=True):
+        """load axes stored using save_axes(). The format is inferred from the
+        extension: '.npy' for binary, otherwise csv.
         @param fname (str): name of file containing axes
+        @param mmap (bool): for binary files, whether to memory-map the axes
+                            read-only instead of reading them into memory.
+                            Processes mapping the same file share one copy.
         """
-        n = utils.num_lines(fname)
-        with open(fname, 'r', newline='') as f:
-            c = reader(f)       # csv.reader
-            words = next(c)
-            self._custom_words = np.array(list(zip(words)), dtype=config.DT_WORD)['word']   # must me a list of tuples for structured array creation
-            axes_t = np.zeros((n-1, len(words)), dtype=float)
-            for i, row in enumerate(c):
-                axes_t[i,:] = row
-            self.axes = axes_t.T
+        if fname.endswith('.npy'):
+            words = np.load(self._words_fname(fname), allow_pickle=False)
+            axes = np.load(fname, mmap_mode='r' if mmap else None, allow_pickle=False)
+        else:
+            with open(fname, 'r', newline='') as f:
+                c = reader(f)       # csv.reader
+                words = next(c)
+                axes = np.array([row for row in c], dtype=config.DT_FLOAT).reshape((-1, len(words))).T
+        self._custom_ids = self.vocabulary.intern(words)
+        self._ipca = None
+        self.axes = axes
 
 
     def save_axes(self, fname):
-        """save the axes in a csv file. The first row is comma-separated self.words.
-        The following rows correspond to axis vectors in self.axes (i.e. self.axes.T)
+        """save the axes to file. If fname ends with '.npy', axes are saved in
+        binary as a 2D array [words x axes] in fname, and self.words are saved
+        in fname with '.npy' replaced by '.words.npy'. Otherwise saves a csv file.
+        The first row is comma-separated self.words. The following rows
+        correspond to axis vectors in self.axes (i.e. self.axes.T)
         @param fname (str): name of file to save
         """
+        if fname.endswith('.npy'):
+            np.save(self._words_fname(fname), np.asarray(self.words), allow_pickle=False)
+            np.save(fname, np.ascontiguousarray(self.axes), allow_pickle=False)
+            return
         with open(fname, 'w', newline='') as f:
             w = writer(f)
             w.writerow(self.words)
             w.writerows(self.axes.T)
 
 
-    def project(self, source):
+    def _words_fname(self, fname):
+        """name of the file storing words for binary axes file fname.
+        """
+        return fname[:-len('.npy')] + '.words.npy'
+
+
+    def save_model(self, fname):
+        """save the complete state of the learner to a single file: axes and
+        their words, cluster centers, regression coefficients and decision tree.
+        Attributes that are not set are left out. The file is an uncompressed
+        .npz archive of arrays, so sections can be memory-mapped when loaded.
+        @param fname (str): name of file to save
+        """
+        sections = {'version': np.array(config.MODEL_VERSION)}
+        if self.axes is not None:
+            sections['axes'] = np.ascontiguousarray(self.axes)
+            sections['words'] = np.asarray(self.words)
+        for name in ('ccenters', 'lrc', 'lrf'):
+            if getattr(self, name) is not None:
+                sections[name] = np.asarray(getattr(self, name))
+        if self.dtree is not None:
+            for key, value in self.dtree.to_arrays().items():
+                sections['dtree.' + key] = value
+        with open(fname, 'wb') as f:
+            np.savez(f, **sections)
+
+
+    def load_model(self, fname, mmap=True):
+        """load the state saved by save_model(). Only the file index is read
+        now. Each section is read, or memory-mapped, when first accessed.
+        Replaces axes, ccenters, lrc, lrf and dtree.
+        @param fname (str): name of file containing the model bundle.
+        @param mmap (bool): whether to memory-map array sections read-only
+                            instead of reading them into memory.
+        """
+        bundle = np.load(fname, allow_pickle=False)
+        if 'version' not in bundle.files or int(bundle['version']) > config.MODEL_VERSION:
+            raise config.InvalidArgument('Unsupported model bundle version.')
+        for name in self._sections:     # unset so they are loaded on access
+            self.__dict__.pop(name, None)
+        self._bundle = (fname, bundle, mmap)
+        self._ipca = None
+        self._rows_cache = None
+        self._ctree = None
+
+
+    def _load_section(self, name):
+        """reads an attribute from the model bundle. Called by Section.
+        Returns the value of the attribute, or None if not in the bundle.
+        """
+        if self.__dict__.get('_bundle') is None:
+            return None
+        fname, bundle, mmap = self._bundle
+        if name=='_custom_ids':
+            if 'words' not in bundle.files:
+                return None
+            return self.vocabulary.intern(bundle['words'])
+        if name=='dtree':
+            if 'dtree.axis' not in bundle.files:
+                return None
+            return DTree.from_arrays({key[len('dtree.'):]: bundle[key]
+                        for key in bundle.files if key.startswith('dtree.')})
+        if name not in bundle.files:
+            return None
+        value = utils.npz_memmap(fname, name) if mmap else None
+        return bundle[name] if value is None else value
+
+
+    def project(self, source, ids=None):
         """projects the wordcounts of the source on the axes calculated from the
-        get_axes() or get_comment_axes() functions. If source is Molecular, assumes
-        that it is consolidated (for faster processing).
-        @param source (Atomic/Molecular): an instance of an Atomic/Molecular object
-                                        with wordcounts calculated.
+        get_axes() or get_comment_axes() functions. Source words are mapped to
+        rows in self.axes once, all weights are gathered into a single matrix
+        and projected with one product.
+        @param source (Atomic/Molecular/CSRMatrix): an instance of an Atomic/
+                                        Molecular object with wordcounts calculated,
+                                        or a CSRMatrix (rows -> items, columns -> words).
+                                        Molecular need not be consolidated.
+        @param ids (array): OPTIONAL. Only for CSRMatrix source. Word id of each
+                            column. Defaults to self.ids i.e. columns are rows
+                            of self.axes.
         Returns a 2D numpy array of projections (each row->coordinates, column->axis)
         """
         # PREPROCESSING
         if self.axes is None:
             raise config.PrematureFunctionCall('Calculate axes first.')
-        wc = None
-        if isinstance(source, Molecular):
-            if not source._consolidated:
-                raise cofig.PrematureFunctionCall('Consolidate first.')
-            wc = (i.wordcount for i in source.items)
-            weights = np.zeros((len(source.items), len(self.axes)))
+        if isinstance(source, CSRMatrix):
+            if ids is None:
+                return source.dot(self.axes)
+            return source.dot(self._source_axes(self._axis_rows(ids)))
+        elif isinstance(source, Molecular):
+            if source._consolidated:
+                axes = self._source_axes(self._axis_rows(source.ids))
+                if source.matrix is not None:
+                    return source.matrix.dot(axes)
+                if not len(source.items):
+                    return np.zeros((0, self.axes.shape[1]), dtype=self.axes.dtype)
+                source._pad_items()     # all items have words in order of source.ids
+                weights = np.vstack([item.weights for item in source.items])
+                return np.dot(weights, axes)
+            counts, indptr = source._gather()
+            axes = np.vstack((self.axes, np.zeros((1, self.axes.shape[1]), dtype=self.axes.dtype)))
+            cols = self._axis_rows(counts['id'])
+            cols[cols<0] = len(self.axes)       # zero row for unknown words
+            matrix = CSRMatrix(counts['weight'], cols, indptr, (len(indptr)-1, len(axes)))
+            return matrix.dot(axes)
         elif isinstance(source, Atomic):
-            wc = [source.wordcount]
-            weights = np.zeros((1,len(self.axes)))
-        # CALCULATIONS
-        zero_words = np.setdiff1d(self.words, source.words, assume_unique=True)
-        zero_wordcounts = np.array(list(zip(zero_words, np.zeros(len(zero_words)))), dtype=config.DT_WORD_WEIGHT)
-        in_both = np.in1d(source.words, self.words, assume_unique=True)
-        for i, v in enumerate(wc):            # v-> vector , wc -> wordcount
-            vec = np.append(v[in_both], zero_wordcounts)
-            vec.sort(order=[config.DEFAULT_SORT_ORDER])
-            # vec now only contains words present in self.words in same order
-            weights[i] = vec['weight']
-        return np.dot(weights, self.axes)   #projection = weights . axes
-
-
-    def k_means_cluster(self, projections, nclusters):
+            axes = self._source_axes(self._axis_rows(source.ids))
+            return np.dot(source.weights, axes).reshape((1, -1))
+        raise config.InvalidArgument('Source must be Atomic, Molecular or CSRMatrix.')
+
+
+    def _axis_rows(self, ids):
+        """maps word ids to rows in self.axes. The sort order of self.ids is
+        cached so repeated projections only search, not sort.
+        @param ids (array): an array of word ids.
+        Returns an int array the same length as ids, with the row in self.axes
+        for each id, or -1 if the id is not in self.ids.
+        """
+        own = self.ids
+        if self._rows_cache is None or not np.array_equal(self._rows_cache[0], own):
+            self._rows_cache = (np.array(own), np.argsort(own))
+        own, order = self._rows_cache
+        return utils.positions(own, ids, order)
+
+
+    def _source_axes(self, rows):
+        """gathers rows of self.axes in the order of a source's words.
+        @param rows (array): row in self.axes for each source word, -1 if the
+                            word is not in self.words.
+        Returns a 2D array [len(rows) x # of axes]. Words not in self.words have
+        zero weight.
+        """
+        axes = np.zeros((len(rows), self.axes.shape[1]), dtype=self.axes.dtype)
+        found = np.flatnonzero(rows>=0)
+        axes[found] = self.axes[rows[found]]
+        return axes
+
+
+    def k_means_cluster(self, projections, nclusters, max_iter=300, tol=1e-4,
+                        batch_size=None, store=True, seed=None):
         """using projection coordinates, group coordinates together based on
-        smallest cartesian distance to cluster centers.
+        smallest cartesian distance to cluster centers. Centers are seeded with
+        k-means++ and refined until assignments stop changing, centers move less
+        than tol, or max_iter iterations.
         @param projections (2D ndarray): a 2D numpy array with rows representing
                                     coordinates on self.axes. If 1D array, each
                                     element is considered a separate coordinate.
         @param nclusters (int): number of clusters to create
+        @param max_iter (int): maximum number of iterations.
+        @param tol (float): stop when the squared movement of centers is less
+                            than tol x the variance of projections.
+        @param batch_size (int): OPTIONAL. If specified, uses mini-batch k-means
+                            with random batches of this many coordinates per
+                            iteration. Faster for very many projections.
+        @param store (bool): whether to store centers in self.ccenters.
+        @param seed (int/RandomState): OPTIONAL. Seed or np.random.RandomState
+                            for seeding centers and sampling batches. If None,
+                            numpy's global random state is used.
         Returns a tuple. First element is a 2D numpy array with each row -> cluster
         center coordinate (len==# of axes).
         Second element is 1D numpy array the size of projection with int labels
@@ -171,48 +580,142 @@ class BaseLearner(object):
         """
         # PREPROCESSING
         if isinstance(projections, (int, float)):
-            proj = np.array([proj])
+            projections = np.array([projections])
+        projections = np.asarray(projections, dtype=config.DT_FLOAT)
         if len(projections.shape)==1:   # accounting for 1D projections if passed
             projections = projections.reshape((1,-1)).T
+        if nclusters < 1 or nclusters > len(projections):
+            raise config.InvalidArgument('Invalid number of clusters.')
         # CALCULATIONS
-        pmax = np.amax(projections)  # get bounding box for cluster centers
-        pmin = np.amin(projections)
-        centers = np.random.randint(pmin, pmax, size=(nclusters, len(projections[0]))) # allocate memory
-        pre = np.zeros(len(projections))
-        nex = np.ones(len(projections))
-        while not np.array_equal(pre, nex):
-            pre = nex
-            # calculate new assignments based on centers
-            for i in range(len(projections)):
-                closest = None
-                for j in range(len(centers)):
-                    diff = projections[i] - centers[j]
-                    dist = np.dot(diff, diff)   # squared cartesian distance
-                    if closest is None:
-                        closest = dist
-                        nex[i] = j
-                    elif dist < closest:
-                        closest = dist
-                        nex[i] = j
-
-            # calculate new centers based on assignments
-            for k in range(len(centers)):
-                mine = nex==k
-                if np.any(mine):
-                    centers[k] = np.mean(projections[mine], axis=0)
-
-        self.ccenters = centers
-        return centers, nex
-
-
-    def assign_to_cluster(self, projections, ccenters=None):
+        tol = tol * np.mean(np.var(projections, axis=0))
+        if seed is None:
+            rng = np.random
+        elif isinstance(seed, np.random.RandomState):
+            rng = seed
+        else:
+            rng = np.random.RandomState(seed)
+        centers = self._kmeans_seeds(projections, nclusters, rng)
+        if batch_size is None:
+            labels = None
+            for _ in range(max_iter):
+                dist = self._sq_distances(projections, centers)
+                nex = np.argmin(dist, axis=1)
+                if labels is not None and np.array_equal(labels, nex):
+                    break
+                labels = nex
+                new = self._cluster_means(projections, labels, centers)
+                empty = np.bincount(labels, minlength=nclusters)==0
+                if np.any(empty):       # re-seed empty clusters at farthest points
+                    far = np.argsort(dist[np.arange(len(labels)), labels])
+                    new[empty] = projections[far[-np.sum(empty):]]
+                shift = np.sum((new - centers)**2)
+                centers = new
+                if shift <= tol:
+                    break
+        else:
+            counts = np.zeros(nclusters)
+            for _ in range(max_iter):
+                batch = projections[rng.randint(len(projections), size=batch_size)]
+                labels = np.argmin(self._sq_distances(batch, centers), axis=1)
+                # per center learning rate 1/(# of points assigned so far)
+                bcounts = np.bincount(labels, minlength=nclusters)
+                counts += bcounts
+                rate = bcounts / np.maximum(counts, 1)
+                means = self._cluster_means(batch, labels, centers)
+                new = centers + (means - centers) * rate[:, None]
+                shift = np.sum((new - centers)**2)
+                centers = new
+                if shift <= tol:
+                    break
+        labels = self._nearest_center(projections, centers)
+        if store:
+            self.ccenters = centers
+        return centers, labels
+
+
+    def _kmeans_seeds(self, projections, nclusters, rng=np.random):
+        """greedy k-means++ seeding. Each new center is chosen from a few random
+        projections, sampled with probability proportional to their squared
+        distance to the closest center, as the one that most reduces the total
+        squared distance.
+        @param rng (RandomState): source of random numbers.
+        Returns a 2D array [nclusters x # of axes].
+        """
+        ntrials = 2 + int(np.log(nclusters))
+        centers = np.zeros((nclusters, projections.shape[1]), dtype=projections.dtype)
+        centers[0] = projections[rng.randint(len(projections))]
+        closest = self._sq_distances(projections, centers[:1])[:, 0]
+        for i in range(1, nclusters):
+            total = np.sum(closest)
+            if total > 0:
+                trials = np.searchsorted(np.cumsum(closest),
+                                         rng.uniform(0, total, size=ntrials))
+                trials = np.minimum(trials, len(projections)-1)
+            else:               # all points coincide with centers
+                trials = rng.randint(len(projections), size=ntrials)
+            dist = np.minimum(closest[:, None],
+                              self._sq_distances(projections, projections[trials]))
+            best = np.argmin(np.sum(dist, axis=0))
+            centers[i] = projections[trials[best]]
+            closest = dist[:, best]
+        return centers
+
+
+    def _sq_distances(self, projections, centers):
+        """squared cartesian distances between all projections and centers using
+        |x - c|^2 = |x|^2 - 2x.c + |c|^2 so the bulk is a single matrix product.
+        Returns a 2D array [len(projections) x len(centers)].
+        """
+        dist = np.dot(projections, centers.T)
+        dist *= -2
+        dist += np.einsum('ij,ij->i', projections, projections)[:, None]
+        dist += np.einsum('ij,ij->i', centers, centers)
+        return np.maximum(dist, 0, out=dist)
+
+
+    def _cluster_means(self, projections, labels, centers):
+        """mean of projections in each cluster. Clusters with no projections
+        keep their center from centers.
+        Returns a 2D array the shape of centers.
+        """
+        counts = np.bincount(labels, minlength=len(centers))
+        means = np.copy(centers)
+        found = counts > 0
+        for j in range(projections.shape[1]):   # loop over axes, not points
+            sums = np.bincount(labels, weights=projections[:, j], minlength=len(centers))
+            means[found, j] = sums[found] / counts[found]
+        return means
+
+
+    def _nearest_center(self, projections, centers, chunk=2**20):
+        """index of the closest center for each projection. Distances are
+        computed for blocks of projections so at most chunk distances are held
+        in memory at a time.
+        Returns a 1D int array.
+        """
+        labels = np.zeros(len(projections), dtype=np.intp)
+        size = max(1, chunk // max(1, len(centers)))
+        for i in range(0, len(projections), size):
+            dist = self._sq_distances(projections[i:i+size], centers)
+            labels[i:i+size] = np.argmin(dist, axis=1)
+        return labels
+
+
+    def assign_to_cluster(self, projections, ccenters=None, tree=False, chunk=2**20):
         """given cluster center coordinates on self.axes, assign cluster to each
         projection based on the smallest cartesian distance.
         @param projections (ndarray): 2D numpy array of coordinates on self.axes.
-                                    If 1D, each element is a separate coordinate.
+                                    If 1D and centers are 1D coordinates, each
+                                    element is a separate coordinate. Otherwise
+                                    a 1D array is a single coordinate.
         @param ccenters (ndarray): OPTIONAL. 2D numpy array of cluster center
                                 coordinates. If not specified, result of k_means_cluster
                                 is used.
+        @param tree (bool): whether to use a base.KDTree index over the centers.
+                            The index is built once and reused while the centers
+                            stay the same. Faster for many centers in few axes.
+        @param chunk (int): maximum number of projection-center distances to
+                            hold in memory at a time.
         Returns a 1D array where each element is the index of cluster center in
         ccenters the projection matched with.
         """
@@ -222,24 +725,69 @@ class BaseLearner(object):
                 raise config.PrematureFunctionCall('Specify centers or call \
                             k_means_cluster first to compute centers.')
             ccenters = self.ccenters
+        ccenters = np.asarray(ccenters, dtype=config.DT_FLOAT)
+        if len(ccenters.shape)==1:
+            ccenters = ccenters.reshape((-1,1))
         if isinstance(projections, (int, float)):
-            proj = np.array([proj])
+            projections = np.array([projections])
+        projections = np.asarray(projections, dtype=config.DT_FLOAT)
         if len(projections.shape)==1:
-            projections = projections.reshape((1,-1))
+            if ccenters.shape[1]==1:
+                projections = projections.reshape((-1,1))
+            else:
+                projections = projections.reshape((1,-1))
         # CALCULATIONS
-        assignments = np.zeros(len(projections))
-        for i in range(len(projections)):
-            closest = None
-            for j in range(len(ccenters)):
-                diff = ccenters[j] - projections[i]
-                dist = np.dot(diff, diff)
-                if closest is not None:
-                    if dist < closest:
-                        assignments[i] = j
-                        closest = dist
-                else:
-                    closest = dist
-        return assignments
+        if not tree:
+            return self._nearest_center(projections, ccenters, chunk)
+        if self._ctree is None or not np.array_equal(self._ctree[0], ccenters):
+            self._ctree = (np.copy(ccenters), KDTree(ccenters))
+        size = max(1, chunk // max(1, len(self._ctree[1].leaves)))
+        return self._ctree[1].query(projections, size)[0]
+
+
+    def build_neighbour_index(self, projections, nlists=None):
+        """builds an index over projections to find the most similar items with
+        nearest_neighbours(). More items can be added later with self.nindex.add().
+        @param projections (ndarray): 2D numpy array of coordinates on self.axes.
+                                    If 1D, each element is a separate coordinate.
+        @param nlists (int): OPTIONAL. Number of k-means clusters to partition
+                            projections into for approximate search. If None,
+                            only exact search is available.
+        Returns a base.NeighbourIndex instance, also stored in self.nindex.
+        """
+        projections = np.asarray(projections, dtype=config.DT_FLOAT)
+        if len(projections.shape)==1:
+            projections = projections.reshape((1,-1)).T
+        centers = None
+        if nlists:          # centers from k-means on a sample of projections
+            nlists = min(nlists, len(projections))
+            sample = np.random.permutation(len(projections))[:40*nlists]
+            centers, _ = self.k_means_cluster(projections[sample], nlists,
+                                              max_iter=20, store=False)
+        self.nindex = NeighbourIndex(projections, centers)
+        return self.nindex
+
+
+    def nearest_neighbours(self, projections, k=10, nprobe=None):
+        """finds the k indexed projections closest to each of projections. Call
+        build_neighbour_index() first. If projections are themselves in the
+        index, each is its own nearest neighbour.
+        @param projections (ndarray): 2D numpy array of coordinates on self.axes.
+                                    If 1D, it is a single coordinate.
+        @param k (int): number of neighbours to find.
+        @param nprobe (int): OPTIONAL. For approximate search, number of clusters
+                            closest to a projection to search. Needs an index
+                            built with nlists. If None, the search is exact.
+        Returns a tuple (indices, distances) of 2D arrays [projections x k].
+        Indices are rows in the indexed projections, sorted by increasing
+        squared cartesian distance.
+        """
+        if self.nindex is None:
+            raise config.PrematureFunctionCall('Call build_neighbour_index() first.')
+        projections = np.asarray(projections, dtype=config.DT_FLOAT)
+        if len(projections.shape)==1:
+            projections = projections.reshape((1,-1))
+        return self.nindex.query(projections, k, nprobe)
 
 
     def linear_regression(self, projections, predictions, store=True):
@@ -256,12 +804,15 @@ class BaseLearner(object):
         """
         # PREPROCESSING
         if isinstance(projections, (int, float)):
-            proj = np.array([proj])
+            projections = np.array([projections])
+        projections = np.asarray(projections, dtype=config.DT_FLOAT)
         if len(projections.shape)==1:   # accounting for 1D projections if passed
             projections = projections.reshape((1,-1)).T
-        coefficients = np.vstack((np.ones(projections.shape[0]), projections.T)).T
+        coefficients = np.vstack((np.ones(projections.shape[0], dtype=projections.dtype),
+                                  projections.T)).T
+        predictions = np.asarray(predictions, dtype=config.DT_FLOAT)
         # CALCULATIONS
-        res =  np.linalg.lstsq(coefficients, predictions)[0]
+        res = np.linalg.lstsq(coefficients, predictions, rcond=None)[0]
         if store:
             self.lrc = res
         return res
@@ -283,63 +834,103 @@ class BaseLearner(object):
                                 call linear_regression() first.')
             coefficients = self.lrc
         if isinstance(projections, (int, float)):
-            proj = np.array([proj])
+            projections = np.array([projections])
         if len(projections.shape)==1:
             projections = projections.reshape((1,-1)).T
         # CALCULATIONS
         return coefficients[0] + np.dot(coefficients[1:], projections.T)
 
 
-    def logistic_regression(self, projections, labels):
+    def logistic_regression(self, projections, labels, alpha=1e-4, max_iter=100,
+                            tol=1e-8, store=True):
         """perform logistic regression on projections and their binary labels.
+        Coefficients are fit by Newton's method (iteratively reweighted least
+        squares) on the full design matrix, with a small L2 penalty so that
+        perfectly separable labels still give finite coefficients.
         @param projections (ndarray): a 2D numpy array of n coordinates [n x dimensions].
                                     If 1D, each element is a separate coordinate.
         @param labels (ndarray): a 1D numpy array of n 0/1 labels for each projection.
-        Returns a function that when passed a single projection (1D array) returns
-        a 1 or 0 label.
+        @param alpha (float): L2 penalty on coefficients other than intercept.
+        @param max_iter (int): maximum number of Newton iterations.
+        @param tol (float): stop when coefficients change by less than tol.
+        @param store (bool): whether to store results in self.lrf for later use.
+        Returns a 1D numpy array [1 + # of axes] of coefficients [a0, a1, a2,...]
+        such that probability of label 1 = 1 / (1 + exp(-(a0 + a1.x1 + a2.x2 +...)))
         """
-        c = self.linear_regression(projections, labels, False)  # coefficients
-        def r(proj):    # proj is a 1D array of a single coordinate
-            if isinstance(proj, (int, float)):
-                proj = np.array([proj])
-            y = c[0] + np.dot(proj, c[1:])
-            z = 1 / (1 + np.exp(-y))
-            return 1 if z>=0.5 else 0
-        self.lrf = r
-        return r
+        # PREPROCESSING
+        if isinstance(projections, (int, float)):
+            projections = np.array([projections])
+        projections = np.asarray(projections, dtype=config.DT_FLOAT)
+        if len(projections.shape)==1:   # accounting for 1D projections if passed
+            projections = projections.reshape((1,-1)).T
+        labels = np.asarray(labels, dtype=projections.dtype)
+        X = np.hstack((np.ones((len(projections), 1), dtype=projections.dtype), projections))
+        penalty = np.full(X.shape[1], alpha, dtype=X.dtype)
+        penalty[0] = 0                  # intercept is not penalized
+        tol = max(tol, 10 * np.finfo(X.dtype).eps)  # reachable at this precision
+        # CALCULATIONS
+        coefficients = np.zeros(X.shape[1], dtype=X.dtype)
+        for _ in range(max_iter):
+            p = self._sigmoid(np.dot(X, coefficients))
+            gradient = np.dot(X.T, p - labels) + penalty * coefficients
+            w = p * (1 - p)                 # IRLS weights
+            hessian = np.dot(X.T * w, X) + np.diag(penalty)
+            step = np.linalg.lstsq(hessian, gradient, rcond=None)[0]
+            coefficients -= step
+            if np.max(np.abs(step)) < tol:
+                break
+        if store:
+            self.lrf = coefficients
+        return coefficients
 
 
-    def logistic_prediction(self, projections, rfunc=None):
+    def logistic_prediction(self, projections, coefficients=None, probabilities=False):
         """compute the labels for each projection based on logistic regression
-        function.
+        coefficients.
         @param projections (ndarray): a 2D numpy array of n coordinates [n x dimensions].
                                     If 1D, each element is a separate coordinate.
-        @param rfunc (function): OPTIONAL. a function that takes a single element
-                                in projections and returns a label.
-        Returns a 1D numpy array of binary labels in the same order as projections.
+        @param coefficients (ndarray): OPTIONAL. a 1D array of dimensions+1
+                                    coefficients: [a0, a1, a2,...], a0 is intercept.
+                                    Defaults to result of logistic_regression().
+        @param probabilities (bool): whether to return probabilities of label 1
+                                    instead of labels.
+        Returns a 1D numpy array of binary labels (or probabilities) in the same
+        order as projections.
         """
         # PREPROCESSING
-        if rfunc is None:
+        if coefficients is None:
             if self.lrf is None:
-                raise config.PrematureFunctionCall('Specify rfunc or call linear\
-                            _regression() first.')
-            rfunc = self.lrf
+                raise config.PrematureFunctionCall('Specify coefficients or call \
+                            logistic_regression() first.')
+            coefficients = self.lrf
         if isinstance(projections, (int, float)):
-            proj = np.array([proj])
+            projections = np.array([projections])
+        projections = np.asarray(projections, dtype=config.DT_FLOAT)
         if len(projections.shape)==1:
             projections = projections.reshape((1,-1)).T
-        labels = np.zeros(len(projections))
         # CALCULATIONS
-        for i in range(len(labels)):
-            labels[i] = rfunc(projections[i])
-        return labels
+        z = coefficients[0] + np.dot(projections, coefficients[1:])
+        if probabilities:
+            return self._sigmoid(z)
+        return (z >= 0).astype(int)     # probability >= 0.5
+
+
+    def _sigmoid(self, z):
+        """logistic function 1 / (1 + exp(-z)), without overflow for large |z|.
+        """
+        return 0.5 * (1 + np.tanh(0.5 * z))
 
 
-    def decision_tree(self, projections, labels, branches=2):
+    def decision_tree(self, projections, labels, branches=2, quantiles=None,
+                      max_depth=None):
         """computes a decision tree based on attributes contained in projections
         by splitting by attribute which yields maximum information gain for the
         labels. Splits until all coordinates in projections used up or if there
         is no entropy in the label subsets.
+        If quantiles is specified, each attribute is instead quantized once into
+        at most that many quantile bins (1 byte per value) and every node is
+        split in two at the bin boundary with maximum information gain. Branch
+        points are then chosen from the data, and attributes may be reused.
         @param projections (ndarray): a 2D numpy array where each row is
                             coordinates representing a point. If 1D, each element
                             is considered a separate coordinate of 1 dimension.
@@ -354,57 +945,67 @@ class BaseLearner(object):
                             are upper bounds (inclusive) of the split. For
                             n values, there will be n+1 splits. A minimum of
                             n=1 (split points) i.e 2 branches are required
-                            for all attributes.
+                            for all attributes. Ignored if quantiles is specified.
+        @param quantiles (int): OPTIONAL. Number of quantile bins (2-256) per
+                            attribute for histogram based binary splits.
+        @param max_depth (int): OPTIONAL. Maximum depth of the tree. Root has
+                            depth 0.
+        Returns a base.DTree instance.
         """
         # PREPROCESSING
         if len(projections.shape)==1:
             projections = projections.reshape((1,-1)).T
+        labels = np.asarray(labels)
+        if quantiles is not None:
+            return self._histogram_tree(projections, labels, quantiles, max_depth)
         if isinstance(branches, (int, float)):      # if branches is number, conv to list of #
             branches = [branches] * len(projections[0])
         if isinstance(branches, (list, tuple, np.ndarray)) and \
-            isinstance(branches[0], (int, float)):  # if list of #, conv to list of
-            nbranches = []                          # lists of split points
+            isinstance(branches[0], (int, float, np.integer)):  # if list of #, conv
+            nbranches = []                                      # to lists of split points
             for i, n in enumerate(branches):
                 minimum = np.min(projections[:, i])             # smallest value of attribute
-                d = (np.max(projections[:, 1]) - minimum) / n   # interval between branch values
+                d = (np.max(projections[:, i]) - minimum) / n   # interval between branch values
                 nbranches.append([minimum+j*d for j in range(1,n)])
             branches = nbranches
-        branches = np.array(branches)
-        # Now branches is a 2D array, where each sublist contains the
+        branches = [np.asarray(b, dtype=float) for b in branches]
+        # Now branches is a list of arrays, where each array contains the
         # inclusive top limit of splits for each attribute
         # i.e [[1,2],[2,3]...], then the first sublist, [1,2] containing 2 values,
         # for the first attribute [<=1, >1 and <=2, >2] will split projections
-        # into 2+1 branches
+        # into 2+1 branches.
+        # Each projection's branch on every attribute is computed once. Nodes
+        # then only hold the row indices of their projections.
+        bins = np.zeros(projections.shape, dtype=np.intp)   # [rows x attributes]
+        for i, b in enumerate(branches):
+            if len(b):
+                bins[:, i] = np.searchsorted(b, projections[:, i])  # x<=b[0] -> 0...
+        nbins = np.array([len(b)+1 for b in branches])
+        ulabels, codes = np.unique(labels, return_inverse=True)
         # CALCULATIONS
         dtree = DTree()                       # contains the finished decision tree
         counter=0                             # counts # of nodes added to tree
-        q = deque()                           # contains references to proj pending _find_max_info_gain
-        bfilter = np.array([1 if len(x) else 0 for x in branches], dtype=bool)
-        q.appendleft((np.ones(len(labels), dtype=bool), 0, -1, bfilter)) # queue of (filter, index, parent, branch_filter)
-
+        q = deque()                           # contains nodes pending _find_max_info_gain
+        usable = np.array([len(b)>0 for b in branches], dtype=bool)
+        q.appendleft((np.arange(len(labels)), 0, -1, usable, 0)) # queue of (rows, index,
+                                                            # parent, usable attributes, depth)
         while len(q):                         # breadth-first traversal of decision tree
-            f, index, parent, bfilter = q.pop()
-            ig, bi, filters, probs = self._find_max_info_gain(projections[f][:,bfilter], labels[f], branches[bfilter])
-
-            if bi is not None:
-                j=0                             # bi is the index of branch axis in
-                for i, b in enumerate(bfilter): # branches[bfilter], i.e. the bi'th
-                    if b:                       # True value in bfilter. This finds
-                        j+=1                    # the absolute index of that True
-                        if i==bi:               # value, hence branch axis in the
-                            break               # original array 'branches'.
-
-            dtree.add_node(index=index, parent=parent, axis=i if bi is not None else None,
-                    branch=branches[bi] if bi is not None else (), probabilities=probs)
-
-            bfilter_copy = np.copy(bfilter)
-            bfilter_copy[bi] = False
+            rows, index, parent, usable, depth = q.pop()
+            if max_depth is not None and depth>=max_depth:
+                usable = np.zeros_like(usable)
+            ig, axis, probs = self._find_max_info_gain(bins[rows], codes[rows],
+                                                       nbins, usable, ulabels)
+            dtree.add_node(index=index, parent=parent, axis=axis,
+                    branch=branches[axis] if axis is not None else (), probabilities=probs)
             if ig>0:    # if there was any info gain, then process results
-                for fi in filters:          # fi is of length f[f], i.e. whatever the
-                    counter+=1              # filter let through, so cannot apply to
-                    f_copy = np.copy(f)     # the original projections. This resizes
-                    f_copy[f_copy] = fi[:]  # fi so it can directly act on projections.
-                    q.appendleft((f_copy, counter, index, bfilter_copy))
+                child_usable = np.copy(usable)
+                child_usable[axis] = False
+                b = bins[rows, axis]
+                order = np.argsort(b, kind='mergesort')     # rows grouped by branch
+                bounds = np.cumsum(np.bincount(b, minlength=nbins[axis]))[:-1]
+                for child in np.split(rows[order], bounds): # one child per branch
+                    counter+=1
+                    q.appendleft((child, counter, index, child_usable, depth+1))
             else:       # if no info gain i.e no more branches or labels fully classified
                 pass
         dtree.construct()
@@ -426,64 +1027,211 @@ class BaseLearner(object):
         return self.dtree.classify(projections)
 
 
-    def _find_max_info_gain(self, projections, labels, branches):
-        """given projections, their labels, and branching points, calculates
-        branching on which attribute would yeild the maximum information gain.
-        @param projections (ndarray): 2D numpy array, each row-> coordinate.
-        @param labels (array/list): list of labels same length as projections.
-        @param branches (ndarray/list): 2D array, each row -> split points for
-                                    coord attribute/axis in the row's index.
+    def _find_max_info_gain(self, bins, codes, nbins, usable, ulabels):
+        """given the branch of each projection on each attribute and their labels,
+        calculates branching on which attribute would yeild the maximum information
+        gain. Label counts for every branch of every attribute are computed
+        with a single np.bincount.
+        @param bins (ndarray): 2D int array [projections x attributes], index of
+                            branch each projection falls in for each attribute.
+        @param codes (ndarray): 1D int array, index of label of each projection
+                            in ulabels.
+        @param nbins (ndarray): 1D int array, # of branches of each attribute.
+        @param usable (ndarray): 1D bool array, attributes that can be split on.
+        @param ulabels (ndarray): 1D array of all unique labels.
         Returns a tuple of:    (maximum info gain,
-                                index of axis that was split,
-                                bool filters describing projs in each split,
-                                an array of tulples (label, probability))
+                                index of attribute that was split or None,
+                                an array of tuples (label, probability))
         """
-        mig_bi = None   # max information gain branch index
-        mig = 0         # max info gain
-        mig_f = None    # max info gain filters
+        size_parent = len(codes)
+        nlabels = len(ulabels)
+        labels_probs = self._label_probs(codes, ulabels)
+        attrs = np.flatnonzero(usable)
+        if size_parent==0 or not len(attrs):
+            return 0, None, labels_probs
+        p = labels_probs[:,1]                           # probability p
+        entropy_parent = np.sum(-p * np.log(p))
+
+        # joint histogram of (attribute, branch, label) over all usable attributes
+        offsets = np.zeros(len(attrs)+1, dtype=np.intp)
+        np.cumsum(nbins[attrs], out=offsets[1:])
+        keys = (bins[:, attrs] + offsets[:-1]) * nlabels + codes[:, None]
+        hist = np.bincount(keys.ravel(), minlength=offsets[-1]*nlabels)
+        hist = hist.reshape((offsets[-1], nlabels)).astype(float)
+        sizes = np.sum(hist, axis=1)                    # projections in each branch
+        cp = hist / np.maximum(sizes, 1)[:, None]       # child probabilities
+        with np.errstate(divide='ignore', invalid='ignore'):
+            plogp = np.where(hist > 0, -cp * np.log(cp), 0)
+        entropy_branches = np.sum(plogp, axis=1) * sizes / size_parent
+        entropy_children = np.add.reduceat(entropy_branches, offsets[:-1])
+        ig = entropy_parent - entropy_children           # information gain
+        best = np.argmax(ig > np.max(ig) - 1e-12)       # first of (near) ties
+        if ig[best] <= 1e-12:
+            return 0, None, labels_probs
+        return ig[best], attrs[best], labels_probs
 
-        ulbl, counts = np.unique(labels, return_counts=True)
-        size_parent = len(labels)
-        p = counts / size_parent       # probability p
+
+    def _label_probs(self, codes, ulabels):
+        """Returns a 2D array of rows [label, probability] for labels present in
+        codes (indices into ulabels).
+        """
+        counts = np.bincount(codes, minlength=len(ulabels))
+        present = counts > 0
+        p = counts[present] / max(len(codes), 1)
+        return np.vstack((ulabels[present], p)).T
+
+
+    def _histogram_tree(self, projections, labels, quantiles, max_depth=None):
+        """decision tree with binary splits on quantile bins. See decision_tree().
+        Each attribute is quantized once to uint8 bin indices. Nodes only hold
+        row indices and find their best split from per-bin label counts.
+        Returns a base.DTree instance.
+        """
+        # PREPROCESSING
+        if not 2 <= quantiles <= 256:
+            raise config.InvalidArgument('Quantiles must be between 2 and 256.')
+        edges = []                            # bin boundaries of each attribute
+        binned = np.zeros(projections.shape, dtype=np.uint8)
+        for i in range(projections.shape[1]):
+            e = np.unique(np.quantile(projections[:, i],
+                                      np.linspace(0, 1, quantiles+1)[1:-1]))
+            edges.append(e)
+            binned[:, i] = np.searchsorted(e, projections[:, i])    # x<=e[0] -> 0...
+        ulabels, codes = np.unique(labels, return_inverse=True)
+        # CALCULATIONS
+        dtree = DTree()
+        counter = 0
+        q = deque()
+        q.appendleft((np.arange(len(labels)), 0, -1, 0))    # (rows, index, parent, depth)
+        while len(q):
+            rows, index, parent, depth = q.pop()
+            if max_depth is not None and depth>=max_depth:
+                ig, axis, cut, probs = 0, None, None, self._label_probs(codes[rows], ulabels)
+            else:
+                ig, axis, cut, probs = self._find_best_cut(binned[rows], codes[rows],
+                                                           quantiles, ulabels)
+            dtree.add_node(index=index, parent=parent, axis=axis,
+                    branch=edges[axis][cut:cut+1] if ig>0 else (), probabilities=probs)
+            if ig>0:
+                left = binned[rows, axis] <= cut
+                for child in (rows[left], rows[~left]):
+                    counter += 1
+                    q.appendleft((child, counter, index, depth+1))
+        dtree.construct()
+        self.dtree = dtree
+        return self.dtree
+
+
+    def _find_best_cut(self, binned, codes, nbins, ulabels):
+        """finds the binary split of binned attributes with the maximum
+        information gain. Label counts per bin for all attributes come from a
+        single np.bincount. Cumulative sums over bins give label counts on
+        either side of every possible cut.
+        @param binned (ndarray): 2D uint8 array [projections x attributes] of bins.
+        @param codes (ndarray): 1D int array, index of label of each projection
+                            in ulabels.
+        @param nbins (int): maximum number of bins of any attribute.
+        @param ulabels (ndarray): 1D array of all unique labels.
+        Returns a tuple of:    (maximum info gain,
+                                index of attribute that was split or None,
+                                bin after which to split (bins <= cut go left),
+                                an array of tuples (label, probability))
+        """
+        size = len(codes)
+        nlabels = len(ulabels)
+        labels_probs = self._label_probs(codes, ulabels)
+        if size < 2 or len(labels_probs) < 2:   # nothing to split or pure node
+            return 0, None, None, labels_probs
+        nattrs = binned.shape[1]
+        keys = (binned.astype(np.intp) + np.arange(nattrs) * nbins) * nlabels + codes[:, None]
+        hist = np.bincount(keys.ravel(), minlength=nattrs*nbins*nlabels)
+        hist = hist.reshape((nattrs, nbins, nlabels)).astype(float)
+        left = np.cumsum(hist, axis=1)[:, :-1, :]       # counts in bins <= cut
+        right = np.sum(hist, axis=1)[:, None, :] - left
+
+        def weighted_entropy(c):    # size x entropy of label counts c
+            n = np.sum(c, axis=-1)
+            with np.errstate(divide='ignore', invalid='ignore'):
+                p = c / n[..., None]
+                return np.sum(np.where(c > 0, -c * np.log(p), 0), axis=-1)
+
+        p = labels_probs[:,1]
         entropy_parent = np.sum(-p * np.log(p))
-        labels_probs = np.vstack((ulbl, p)).T
-
-        for i, b in enumerate(branches):    # find which attribute's branching -> max info
-            if not len(b):
-                continue        # do not process when no branching -> no info gain
-            filters = self._split(projections, b, i)
-            entropy_children = 0
-            for f in filters:   # for each branch split, compute its contribution to entropy
-                if not np.any(f):
-                    continue    # skip if filter all false
-                filtered_labels = labels[f]
-                filtered_labels_sz = len(filtered_labels)
-                _, ccounts = np.unique(filtered_labels, return_counts=True)
-                cp = ccounts / filtered_labels_sz     # child probability
-                entropy_children += np.sum(-cp * np.log(cp)) * filtered_labels_sz / size_parent
-            ig = entropy_parent - entropy_children    # information gain
-            if ig>mig:
-                mig = ig
-                mig_bi = i
-                mig_f = filters
-
-        return mig, mig_bi, mig_f, labels_probs
-
-
-    def _split(self, projections, branch, index):
-        """returns boolean arrays that act as filters on projections and labels
-        to split them according to breakpoints in branch.
-        @param projections (ndarray): 2D ndarray, each row is a coordinate.
-        @param branch (list/array): a list of n values to split into n+1 branches.
-        @param index (int): index of attribute in coordinate the branch applies to.
-        Returns a list of boolean arrays, each array filtering in indices belonging
-        to its branch.
-        """
-        if len(branch):
-            cond = []
-            for b in branch:
-                cond.append(projections[:,index]<=b)
-            cond.append(projections[:,index]>branch[-1])
+        ig = entropy_parent - (weighted_entropy(left) + weighted_entropy(right)) / size
+        empty = (np.sum(left, axis=-1)==0) | (np.sum(right, axis=-1)==0)
+        ig[empty] = -np.inf                 # cut must leave projections on both sides
+        best = np.argmax(ig.ravel() > np.max(ig) - 1e-12)   # first of (near) ties
+        axis, cut = divmod(best, nbins-1)
+        if not ig[axis, cut] > 1e-12:
+            return 0, None, None, labels_probs
+        return ig[axis, cut], axis, cut, labels_probs
+
+
+    def cross_validate(self, projections, labels=None, method='logistic_regression',
+                       params=({},), folds=5, repeats=1, nprocs=None, seed=None):
+        """k-fold cross-validation of one or more configurations of a learning
+        method. Projections are split into folds at random. Each configuration
+        is trained on all folds but one and scored on the held out fold, for
+        every fold. Folds run in parallel processes that share projections
+        and labels through shared memory. Stored results (self.lrc etc.) are
+        not changed.
+        @param projections (ndarray): 2D numpy array of coordinates. If 1D, each
+                                    element is a separate coordinate.
+        @param labels (ndarray): 1D numpy array of labels (or predictions for
+                                    linear regression) for each projection. Not
+                                    needed for k_means_cluster.
+        @param method (str): one of 'linear_regression', 'logistic_regression',
+                                    'decision_tree', 'k_means_cluster'.
+        @param params (list): a list of dicts of keyword arguments to method, one
+                                    per configuration. E.g. [{'nclusters': 2},
+                                    {'nclusters': 3}] for k_means_cluster.
+        @param folds (int): number of folds (>= 2).
+        @param repeats (int): number of times to repeat with different folds.
+        @param nprocs (int): OPTIONAL. Number of worker processes. Defaults to
+                                    number of CPUs. If 1, runs in this process.
+                                    Processes are spawned, so the class of
+                                    self must be importable from its module.
+        @param seed (int): OPTIONAL. Seed for splitting folds. Same seed gives
+                                    same scores, for any nprocs.
+        Returns a 2D numpy array of scores [configurations x (repeats * folds)].
+        Higher is better. Scores are R^2 for linear_regression, accuracy for
+        logistic_regression and decision_tree, and negative mean squared
+        distance to closest center for k_means_cluster.
+        """
+        # PREPROCESSING
+        projections = np.asarray(projections, dtype=config.DT_FLOAT)
+        if len(projections.shape)==1:
+            projections = projections.reshape((1,-1)).T
+        if isinstance(params, dict):
+            params = [params]
+        if seed is None:
+            seed = np.random.randint(2**31)
+        # CALCULATIONS
+        return validation.cross_validate(type(self), projections, labels, method,
+                                         list(params), folds, repeats, nprocs, seed)
+
+
+    def select_model(self, projections, labels=None, method='logistic_regression',
+                     params=({},), folds=5, repeats=1, nprocs=None, seed=None):
+        """chooses the configuration of a method with the best mean score in
+        cross_validate(), then trains it on all projections (storing results
+        as the method normally does). Arguments are same as cross_validate().
+        Returns a tuple. First element is the dict of best params. Second is a
+        1D array of mean scores of each configuration. Third is the return
+        value of the method trained with the best params.
+        """
+        if isinstance(params, dict):
+            params = [params]
+        params = list(params)
+        scores = self.cross_validate(projections, labels, method, params, folds,
+                                     repeats, nprocs, seed)
+        mean = np.mean(scores, axis=1)
+        best = params[int(np.argmax(mean))]
+        projections = np.asarray(projections, dtype=config.DT_FLOAT)
+        if len(projections.shape)==1:
+            projections = projections.reshape((1,-1)).T
+        if method=='k_means_cluster':
+            model = self.k_means_cluster(projections, **best)
         else:
-            cond = [np.zeros(len(projections), dtype=bool)]
-        return np.array(cond)
+            model = getattr(self, method)(projections, labels, **best)
+        return best, mean, model
@@ -4,6 +4,7 @@ from __future__ import absolute_import
 from . import Parallel
 import threading
 import time
+import traceback
 
 # The Electronic class is a base class for all automated tasks (see Bot).
 # It can be subclassed with additional authentication functions to act on
@@ -78,6 +79,8 @@ class Electronic(object):
 
     def go(self):
         """begin scheduled task. Derives and runs Parallel instance with 1 thread.
+        If the task raises, its traceback is printed when it happens, and the
+        error is re-raised by stop().
         """
         class Task(Parallel):
             def parallel_process(self, pkg, common):
@@ -88,27 +91,37 @@ class Electronic(object):
                 n = common[4]
                 i=0
                 while not (stop_flag.is_set() or (until>0 and time.time()>=until) or (n>0 and i>=n)):
-                    function(*pkg)
+                    try:
+                        function(*pkg)
+                    except Exception:
+                        traceback.print_exc()   # nobody may wait on the task
+                        raise
                     i+=1
                     time.sleep(interval)
                 stop_flag.clear()   # clear stop flag once loop ends
 
+        # not run on base.POOL: pool threads are daemons, so a task started at
+        # the end of a script would be killed when the main thread exits. The
+        # task also occupies its thread for its whole life, so it would not
+        # reuse one anyway.
         self._task = Task([self._args], nthreads=1)
         self._task.common = [self._func, threading.Event(), self._interval, self._until, self._n]
         self._task.start()
 
 
     def stop(self, force=False):
-        """stop the task after it comes out of sleep for next execution"""
-        self._task.common[1].set()
-        if force:
-            self._task.threads[0].join(timeout=0)
-        else:
-            self._task.threads[0].join()
-
+        """stop the task after it comes out of sleep for next execution. Unless
+        force=True, waits for the task and re-raises an error raised by it.
+        """
+        task = self._task
+        task.common[1].set()
         self._until = -1    # reset all parameters
         self._n = -1
         self._args = []
         self._interval = 0
         self._func = None
         self._task = None
+        if force:
+            task.threads[0].join(timeout=0)
+        else:
+            task.wait_for_threads()
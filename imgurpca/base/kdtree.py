@@ -0,0 +1,120 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import numpy as np
+from . import config
+
+# The class KDTree is a spatial index over a fixed set of points (e.g. cluster
+# centers) for nearest neighbour queries. Points are recursively split at the
+# median of their widest dimension into leaves of at most leaf_size points. Each
+# leaf stores the bounding box of its points. Queries are answered in bulk: every
+# query is first compared with the points in its closest leaf, then only with
+# leaves whose bounding box is closer than the best distance found so far. All
+# comparisons are vectorized over the queries that share a leaf.
+
+class KDTree(object):
+
+    def __init__(self, points, leaf_size=64):
+        """
+        @param points (ndarray): 2D array of points. Rows -> points, columns ->
+                                coordinates.
+        @param leaf_size (int): maximum number of points in a leaf.
+        """
+        self.points = np.array(points, dtype=config.DT_FLOAT)
+        if self.points.ndim==1:
+            self.points = self.points.reshape((-1, 1))
+        self.leaf_size = max(1, int(leaf_size))
+        self.leaves = []            # list of 1D int arrays of point indices
+        self._sqnorms = np.einsum('ij,ij->i', self.points, self.points)
+        self._build(np.arange(len(self.points)))
+        if len(self.leaves):
+            self.lo = np.vstack([np.min(self.points[l], axis=0) for l in self.leaves])
+            self.hi = np.vstack([np.max(self.points[l], axis=0) for l in self.leaves])
+        else:
+            self.lo = self.hi = np.zeros((0, self.points.shape[1]), dtype=self.points.dtype)
+
+    def __len__(self):
+        return len(self.points)
+
+
+    def _build(self, indices):
+        """splits indices into leaves, depth first.
+        """
+        stack = [indices]
+        while stack:
+            idx = stack.pop()
+            if len(idx) <= self.leaf_size:
+                if len(idx):
+                    self.leaves.append(np.sort(idx))
+                continue
+            pts = self.points[idx]
+            dim = np.argmax(np.ptp(pts, axis=0))        # widest dimension
+            if np.ptp(pts[:, dim])==0:                  # all points identical
+                self.leaves.append(np.sort(idx))
+                continue
+            order = np.argsort(pts[:, dim], kind='mergesort')
+            half = len(idx) // 2
+            stack.append(idx[order[half:]])
+            stack.append(idx[order[:half]])
+
+
+    def query(self, queries, chunk=2**14):
+        """finds the nearest point to each query. Ties go to the point with the
+        lowest index, as with np.argmin over all distances.
+        @param queries (ndarray): 2D array of coordinates with as many columns
+                                as points.
+        @param chunk (int): number of queries to process at a time. Memory is
+                            O(chunk x number of leaves).
+        Returns a tuple (indices, distances). Indices is a 1D int array of the
+        nearest point for each query. Distances are squared cartesian distances.
+        """
+        queries = np.asarray(queries, dtype=self.points.dtype)
+        if queries.ndim==1:
+            queries = queries.reshape((-1, self.points.shape[1]))
+        nearest = np.zeros(len(queries), dtype=np.intp)
+        best = np.zeros(len(queries), dtype=self.points.dtype)
+        if not len(self.points):
+            raise ValueError('Tree has no points.')
+        for i in range(0, len(queries), chunk):
+            nearest[i:i+chunk], best[i:i+chunk] = self._query(queries[i:i+chunk])
+        return nearest, best
+
+
+    def _query(self, queries):
+        """nearest point for a chunk of queries. See query().
+        """
+        n = len(queries)
+        # squared distance from each query to each leaf's bounding box
+        boxdist = np.zeros((n, len(self.leaves)), dtype=queries.dtype)
+        for k in range(queries.shape[1]):
+            x = queries[:, k, None]
+            gap = np.subtract(self.lo[:, k], x)
+            np.maximum(gap, x - self.hi[:, k], out=gap)
+            np.maximum(gap, 0, out=gap)
+            gap *= gap
+            boxdist += gap
+        first = np.argmin(boxdist, axis=1)
+        qsq = np.einsum('ij,ij->i', queries, queries)
+        psq = self._sqnorms
+        best = np.full(n, np.inf, dtype=queries.dtype)
+        nearest = np.full(n, len(self.points), dtype=np.intp)
+        for visit in (True, False):     # closest leaf first, then pruned others
+            for j, leaf in enumerate(self.leaves):
+                if visit:
+                    mine = np.flatnonzero(first==j)
+                else:
+                    mine = np.flatnonzero((boxdist[:, j] <= best) & (first!=j))
+                if not len(mine):
+                    continue
+                q, pts = queries[mine], self.points[leaf]
+                dist = np.dot(q, pts.T)     # |q - p|^2 = |q|^2 - 2q.p + |p|^2
+                dist *= -2
+                dist += qsq[mine, None]
+                dist += psq[leaf]
+                k = np.argmin(dist, axis=1)
+                d = dist[np.arange(len(mine)), k]
+                better = (d < best[mine]) | ((d==best[mine]) & (leaf[k] < nearest[mine]))
+                best[mine[better]] = d[better]
+                nearest[mine[better]] = leaf[k[better]]
+        return nearest, best
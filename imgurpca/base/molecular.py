@@ -3,6 +3,9 @@ from __future__ import absolute_import
 from . import utils
 from . import config
 from . import Parallel
+from . import POOL
+from . import CSRMatrix
+from . import VOCABULARY
 import numpy as np
 
 # The Molecular class (as in: a collection of atoms) is a container class for
@@ -12,20 +15,58 @@ import numpy as np
 
 class Molecular(object):
 
+    vocabulary = VOCABULARY             # shared word <-> id mapping
+    pool = POOL                         # base.WorkerPool whose threads run downloads.
+                                        # None spawns new threads per download()
+
     class Downloader(Parallel):
         def parallel_process(self, pkg, common):
             pkg.download()
 
+    class WordCounter(Parallel):
+        def parallel_process(self, pkg, common):
+            pkg.generate_word_counts(*common[0], **common[1])
+            # words, not ids, since ids are only valid in this process
+            return '\n'.join(pkg.words), pkg.weights
+
 
     def __init__(self, **kwargs):
         self.items = []                 # a list of Atomic subclassed objects
         self.nthreads = 1
-        self.wordcount = None
+        self.counts = None              # np array of dtype=config.DT_ID_WEIGHT
+        self.matrix = None              # CSRMatrix of item weights if consolidated
+                                        # with sparse=True, else None
         self._consolidated = False      # flag to signal if all wordcounts sorted
+        self._nconsolidated = 0         # number of items in self.items consolidated
+        self._filter = (None, False)    # (word ids, reverse) used by consolidate()
+        self._padded = True             # False if items need padding after add_items()
         for attr in kwargs:
             setattr(self, attr, kwargs[attr])
 
 
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state.pop('pool', None)         # threads cannot be pickled. base.POOL
+                                        # is used after unpickling
+        # ids are only valid in this process's vocabulary, so words are pickled
+        # and interned again when unpickled.
+        if state.get('counts') is not None:
+            state['counts'] = self.vocabulary.decode(state['counts'])
+        ids, reverse = state.get('_filter', (None, False))
+        if ids is not None:
+            state['_filter'] = (self.vocabulary[ids], reverse)
+        return state
+
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if self.counts is not None:
+            self.counts = self.vocabulary.encode(self.counts)
+        words, reverse = self._filter
+        if words is not None:
+            self._filter = (self.vocabulary.intern(words), reverse)
+
+
     def content(self, flatten=True, accessor=lambda x:x):
         """returns a generator containing list[s] of content objects for all items.
         [[post1.content], [post2.content]...[postn.content]]
@@ -39,68 +80,311 @@ class Molecular(object):
                 for c in item.content:
                     yield c
 
+    @property
+    def wordcount(self):
+        """np array of dtype=config.DT_WORD_WEIGHT decoded from self.counts.
+        A new array on every access, so changes to it are not stored. Assign it
+        back, or change self.counts instead.
+        """
+        if self.counts is None:
+            return None
+        return self.vocabulary.decode(self.counts)
+
+    @wordcount.setter
+    def wordcount(self, wordcount):
+        self.counts = None if wordcount is None else self.vocabulary.encode(wordcount)
+
+    @property
+    def ids(self):
+        return self.counts['id']
+
     @property
     def words(self):
-        return self.wordcount['word']
+        return self.vocabulary[self.counts['id']]
 
     @property
     def weights(self):
-        return self.wordcount['weight']
+        return self.counts['weight']
 
 
     def download(self):
         """downloads whatever items (User/Post objects) are placed in self.items
+        on self.nthreads workers of self.pool.
         """
-        D = self.__class__.Downloader(self.items, nthreads=self.nthreads)
+        D = self.__class__.Downloader(self.items, nthreads=self.nthreads, pool=self.pool)
         D.start()
         D.wait_for_threads()
 
 
+    def iter_download(self, ordered=False):
+        """downloads items like download(), yielding each item as soon as it is
+        downloaded, so it can be processed (e.g. generate_word_counts()) while
+        other downloads are running.
+        @param ordered (bool): True -> yield items in the order of self.items.
+        """
+        D = self.__class__.Downloader(self.items, nthreads=self.nthreads, pool=self.pool)
+        for item, _ in D.iter_results(ordered):
+            yield item
+
+
+    def generate_word_counts(self, *args, nprocs=1, **kwargs):
+        """generates wordcounts of all items in self.items, tokenizing across
+        nprocs processes. Each process returns only the words and weights of an
+        item, which are interned in this process.
+        @param nprocs (int): number of processes. If 1, runs in this process.
+        *args and **kwargs are passed to generate_word_counts() of each item.
+        For nprocs > 1, items (including their word_weight functions) must be
+        picklable, e.g. word_weight defined at module level, not a lambda.
+        """
+        if nprocs <= 1:
+            for item in self.items:
+                item.generate_word_counts(*args, **kwargs)
+            return
+        W = self.__class__.WordCounter(self.items, common=(args, kwargs),
+                                       nthreads=nprocs, backend='processes')
+        for item, (words, weights) in W.iter_results():
+            counts = np.zeros(len(weights), dtype=config.DT_ID_WEIGHT)
+            if len(weights):
+                counts['id'] = self.vocabulary.intern(words.split('\n'))
+                counts['weight'] = weights
+            item.counts = counts
+
+
     def get(self, query,):
         """instantiates items to self.items. Items should be subclasses of Atomic.
         """
         pass
 
 
-    def consolidate(self, words=None, reverse=False):
+    def add_items(self, items):
+        """append items to self.items. If already consolidated, only the new items'
+        words are merged into self.wordcount (see consolidate(incremental=True)).
+        @param items (list): a list of Atomic subclassed objects w/ wordcounts.
+        """
+        self.items = list(self.items) + list(items)
+        if self._consolidated:
+            self.consolidate(incremental=True)
+
+
+    def consolidate(self, words=None, reverse=False, sparse=False, incremental=False):
         """Generate a cumulative wordcount from the items' wordcounts. Add 0-weight
         words to items' wordlists so all items have the same set of words. Sort
-        cumulative wordlist and item wordlists (by word) so index positions are
-        identical.
+        cumulative wordlist and item wordlists (in config.DEFAULT_SORT_ORDER) so
+        index positions are identical.
         @param words (list/array): OPTIONAL - a list of words to keep and consolidate.
                                 Otherwise, generates list of unique words from
                                 all wordcounts in self.items
         @param reverse (bool): True->filter out 'words', use everything else,
                                False->only use 'words', filter out everything else.
                                Only matters if words provided.
+        @param sparse (bool): True->do not pad items' wordcounts. Instead store
+                              all item weights in self.matrix (a CSRMatrix with
+                              rows=items, columns=self.words).
+        @param incremental (bool): True->only consolidate items added to self.items
+                              since the last consolidation. New words are appended
+                              to self.wordcount. Previously consolidated items are
+                              padded lazily. 'words', 'reverse' and 'sparse' from
+                              the last full consolidation are used.
         """
         if len(self.items)==0:
             raise config.PrematureFunctionCall('No User/Post objects in self.items.')
-        word_dict = {}
+        if incremental and self._consolidated:
+            return self._consolidate_new()
+        word_ids = None
         if words is not None:
-            if not reverse:                         # i.e. if only 'words' MUST be in wordcount
-                word_dict = {w:0 for w in words}    # then word_dict initialized w/ 'words'
-            for item in self.items:                 # filter (in/out) words from items
-                item.filter_by_word(words, reverse)
+            if not reverse:                 # i.e. if only 'words' MUST be in wordcount
+                word_ids = np.unique(self.vocabulary.intern(words))
+            else:
+                word_ids = self.vocabulary.lookup(words)
+                word_ids = np.unique(word_ids[word_ids>=0])
+        if word_ids is not None:            # filter (in/out) words from items
+            self.filter_by_id(word_ids, reverse)
+
+        counts, indptr = self._gather()
+        if word_ids is not None and not reverse:
+            ids = word_ids
+        else:
+            ids = np.unique(counts['id'])   # sorted by id
+        columns = np.searchsorted(ids, counts['id'])
+        weights = np.bincount(columns, weights=counts['weight'], minlength=len(ids))
+        order = utils.word_order(ids, weights, self.vocabulary)
+        ids, weights = ids[order], weights[order]
+        columns = np.argsort(order)[columns]
+        matrix = CSRMatrix(counts['weight'], columns, indptr, (len(self.items), len(ids)))
+
+        self.counts = np.zeros(len(ids), dtype=config.DT_ID_WEIGHT)
+        self.counts['id'] = ids
+        self.counts['weight'] = weights
+
+        if sparse:
+            self.matrix = matrix
+        else:                               # pad items w/ 0-weight words
+            for item, row in zip(self.items, matrix.blocks(size=1)):
+                counts = np.zeros(len(ids), dtype=config.DT_ID_WEIGHT)
+                counts['id'] = ids
+                counts['weight'] = row[0]
+                item.counts = counts
+            self.matrix = None
+        self._filter = (word_ids, reverse)
+        self._nconsolidated = len(self.items)
+        self._padded = True
+        self._consolidated = True
+
+
+    def _consolidate_new(self):
+        """consolidates items in self.items[self._nconsolidated:] with the existing
+        self.wordcount. Words not already in self.wordcount are appended to it, so
+        column positions of consolidated items stay valid.
+        """
+        new = self.items[self._nconsolidated:]
+        if not len(new):
+            return
+        word_ids, reverse = self._filter
+        counts, indptr = self._gather(new)
+        if word_ids is not None:
+            mask = np.in1d(counts['id'], word_ids, invert=reverse)
+            counts, indptr = self._scatter(counts[mask], self._mask_indptr(indptr, mask), new)
+
+        ids = self.ids
+        if word_ids is None or reverse:     # strict word list -> no new words
+            fresh = np.setdiff1d(counts['id'], ids)
+            ids = np.concatenate((ids, fresh))
+        columns = utils.positions(ids, counts['id'])
+        matrix = CSRMatrix(counts['weight'], columns, indptr, (len(new), len(ids)))
+
+        counts = np.zeros(len(ids), dtype=config.DT_ID_WEIGHT)
+        counts['id'] = ids
+        counts['weight'][:len(self.counts)] = self.weights
+        counts['weight'] += matrix.sum(axis=0)
+        if self.matrix is not None:
+            self.matrix.append_rows(matrix)
+        else:
+            for item, row in zip(new, matrix.blocks(size=1)):
+                c = np.zeros(len(ids), dtype=config.DT_ID_WEIGHT)
+                c['id'] = ids
+                c['weight'] = row[0]
+                item.counts = c
+            self._padded = self._padded and len(ids)==len(self.counts)
+        self.counts = counts
+        self._nconsolidated = len(self.items)
+
 
+    def _pad_items(self):
+        """extends wordcounts of items consolidated before new words were added
+        by consolidate(incremental=True) with 0-weight entries, so all items have
+        the same words in the same order as self.wordcount.
+        """
+        if self._padded or self.matrix is not None:
+            return
+        n = len(self.counts)
         for item in self.items:
-            if item.wordcount is None:
+            m = len(item.counts)
+            if m < n:
+                pad = np.zeros(n-m, dtype=config.DT_ID_WEIGHT)
+                pad['id'] = self.ids[m:]
+                item.counts = np.concatenate((item.counts, pad))
+        self._padded = True
+
+
+    def _gather(self, items=None):
+        """concatenates the counts of items into one array so corpus-wide
+        operations can be vectorized.
+        @param items (list): OPTIONAL. Atomic objects. Defaults to self.items.
+        Returns a tuple (counts, indptr). Counts for items[i] are in
+        counts[indptr[i]:indptr[i+1]].
+        """
+        items = self.items if items is None else items
+        for item in items:
+            if item.counts is None:
                 raise config.PrematureFunctionCall('Generate wordcounts first.')
-            for w in item.wordcount:
-                try:                    # if word already exists, increment weight
-                    word_dict[w['word']] += w['weight']
-                except KeyError:        # else add word if a strict word list not provided
-                    if words is None or reverse:
-                        word_dict[w['word']] = w['weight']
-        self.wordcount = np.array(list(word_dict.items()), dtype=config.DT_WORD_WEIGHT)
-        self.wordcount.sort(order=[config.DEFAULT_SORT_ORDER])
+        indptr = np.zeros(len(items)+1, dtype=np.intp)
+        np.cumsum([len(item.counts) for item in items], out=indptr[1:])
+        if len(items):
+            counts = np.concatenate([item.counts for item in items])
+        else:
+            counts = np.zeros(0, dtype=config.DT_ID_WEIGHT)
+        return counts, indptr
 
-        for item in self.items:
-            zero_words = np.setdiff1d(self.words, item.words, assume_unique=True)
-            zero_wordcounts = np.array(list(zip(zero_words, np.zeros(len(zero_words)))), dtype=config.DT_WORD_WEIGHT)
-            item.wordcount = np.append(item.wordcount, zero_wordcounts)
-            item.sort()     # using default sort order
-        self._consolidated = True
+
+    def _scatter(self, counts, indptr, items=None):
+        """inverse of _gather(). Assigns slices of counts back to items.
+        Returns the tuple (counts, indptr).
+        """
+        items = self.items if items is None else items
+        for i, item in enumerate(items):
+            item.counts = counts[indptr[i]:indptr[i+1]]
+        return counts, indptr
+
+
+    def _mask_indptr(self, indptr, mask):
+        """returns the indptr of gathered counts after applying a bool mask.
+        """
+        rows = np.repeat(np.arange(len(indptr)-1), np.diff(indptr))
+        kept = np.zeros(len(indptr), dtype=np.intp)
+        np.cumsum(np.bincount(rows[mask], minlength=len(indptr)-1), out=kept[1:])
+        return kept
+
+
+    def filter_by_word(self, words, reverse=False):
+        """filter wordcounts of all items by words in a single vectorized pass.
+        If reverse=False, keep words present in words. If reverse=True, keep
+        words not present in words. Items have to be consolidated again afterwards.
+        @param words (list/array): a list of words in unicode
+        """
+        ids = self.vocabulary.lookup(words)
+        self.filter_by_id(np.unique(ids[ids>=0]), reverse)
+
+
+    def filter_by_id(self, ids, reverse=False):
+        """same as filter_by_word() but with word ids from self.vocabulary.
+        @param ids (array): an array of unique word ids
+        """
+        counts, indptr = self._gather()
+        mask = np.in1d(counts['id'], ids, invert=reverse)
+        self._scatter(counts[mask], self._mask_indptr(indptr, mask))
+        self._consolidated = False
+
+
+    def filter_by_weight(self, minimum, maximum, reverse=False):
+        """filter out words in all items' wordcounts with minumum >= weights >= maximum
+        in a single vectorized pass. reverse=True filters out words with
+        minimum < weights < maximum. Items have to be consolidated again afterwards.
+        """
+        if minimum>maximum:
+            raise ValueError('Minimum is less than maximum.')
+        counts, indptr = self._gather()
+        w = counts['weight']
+        mask = (w>=minimum) & (w<=maximum)
+        if reverse:
+            mask = ~mask
+        self._scatter(counts[mask], self._mask_indptr(indptr, mask))
+        self._consolidated = False
+
+
+    def normalize(self):
+        """normalize weights of each item's wordcount such that they sum to 1,
+        in a single vectorized pass. Items have to be consolidated again afterwards.
+        """
+        counts, indptr = self._gather()
+        rows = np.repeat(np.arange(len(indptr)-1), np.diff(indptr))
+        sums = np.bincount(rows, weights=counts['weight'], minlength=len(indptr)-1)
+        counts['weight'] /= sums[rows]
+        self._scatter(counts, indptr)
+        self._consolidated = False
+
+
+    def sort(self, order=None):
+        """sort each item's wordcount in a single vectorized pass.
+        @param order (str): OPTIONAL. one of 'id', 'word', 'weight'. Defaults to
+                            config.DEFAULT_SORT_ORDER.
+        Items have to be consolidated again afterwards.
+        """
+        order = config.DEFAULT_SORT_ORDER if order is None else order
+        counts, indptr = self._gather()
+        rows = np.repeat(np.arange(len(indptr)-1), np.diff(indptr))
+        key = self.vocabulary[counts['id']] if order=='word' else counts[order]
+        self._scatter(counts[np.lexsort((key, rows))], indptr)
+        self._consolidated = False
 
 
     def get_baseline(self):
@@ -113,7 +397,10 @@ class Molecular(object):
         """
         if not self._consolidated:
             raise config.PrematureFunctionCall('Consolidate first.')
-        matrix = np.zeros((len(self.items), len(self.weights)))
+        if self.matrix is not None:
+            return (self.matrix.mean(axis=0), self.matrix.var(axis=0))
+        self._pad_items()
+        matrix = np.zeros((len(self.items), len(self.weights)), dtype=config.DT_FLOAT)
         for i, item in enumerate(self.items):
             matrix[i,:] = item.weights
         means = np.mean(matrix, axis=0)
@@ -0,0 +1,143 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import numpy as np
+from . import config
+
+# The class NeighbourIndex finds the k nearest points (e.g. projections of posts
+# or users on axes) to a batch of queries. Exact search compares queries with
+# all points, one block of points at a time, keeping a running top k. For
+# approximate search, points are partitioned into lists by their closest
+# coarse center (an inverted file index). A query then only searches the lists
+# of its nprobe closest centers. Points can be added at any time.
+
+class NeighbourIndex(object):
+
+    def __init__(self, points, centers=None):
+        """
+        @param points (ndarray): 2D array of points. Rows -> points, columns ->
+                                coordinates.
+        @param centers (ndarray): OPTIONAL. 2D array of coarse centers (e.g. from
+                                k-means) to partition points for approximate
+                                search. If None, only exact search is possible.
+        """
+        points = np.asarray(points, dtype=config.DT_FLOAT)
+        self._points = np.zeros((max(16, len(points)), points.shape[1]), dtype=points.dtype)
+        self._sqnorms = np.zeros(len(self._points), dtype=points.dtype)
+        self.n = 0                  # number of points in index
+        self.centers = None if centers is None else np.asarray(centers, dtype=points.dtype)
+        self._labels = np.zeros(len(self._points), dtype=np.intp) # center of each point
+        self._lists = None          # (order, indptr): points sorted by center
+        self.add(points)
+
+    def __len__(self):
+        return self.n
+
+    @property
+    def points(self):
+        return self._points[:self.n]
+
+
+    def add(self, points):
+        """adds points to the index. New points get indices len(self) onwards.
+        @param points (ndarray): 2D array of points.
+        """
+        points = np.asarray(points, dtype=self._points.dtype).reshape((-1, self._points.shape[1]))
+        n = self.n + len(points)
+        if n > len(self._points):       # grow storage geometrically
+            size = max(n, 2 * len(self._points))
+            self._points = np.resize(self._points, (size, self._points.shape[1]))
+            self._sqnorms = np.resize(self._sqnorms, size)
+            self._labels = np.resize(self._labels, size)
+        self._points[self.n:n] = points
+        self._sqnorms[self.n:n] = np.einsum('ij,ij->i', points, points)
+        if self.centers is not None and len(points):
+            self._labels[self.n:n] = np.argmin(self._distances(points, self.centers), axis=1)
+            self._lists = None
+        self.n = n
+
+
+    def query(self, queries, k=10, nprobe=None, block=2**20):
+        """finds the k nearest points to each query.
+        @param queries (ndarray): 2D array of coordinates.
+        @param k (int): number of neighbours to find.
+        @param nprobe (int): OPTIONAL. For approximate search, number of closest
+                            coarse centers whose points are searched. If None,
+                            all points are searched (exact).
+        @param block (int): maximum number of distances held in memory at a time.
+        Returns a tuple (indices, distances) of 2D arrays [queries x k], sorted
+        by increasing distance. Distances are squared cartesian distances. If
+        fewer than k points are searched, indices are padded with -1 and
+        distances with np.inf.
+        """
+        queries = np.asarray(queries, dtype=self._points.dtype).reshape((-1, self._points.shape[1]))
+        best_d = np.full((len(queries), k), np.inf)
+        best_i = np.full((len(queries), k), -1, dtype=np.intp)
+        if nprobe is None or self.centers is None:
+            size = max(1, block // max(1, len(queries)))    # points per block
+            for start in range(0, self.n, size):
+                idx = np.arange(start, min(start+size, self.n))
+                self._merge(best_d, best_i, np.arange(len(queries)), queries, idx, k)
+        else:
+            order, indptr = self._inverted_lists()
+            nprobe = min(nprobe, len(self.centers))
+            cdist = self._distances(queries, self.centers)
+            probes = np.argpartition(cdist, nprobe-1, axis=1)[:, :nprobe]
+            for j in range(len(self.centers)):      # queries grouped by list
+                qs = np.flatnonzero(np.any(probes==j, axis=1))
+                idx = order[indptr[j]:indptr[j+1]]
+                if len(qs) and len(idx):
+                    self._merge(best_d, best_i, qs, queries[qs], idx, k)
+        return best_i, best_d
+
+
+    def _merge(self, best_d, best_i, qs, queries, idx, k):
+        """merges distances from queries (rows qs of best_d) to points idx into
+        the sorted top k in best_d, best_i. Only distances smaller than the
+        current k-th best of their query are considered.
+        """
+        dist = self._distances(queries, self._points[idx], self._sqnorms[idx])
+        r, c = np.nonzero(dist < best_d[qs, -1][:, None])   # candidates, by row
+        if not len(r):
+            return
+        rows, r = np.unique(r, return_inverse=True)
+        counts = np.bincount(r)
+        pos = np.arange(len(r)) - np.repeat(np.cumsum(counts) - counts, counts)
+        qs = qs[rows]
+        d = np.full((len(rows), k + np.max(counts)), np.inf)
+        i = np.full(d.shape, -1, dtype=np.intp)
+        d[:, :k], i[:, :k] = best_d[qs], best_i[qs]
+        d[r, k+pos] = dist[rows[r], c]
+        i[r, k+pos] = idx[c]
+        top = np.argpartition(d, k-1, axis=1)[:, :k]
+        d, i = np.take_along_axis(d, top, 1), np.take_along_axis(i, top, 1)
+        order = np.argsort(d, axis=1, kind='mergesort')
+        best_d[qs] = np.take_along_axis(d, order, 1)
+        best_i[qs] = np.take_along_axis(i, order, 1)
+
+
+    def _inverted_lists(self):
+        """Returns a tuple (order, indptr). Indices of points in list j are
+        order[indptr[j]:indptr[j+1]].
+        """
+        if self._lists is None:
+            labels = self._labels[:self.n]
+            order = np.argsort(labels, kind='mergesort')
+            indptr = np.zeros(len(self.centers)+1, dtype=np.intp)
+            np.cumsum(np.bincount(labels, minlength=len(self.centers)), out=indptr[1:])
+            self._lists = (order, indptr)
+        return self._lists
+
+
+    def _distances(self, queries, points, sqnorms=None):
+        """squared cartesian distances [len(queries) x len(points)] computed as
+        |q|^2 - 2q.p + |p|^2.
+        """
+        if sqnorms is None:
+            sqnorms = np.einsum('ij,ij->i', points, points)
+        dist = np.dot(queries, points.T)
+        dist *= -2
+        dist += np.einsum('ij,ij->i', queries, queries)[:, None]
+        dist += sqnorms
+        return np.maximum(dist, 0, out=dist)
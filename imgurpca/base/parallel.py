@@ -1,4 +1,6 @@
 import threading
+import multiprocessing
+from . import config
 try:
     from Queue import Queue, Empty
 except ImportError:
@@ -6,27 +8,216 @@ except ImportError:
 
 # The Parallel class provides a framework for running multiple tasks in separate
 # threads. Usefule for network IO operations or automated side-tasks.
+# The WorkerPool class keeps a set of long-lived threads that run submitted
+# functions. A Parallel instance given a pool runs its workers on the pool's
+# threads instead of spawning new ones, so repeated short bursts of work (e.g.
+# downloads by a running bot) reuse the same threads. POOL is a shared instance.
+# Parallel workers block until all packages are processed, so they are submitted
+# with submit_blocking(), which always gives them a thread (spawning past the
+# pool size if needed). nthreads workers then always run, and a Parallel started
+# from within another Parallel on the same pool cannot starve it.
+# With backend='processes', packages are instead sent to a pool of worker
+# processes for CPU-bound work. Each process calls parallel_process() on a bare
+# instance of the Parallel subclass (only self.common is set), so the subclass,
+# packages, common arguments and return values must be picklable. Processes are
+# spawned, not forked, since forking while other threads (pool workers, the
+# feeder) hold locks can deadlock the child. So the subclass must be importable
+# from its module, and the float precision (config.DT_FLOAT) is passed along.
+# Each package is numbered in input order. Results are queued with their number
+# and package as they complete, followed by one _DONE marker per worker, so
+# iter_results() can stream them (optionally in input order) while workers run.
+# Packages are read lazily: a feeder thread moves them from the pkgs iterable
+# into a queue of 2 x nthreads slots, blocking while it is full. So a generator
+# of packages is never materialized; only a few packages per worker are held.
+
+class Job(object):
+    """handle to a function submitted to a WorkerPool.
+    """
+
+    def __init__(self, func, args, kwargs, callback=None):
+        self.func = func
+        self.args = args
+        self.kwargs = kwargs
+        self.callback = callback        # called when finished, before waiters wake
+        self._done = threading.Event()
+        self._result = None
+        self._error = None
+
+    def run(self):
+        try:
+            self._result = self.func(*self.args, **self.kwargs)
+        except BaseException as e:
+            self._error = e
+        finally:
+            if self.callback is not None:
+                self.callback()
+            self._done.set()
+
+    def done(self):
+        return self._done.is_set()
+
+    def wait(self, timeout=None):
+        """blocks until the job is finished or timeout (s) expires.
+        Returns whether the job is finished.
+        """
+        return self._done.wait(timeout)
+
+    def result(self, timeout=None):
+        """waits for the job and returns its return value. Raises any exception
+        raised by the function.
+        """
+        if not self.wait(timeout):
+            raise RuntimeError('Job not finished.')
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+
+
+class WorkerPool(object):
+
+    def __init__(self, size=16):
+        """
+        @param size (int): maximum number of threads for submit(). Threads are
+                           spawned when jobs are submitted and no thread is
+                           idle, and live until shutdown(). submit_blocking()
+                           may spawn more.
+        """
+        self.size = max(1, int(size))
+        self.threads = []               # list of worker threads
+        self.jobs = Queue()             # queue of Job instances, None -> exit
+        self.lock = threading.Lock()
+        self._pending = 0               # number of submitted jobs not finished
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.shutdown()
+
+
+    def submit(self, func, *args, **kwargs):
+        """runs func(*args, **kwargs) on a pool thread.
+        Returns a Job instance.
+        """
+        return self._submit(func, args, kwargs, self.size)
+
+
+    def submit_blocking(self, func, *args, **kwargs):
+        """runs func(*args, **kwargs) on a pool thread, for functions that may
+        wait on other jobs (e.g. Parallel workers). A thread is spawned past the
+        pool size if none is free, so the job never waits for a thread.
+        Returns a Job instance.
+        """
+        return self._submit(func, args, kwargs, None)
+
+
+    def _submit(self, func, args, kwargs, size):
+        """queues a Job. Spawns a thread if there are more pending jobs than
+        threads, and fewer than size threads (no limit if size is None).
+        """
+        job = Job(func, args, kwargs, self._finished)
+        with self.lock:
+            self._pending += 1
+            if self._pending > len(self.threads) and \
+                    (size is None or len(self.threads) < size):
+                t = threading.Thread(target=self._work, args=(self.jobs,))
+                t.daemon = True         # idle workers do not block exit
+                self.threads.append(t)
+                t.start()
+            self.jobs.put(job)
+        return job
+
+
+    def _work(self, jobs):
+        """thread loop: runs jobs from the queue it was started with until None.
+        """
+        while True:
+            job = jobs.get()
+            if job is None:
+                break
+            job.run()
+
+
+    def _finished(self):
+        with self.lock:
+            self._pending -= 1
+
+
+    def shutdown(self, wait=True):
+        """stops all threads once submitted jobs are finished. The pool can be
+        used again afterwards; new threads are spawned as needed.
+        @param wait (bool): whether to block until threads have exited.
+        """
+        with self.lock:
+            threads, self.threads = self.threads, []
+            for _ in threads:           # exit after pending jobs
+                self.jobs.put(None)
+            self.jobs = Queue()         # new jobs go to new threads
+        if wait:
+            for t in threads:
+                t.join()
+
+
+POOL = WorkerPool()                     # shared pool. Threads spawn on first use
+
+_DONE = object()                        # marks the end of input in Parallel.queue,
+                                        # the exit of a worker in Parallel.results
+
+
+_PROCESS = {}       # per worker process: instance of Parallel subclass
+
+
+def _init_process(cls, common, precision):
+    """process pool initializer. Sets the parent's float precision and creates
+    a bare instance of the Parallel subclass without calling __init__.
+    """
+    config.set_precision(precision)
+    instance = cls.__new__(cls)
+    instance.common = common
+    instance.lock = threading.Lock()
+    _PROCESS['instance'] = instance
+
+
+def _run_process(task):
+    i, pkg = task
+    instance = _PROCESS['instance']
+    return i, instance.parallel_process(pkg, instance.common)
+
+
 
 class Parallel:
 
-    def __init__(self, pkgs, common=None, nthreads=1):
+    def __init__(self, pkgs, common=None, nthreads=1, pool=None, backend='threads'):
         """
-        @param pkgs (iterable): a list of objects passed one at a time to parallel_process
+        @param pkgs (iterable): objects passed one at a time to parallel_process.
+                                Read lazily once start() is called.
         @param common (anything): common arguments passed to every process (optional)
         @param nthreads (int): number of threads to run (preferably < len(pkgs))
+        @param pool (WorkerPool): OPTIONAL. Pool whose threads run the workers.
+                                  If None, nthreads new threads are spawned.
+        @param backend (str): 'threads' -> run parallel_process in threads (for IO),
+                              'processes' -> run parallel_process in nthreads
+                              worker processes (for CPU-bound work).
         """
-        self.nthreads = nthreads        # total number of spawned threads
-        self.threads = []               # list of thread objects
-        self.queue = Queue()            # queue containing args for individual thread
-        self.results = Queue()          # queue containing return vals of parallel_process
+        if backend not in ('threads', 'processes'):
+            raise ValueError('Backend must be threads or processes.')
+        self.nthreads = nthreads        # total number of spawned threads/processes
+        self.pool = pool                # WorkerPool or None
+        self.backend = backend
+        self.error = None               # exception raised by the process pool
+        self.threads = []               # list of thread objects or pool Jobs
+        self.queue = Queue(2*max(1, nthreads)) # bounded queue of (number, pkg) or _DONE
+        self.pkgs = pkgs                # iterable of pkgs, consumed by feeder()
+        self.feeder_thread = None       # thread running feeder()
+        self.results = Queue()          # queue of (number, pkg, return val) or _DONE
         self.common = common            # common arguments for all threads
         self.lock = threading.Lock()    # in case there is resource sharing
         self.callback = None            # callback function
         self.cargs = []                 # arguments for callback func
         self.ckwargs = {}               # keyword args for callback func
         self.cthread = None             # callback thread
-        for pkg in pkgs:
-            self.queue.put(pkg)
+        self.nworkers = 0               # number of workers that put _DONE when finished
 
 
     def parallel_process(self, pkg, common):
@@ -35,25 +226,61 @@ class Parallel:
         pass
 
 
+    def feeder(self):
+        """puts numbered pkgs into the bounded queue, blocking while it is full,
+        then one _DONE per worker. Stops early once a worker has failed.
+        """
+        try:
+            for task in enumerate(self.pkgs):
+                if self.error is not None:
+                    break
+                self.queue.put(task)
+        except Exception as e:          # raised by the pkgs iterable
+            self.error = e
+        finally:
+            for _ in range(self.nworkers):
+                self.queue.put(_DONE)
+
+
     def worker(self):
-        """wrapper for parallel_process. Keeps calling until the pkg queue is
-        empty.
+        """wrapper for parallel_process. Keeps calling until the end of pkgs.
+        After an error, remaining pkgs are skipped.
         """
         while True:
-            try:
-                pkg = self.queue.get_nowait()
-            except Empty:
-                break
-            self.results.put(self.parallel_process(pkg, self.common))
+            task = self.queue.get()
             self.queue.task_done()
-        return
+            if task is _DONE:
+                break
+            if self.error is not None:
+                continue
+            i, pkg = task
+            try:
+                self.results.put((i, pkg, self.parallel_process(pkg, self.common)))
+            except Exception as e:      # re-raised by wait_for_threads()
+                self.error = e
+        self.results.put(_DONE)
 
 
     def start(self):
-        """adds threads to self.threads and starts them.
+        """adds threads (or jobs on self.pool) to self.threads and starts them.
+        For the processes backend, a single thread feeds packages to the
+        process pool and collects results.
         """
         self.threads = []
-        for i in range(self.nthreads):
+        self.nworkers = self.nthreads if self.backend=='threads' else 1
+        if self.nworkers > 0:
+            self.feeder_thread = threading.Thread(target=self.feeder)
+            self.feeder_thread.daemon = True
+            self.feeder_thread.start()
+        if self.backend=='processes':
+            t = threading.Thread(target=self.process_worker)
+            t.daemon = False
+            t.start()
+            self.threads.append(t)
+        for i in range(self.nthreads if self.backend=='threads' else 0):
+            if self.pool is not None:
+                self.threads.append(self.pool.submit_blocking(self.worker))
+                continue
             t = threading.Thread(target=self.worker)
             t.daemon = False
             t.start()
@@ -62,9 +289,73 @@ class Parallel:
             self.cthread.start()
 
 
+    def process_worker(self):
+        """sends packages from the queue to a pool of self.nthreads processes
+        and puts their results in self.results. At most 2 chunks per process
+        are in flight, since the process pool reads its input eagerly.
+        """
+        try:
+            size = len(self.pkgs)
+        except TypeError:               # e.g. a generator
+            size = 0
+        chunksize = max(1, min(64, size // (4 * self.nthreads)))
+        slots = threading.Semaphore(2 * self.nthreads * chunksize)
+        sent = {}                       # number -> pkg in flight, to pair with results
+        tasks = self._process_tasks(slots, sent)
+        procs = None
+        try:
+            procs = multiprocessing.get_context('spawn').Pool(self.nthreads,
+                        _init_process, (type(self), self.common, config.DT_FLOAT))
+            for i, r in procs.imap_unordered(_run_process, tasks, chunksize):
+                self.results.put((i, sent.pop(i), r))
+                slots.release()
+        except Exception as e:          # re-raised by wait_for_threads()
+            self.error = e
+            slots.release()             # unblock _process_tasks to let it stop
+            if procs is None:           # pool not started, drain queue here
+                for _ in tasks:
+                    pass
+        finally:
+            if procs is not None:
+                procs.close()
+                procs.join()
+            self.results.put(_DONE)
+
+
+    def _process_tasks(self, slots, sent):
+        """generator of (number, pkg) from the queue for the process pool.
+        Blocks while all slots are in flight. After an error, drains the queue.
+        """
+        while True:
+            slots.acquire()
+            task = self.queue.get()
+            self.queue.task_done()
+            if task is _DONE:
+                return
+            if self.error is not None:
+                while self.queue.get() is not _DONE:
+                    self.queue.task_done()
+                self.queue.task_done()
+                return
+            sent[task[0]] = task[1]
+            yield task
+
+
     def wait_for_threads(self):
+        """blocks until all workers, and the callback if one is running, have
+        finished. Re-raises an error raised by parallel_process in a worker.
+        """
         for t in self.threads:
-            t.join()
+            if isinstance(t, Job):
+                t.result()              # re-raises errors in pool jobs
+            else:
+                t.join()
+        cthread = self.cthread
+        if cthread is not None and cthread is not threading.current_thread() \
+                and cthread.is_alive():
+            cthread.join()
+        if self.error is not None:
+            raise self.error
 
 
     def still_running(self):
@@ -72,7 +363,8 @@ class Parallel:
         Returns a boolean.
         """
         if len(self.threads):
-            status = all([t.isAlive() for t in self.threads])
+            status = all([not t.done() if isinstance(t, Job) else t.is_alive()
+                          for t in self.threads])
         else:
             status = False
         return status
@@ -98,9 +390,9 @@ class Parallel:
 
 
     def get_results(self):
-        """converts results in the queue to a list. Quits as soon as the queue is
-        empty. So should be called after wait_for_threads() to ensure all threads
-        have finished.
+        """converts results in the queue to a list, in the order of their pkgs.
+        Quits as soon as the queue is empty. So should be called after
+        wait_for_threads() to ensure all threads have finished.
         """
         results = []
         while True:
@@ -108,5 +400,39 @@ class Parallel:
                 r = self.results.get_nowait()
             except Empty:
                 break
-            results.append(r)
-        return results
+            if r is not _DONE:
+                results.append(r)
+        results.sort(key=lambda r: r[0])
+        return [r[2] for r in results]
+
+
+    def iter_results(self, ordered=False):
+        """generator of (pkg, return value) tuples, yielded as each package is
+        processed. Calls start() if it has not been called. Ends when all workers
+        have finished, then re-raises any error in workers (see
+        wait_for_threads()). Consumes self.results, so get_results() returns
+        nothing afterwards.
+        @param ordered (bool): False -> yield in order of completion.
+                               True -> yield in order of pkgs. Results that
+                               complete early are held until their turn.
+        """
+        if not self.threads:
+            self.start()
+        held = {}                       # number -> (pkg, result), for ordered
+        following = 0                   # number of next pkg to yield, for ordered
+        remaining = self.nworkers
+        while remaining:
+            r = self.results.get()
+            if r is _DONE:
+                remaining -= 1
+                continue
+            if not ordered:
+                yield r[1:]
+                continue
+            held[r[0]] = r[1:]
+            while following in held:
+                yield held.pop(following)
+                following += 1
+        for i in sorted(held):          # after an error, pkgs may be missing
+            yield held.pop(i)
+        self.wait_for_threads()
@@ -0,0 +1,172 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import numpy as np
+from . import config
+
+# The CSRMatrix class is a minimal compressed sparse row matrix. Row i has its
+# non-zero values in data[indptr[i]:indptr[i+1]], and their column indices in
+# indices[indptr[i]:indptr[i+1]]. It is used by Molecular.consolidate() to store
+# item weights (rows=items, columns=words) without padding each item's wordcount
+# with zero-weight entries for every word in the corpus.
+
+class CSRMatrix(object):
+
+    def __init__(self, data, indices, indptr, shape):
+        """
+        @param data (ndarray): 1D array of non-zero values.
+        @param indices (ndarray): 1D int array of column indices of values in data.
+        @param indptr (ndarray): 1D int array of length nrows+1. Values for row i
+                                are in data[indptr[i]:indptr[i+1]].
+        @param shape (tuple): (number of rows, number of columns)
+        """
+        self.data = np.asarray(data, dtype=config.DT_FLOAT)
+        self.indices = np.asarray(indices, dtype=np.intp)
+        self.indptr = np.asarray(indptr, dtype=np.intp)
+        self.shape = (int(shape[0]), int(shape[1]))
+        self._csc = None            # cached column ordering used by tdot()
+
+    @property
+    def nnz(self):
+        return len(self.data)
+
+    @property
+    def rows(self):
+        """returns the row index of each element in self.data.
+        """
+        return np.repeat(np.arange(self.shape[0]), np.diff(self.indptr))
+
+
+    @classmethod
+    def from_rows(cls, indices, data, ncols):
+        """construct a matrix from a list of rows.
+        @param indices (list): a list of 1D int arrays of column indices per row.
+        @param data (list): a list of 1D arrays of values per row.
+        @param ncols (int): number of columns in the matrix.
+        Returns a CSRMatrix instance.
+        """
+        lengths = np.array([len(i) for i in indices], dtype=np.intp)
+        indptr = np.zeros(len(lengths)+1, dtype=np.intp)
+        np.cumsum(lengths, out=indptr[1:])
+        if len(lengths) and indptr[-1]:
+            indices = np.concatenate(indices)
+            data = np.concatenate(data)
+        else:
+            indices = np.zeros(0, dtype=np.intp)
+            data = np.zeros(0, dtype=config.DT_FLOAT)
+        return cls(data, indices, indptr, (len(lengths), ncols))
+
+
+    def append_rows(self, other):
+        """appends rows of another matrix in place. If other has more columns,
+        self is widened to the same number of columns.
+        @param other (CSRMatrix): matrix with >= number of columns of self.
+        """
+        if other.shape[1] < self.shape[1]:
+            raise ValueError('Appended matrix has fewer columns.')
+        self.data = np.concatenate((self.data, other.data))
+        self.indices = np.concatenate((self.indices, other.indices))
+        self.indptr = np.concatenate((self.indptr, other.indptr[1:] + self.indptr[-1]))
+        self.shape = (self.shape[0] + other.shape[0], other.shape[1])
+        self._csc = None
+
+
+    def toarray(self):
+        """Returns a dense 2D array of the matrix.
+        """
+        out = np.zeros(self.shape, dtype=self.data.dtype)
+        out[self.rows, self.indices] = self.data
+        return out
+
+
+    def blocks(self, size=1024):
+        """generator of dense row blocks of the matrix. Useful for computations
+        that need dense rows without converting the whole matrix at once.
+        @param size (int): maximum number of rows per block.
+        Yields 2D arrays of shape (<=size, number of columns).
+        """
+        for start in range(0, self.shape[0], size):
+            stop = min(start + size, self.shape[0])
+            lo, hi = self.indptr[start], self.indptr[stop]
+            block = np.zeros((stop-start, self.shape[1]), dtype=self.data.dtype)
+            rows = np.repeat(np.arange(stop-start), np.diff(self.indptr[start:stop+1]))
+            block[rows, self.indices[lo:hi]] = self.data[lo:hi]
+            yield block
+
+
+    def dot(self, other):
+        """matrix product with a dense array.
+        @param other (ndarray): 1D/2D array with len(other)==number of columns.
+        Returns a dense array of shape (number of rows,) or (number of rows, other.shape[1]).
+        """
+        other = np.asarray(other)
+        if other.ndim==1:
+            return np.bincount(self.rows, weights=self.data * other[self.indices],
+                               minlength=self.shape[0]).astype(self.data.dtype, copy=False)
+        return self._segment_sum(self.indptr, self.data, self.indices, other,
+                                 self.shape[0])
+
+
+    def tdot(self, other):
+        """matrix product of the transpose with a dense array, i.e. self.T . other
+        @param other (ndarray): 1D/2D array with len(other)==number of rows.
+        Returns a dense array of shape (number of columns,) or (number of columns, other.shape[1]).
+        """
+        other = np.asarray(other)
+        if other.ndim==1:
+            return np.bincount(self.indices, weights=self.data * other[self.rows],
+                               minlength=self.shape[1]).astype(self.data.dtype, copy=False)
+        if self._csc is None:       # element order sorted by column, cached
+            order = np.argsort(self.indices, kind='mergesort')
+            colptr = np.zeros(self.shape[1]+1, dtype=np.intp)
+            np.cumsum(np.bincount(self.indices, minlength=self.shape[1]), out=colptr[1:])
+            self._csc = (order, colptr, self.rows[order])
+        order, colptr, rows = self._csc
+        return self._segment_sum(colptr, self.data[order], rows, other, self.shape[1])
+
+
+    def _segment_sum(self, ptr, data, index, other, n, chunk=2**22):
+        """out[i] = sum(data[ptr[i]:ptr[i+1]] * other[index[ptr[i]:ptr[i+1]]])
+        Columns of other are processed in chunks so at most 'chunk' products
+        are held in memory at a time.
+        """
+        out = np.zeros((n, other.shape[1]), dtype=np.result_type(data, other))
+        nonempty = np.diff(ptr) > 0
+        if not len(data):
+            return out
+        starts = ptr[:-1][nonempty]
+        step = max(1, chunk // len(data))
+        for j in range(0, other.shape[1], step):
+            prod = data[:, None] * other[index, j:j+step]
+            out[nonempty, j:j+step] = np.add.reduceat(prod, starts, axis=0)
+        return out
+
+
+    def sum(self, axis=0):
+        """sum of elements along an axis.
+        @param axis (int): 0 -> column sums, 1 -> row sums.
+        Returns a 1D array.
+        """
+        if axis==0:
+            res = np.bincount(self.indices, weights=self.data, minlength=self.shape[1])
+        else:
+            res = np.bincount(self.rows, weights=self.data, minlength=self.shape[0])
+        return res.astype(self.data.dtype, copy=False)
+
+
+    def mean(self, axis=0):
+        """mean of elements along an axis, counting implicit zeros.
+        """
+        return self.sum(axis) / self.shape[axis]
+
+
+    def var(self, axis=0):
+        """variance of elements along an axis, counting implicit zeros.
+        """
+        n = self.shape[axis]
+        if axis==0:
+            sq = np.bincount(self.indices, weights=self.data**2, minlength=self.shape[1])
+        else:
+            sq = np.bincount(self.rows, weights=self.data**2, minlength=self.shape[0])
+        mean = self.sum(axis) / n
+        return np.maximum(sq / n - mean**2, 0).astype(self.data.dtype, copy=False)
@@ -8,6 +8,10 @@ import numpy as np
 # index of the coordinate axis to branch on, branching points (for n+1 branches),
 # references to child nodes, and probabilities of each label until that node.
 # A single Node represents a point of branching in the decision tree.
+# Once constructed, the tree is also stored as flat parallel arrays (one entry
+# per node, children of a node are contiguous) so that classify() can route a
+# whole batch of projections through the tree level by level, and so the tree
+# can be saved as plain arrays.
 
 
 class Node(object):
@@ -26,6 +30,14 @@ class DTree:
 
     def __init__(self, *args, **kwargs):
         self._content = []
+        self.axis = None            # int array, axis to branch on, -1 for leaves
+        self.thresholds = None      # float array, branching points of all nodes
+        self.toffsets = None        # int array, node i's branching points are
+                                    # thresholds[toffsets[i]:toffsets[i+1]]
+        self.children = None        # int array, index of first child, -1 for leaves
+        self.nchildren = None       # int array, number of (contiguous) children
+        self.labels = None          # array of all labels
+        self.probabilities = None   # 2D array [nodes x labels] of label probabilities
 
         for attr in kwargs:
             setattr(self, attr, kwargs[attr])
@@ -62,51 +74,104 @@ class DTree:
                 else:
                     break
             i+=1
+        self._compile()
+
+
+    def _compile(self):
+        """stores the linked nodes as flat arrays, numbering nodes breadth first
+        from the root so the children of every node are contiguous.
+        """
+        order = [self.root]
+        first = []                  # position of first child of each node
+        for n in order:             # order grows while iterating -> BFS
+            first.append(len(order) if len(n.children) else -1)
+            order.extend(n.children)
+        probs = [np.asarray(n.probabilities, dtype=float).reshape((-1, 2)) for n in order]
+        self.labels = np.unique(np.concatenate([p[:,0] for p in probs]))
+        self.probabilities = np.zeros((len(order), len(self.labels)))
+        for i, p in enumerate(probs):
+            self.probabilities[i, np.searchsorted(self.labels, p[:,0])] = p[:,1]
+        self.axis = np.array([-1 if n.axis is None else n.axis for n in order], dtype=np.intp)
+        self.children = np.array(first, dtype=np.intp)
+        self.nchildren = np.array([len(n.children) for n in order], dtype=np.intp)
+        branches = [np.asarray(n.branch, dtype=float).ravel() for n in order]
+        self.toffsets = np.zeros(len(order)+1, dtype=np.intp)
+        np.cumsum([len(b) for b in branches], out=self.toffsets[1:])
+        self.thresholds = np.concatenate(branches) if len(order) else np.zeros(0)
+
+
+    def to_arrays(self):
+        """Returns a dict of the arrays representing the tree. Can be saved with
+        np.savez and restored with DTree.from_arrays().
+        """
+        return {'axis': self.axis, 'thresholds': self.thresholds,
+                'toffsets': self.toffsets, 'children': self.children,
+                'nchildren': self.nchildren, 'labels': self.labels,
+                'probabilities': self.probabilities}
+
+
+    @classmethod
+    def from_arrays(cls, arrays):
+        """construct a tree from the result of to_arrays().
+        @param arrays (dict): a mapping of array names to arrays e.g. np.load()
+        Returns a DTree instance that can classify() and print_tree().
+        """
+        return cls(**{k: np.asarray(arrays[k]) for k in ('axis', 'thresholds',
+                    'toffsets', 'children', 'nchildren', 'labels', 'probabilities')})
 
 
     def classify(self, projections):
         """given projections, outputs an array of prorabilities for each label
-        that each projection might belong to.
+        that each projection might belong to. All projections are routed through
+        the tree together, one level at a time.
         @param projections (2D ndarray): a 2D array, where each row is a
                         coordinate.
         Returns a 3D numpy array. The first axis is an array of 2D predictions
         for each projection. Each prediction is a 2D array where each row is
-        of the form [label, probability of being that label].
+        of the form [label, probability of being that label]. Labels with zero
+        probability for all projections are left out.
         """
-        res = []
-        for proj in projections:
-            n = self.root
-            while len(n.children):
-                found = False
-                for i, b in enumerate(n.branch):
-                    if proj[n.axis] <= b:
-                        n = n.children[i]
-                        found = True
-                if not found:
-                    if len(n.branch)+1==len(n.children):
-                        n = n.children[-1]
-                    else:
-                        break
-            res.append(n.probabilities)
-        return np.array(res)
+        projections = np.asarray(projections, dtype=float)
+        # branching points padded with +inf to a [nodes x max branching points] array
+        counts = np.diff(self.toffsets)
+        width = np.max(counts) if len(counts) else 0
+        padded = np.full((len(counts), width), np.inf)
+        padded[np.arange(width) < counts[:, None]] = self.thresholds
+        node = np.zeros(len(projections), dtype=np.intp)
+        active = np.full(len(projections), self.nchildren[0] > 0)
+        while np.any(active):
+            rows = np.flatnonzero(active)
+            n = node[rows]
+            value = projections[rows, self.axis[n]]
+            branch = np.sum(value[:, None] > padded[n], axis=1)   # x<=b[0] -> 0...
+            ok = branch < self.nchildren[n]
+            node[rows[ok]] = self.children[n[ok]] + branch[ok]
+            active[rows] = False
+            active[rows[ok]] = self.nchildren[node[rows[ok]]] > 0
+        probs = self.probabilities[node]
+        keep = np.any(probs > 0, axis=0)
+        res = np.zeros((len(projections), np.sum(keep), 2))
+        res[:, :, 0] = self.labels[keep]
+        res[:, :, 1] = probs[:, keep]
+        return res
 
 
     def print_tree(self):
         """given a constructed decision tree, use depth-first search to print
         conditions and final labels.
         """
-        stack = [(self.root, 0, 0)]     # (node, child no., tabs)
-        ntabs = 0
+        stack = [(0, 0, 0)]     # (node, child no., tabs)
         while len(stack):
             n, i, tabs = stack.pop()
-            if len(n.branch):
-                if i>=1 and i==len(n.children)-1:
-                    print(tabs*'\t' + 'axis-' + str(n.axis) + ': >' + str(n.branch[i-1]))
+            branch = self.thresholds[self.toffsets[n]:self.toffsets[n+1]]
+            if len(branch):
+                if i>=1 and i==self.nchildren[n]-1:
+                    print(tabs*'\t' + 'axis-' + str(self.axis[n]) + ': >' + str(branch[i-1]))
                 else:
-                    print(tabs*'\t' + 'axis-' + str(n.axis) + ': <=' + str(n.branch[i]))
+                    print(tabs*'\t' + 'axis-' + str(self.axis[n]) + ': <=' + str(branch[i]))
                     stack.append((n, i+1, tabs))
-                if i<len(n.children):
-                    stack.append((n.children[i], 0, tabs+1))
+                if i<self.nchildren[n]:
+                    stack.append((self.children[n]+i, 0, tabs+1))
             else:
-                avg = np.dot(n.probabilities[:,0], n.probabilities[:,1])
+                avg = np.dot(self.labels, self.probabilities[n])
                 print(tabs*'\t' + 'Label: ' + str(avg) + '\n')
@@ -1,6 +1,9 @@
 from __future__ import unicode_literals
 from __future__ import absolute_import
 import re
+import struct
+import zipfile
+import numpy as np
 from . import config
 
 def flatten(container, lvl=1, accessor=lambda x: x):
@@ -27,6 +30,21 @@ def sanitize(sentence):
     return words
 
 
+def word_order(ids, weights, vocabulary):
+    """returns the order of words in a consolidated wordcount according to
+    config.DEFAULT_SORT_ORDER.
+    @param ids (array): sorted unique word ids.
+    @param weights (array): total weight of each word.
+    @param vocabulary (Vocabulary): vocabulary the ids are from.
+    Returns an array of indices that sorts ids.
+    """
+    if config.DEFAULT_SORT_ORDER=='word':
+        return np.argsort(vocabulary[ids], kind='mergesort')
+    if config.DEFAULT_SORT_ORDER=='weight':
+        return np.argsort(weights, kind='mergesort')
+    return np.arange(len(ids))
+
+
 def num_lines(fname):
     """returns the number of lines in a file.
     @param fname (str): name of file
@@ -43,3 +61,54 @@ def is_url(path):
             path.startswith('https') or \
             path.startswith('ftp') or \
             path.startswith('ftps')
+
+
+def positions(haystack, needles, order=None):
+    """returns the index of each of needles in haystack. Haystack need not be
+    sorted but must have unique elements.
+    @param haystack (array): 1D array of unique values.
+    @param needles (array): 1D array of values to find.
+    @param order (array): OPTIONAL. np.argsort(haystack), if already computed.
+    Returns an int array the same length as needles, -1 where not found.
+    """
+    pos = np.full(len(needles), -1, dtype=np.intp)
+    if len(haystack):
+        if order is None:
+            order = np.argsort(haystack)
+        idx = np.searchsorted(haystack, needles, sorter=order)
+        idx[idx==len(haystack)] = 0
+        found = haystack[order[idx]]==needles
+        pos[found] = order[idx[found]]
+    return pos
+
+
+def npz_memmap(fname, key):
+    """memory-maps an array stored uncompressed in a .npz file (np.savez) in
+    read-only mode, without reading it into memory.
+    @param fname (str): name of .npz file.
+    @param key (str): name of the array in the file.
+    Returns a np.memmap, or None if the array cannot be mapped (compressed,
+    empty, or object arrays).
+    """
+    with zipfile.ZipFile(fname) as z:
+        info = z.getinfo(key + '.npy')
+    if info.compress_type != zipfile.ZIP_STORED:
+        return None
+    with open(fname, 'rb') as f:
+        f.seek(info.header_offset)
+        header = f.read(30)                 # zip local file header
+        name_len, extra_len = struct.unpack('<HH', header[26:30])
+        f.seek(info.header_offset + 30 + name_len + extra_len)
+        version = np.lib.format.read_magic(f)
+        if version==(1, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_1_0(f)
+        elif version==(2, 0):
+            shape, fortran, dtype = np.lib.format.read_array_header_2_0(f)
+        else:
+            return None
+        offset = f.tell()
+    if dtype.hasobject or not np.prod(shape):
+        return None
+    return np.memmap(fname, dtype=dtype, mode='r', shape=shape,
+                     order='F' if fortran else 'C', offset=offset)
+
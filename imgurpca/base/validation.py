@@ -0,0 +1,133 @@
+from __future__ import print_function
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from __future__ import division
+import multiprocessing
+from multiprocessing.sharedctypes import RawArray
+import numpy as np
+from . import config
+
+# Functions to evaluate learning methods of BaseLearner by k-fold cross-validation.
+# Projections (and labels) are copied once into shared memory. Each task trains
+# one configuration of a method on all but one fold and scores it on that fold.
+# Tasks run in a pool of worker processes which read projections from shared
+# memory instead of receiving a pickled copy per task. Processes are spawned,
+# not forked, since forking while threads (e.g. of base.POOL) hold locks can
+# deadlock the child. So the learner class must be importable from its module,
+# and the float precision (config.DT_FLOAT) is passed along. Folds are
+# reproducible from a seed, so results do not depend on the number of processes.
+# Scores are higher for better models:
+# linear_regression     -> coefficient of determination (R^2) of predictions
+# logistic_regression   -> fraction of labels predicted correctly
+# decision_tree         -> fraction of labels predicted correctly (most probable)
+# k_means_cluster       -> negative mean squared distance to closest center
+
+METHODS = ('linear_regression', 'logistic_regression', 'decision_tree',
+           'k_means_cluster')
+
+_SHARED = {}        # per process: projections, labels and learner class
+
+
+def folds(n, nfolds, seed):
+    """splits n rows into nfolds folds of a random permutation.
+    @param n (int): number of rows.
+    @param nfolds (int): number of folds.
+    @param seed (int/tuple): seed for the random permutation.
+    Returns a list of nfolds 1D int arrays of row indices.
+    """
+    return np.array_split(np.random.RandomState(seed).permutation(n), nfolds)
+
+
+def _share(array):
+    """copies an array into shared memory as config.DT_FLOAT.
+    Returns (RawArray, shape).
+    """
+    array = np.ascontiguousarray(array, dtype=config.DT_FLOAT)
+    buf = RawArray(array.dtype.char, max(1, array.size))
+    np.frombuffer(buf, dtype=array.dtype)[:array.size] = array.ravel()
+    return buf, array.shape
+
+
+def _unshare(buf, shape):
+    """returns an ndarray view of shared memory, no copy.
+    """
+    dtype = np.dtype(buf._type_)
+    return np.frombuffer(buf, dtype=dtype)[:int(np.prod(shape))].reshape(shape)
+
+
+def _init_worker(cls, projections, labels, precision):
+    """pool initializer. Sets the parent's float precision and sets up views of
+    shared projections and labels.
+    @param cls (type): BaseLearner (sub)class used to train models.
+    @param projections (tuple): (RawArray, shape) of projections.
+    @param labels (tuple): (RawArray, shape) of labels, or None.
+    @param precision (dtype): config.DT_FLOAT of the parent process.
+    """
+    config.set_precision(precision)
+    _SHARED['cls'] = cls
+    _SHARED['projections'] = _unshare(*projections)
+    _SHARED['labels'] = None if labels is None else _unshare(*labels)
+
+
+def _score_fold(task):
+    """trains a configuration on all folds but one and scores it on that fold.
+    @param task (tuple): (method, params, nfolds, seed, repeat, fold)
+    Returns a float score.
+    """
+    method, params, nfolds, seed, repeat, fold = task
+    proj, labels = _SHARED['projections'], _SHARED['labels']
+    test = folds(len(proj), nfolds, (seed, repeat))[fold]
+    train = np.ones(len(proj), dtype=bool)
+    train[test] = False
+    learner = _SHARED['cls']()
+    if method=='k_means_cluster':       # reproducible, global random state untouched
+        params = dict({'seed': np.random.RandomState((seed, repeat, fold))}, **params)
+        centers, _ = learner.k_means_cluster(proj[train], **params)
+        return -np.mean(np.min(learner._sq_distances(proj[test], centers), axis=1))
+    model = getattr(learner, method)(proj[train], labels[train], **params)
+    if method=='linear_regression':
+        residual = labels[test] - learner.linear_prediction(proj[test], model)
+        total = np.sum((labels[test] - np.mean(labels[test]))**2)
+        return 1 - np.sum(residual**2) / total if total else 0.
+    if method=='logistic_regression':
+        predicted = learner.logistic_prediction(proj[test], model)
+    else:
+        probs = learner.decision_prediction(proj[test])
+        predicted = probs[np.arange(len(test)), np.argmax(probs[:, :, 1], axis=1), 0]
+    return np.mean(predicted==labels[test])
+
+
+def cross_validate(cls, projections, labels, method, params, nfolds, repeats,
+                   nprocs, seed):
+    """scores each configuration of a method on every fold. See
+    BaseLearner.cross_validate().
+    Returns a 2D array of scores [configurations x (repeats * nfolds)].
+    """
+    if method not in METHODS:
+        raise config.InvalidArgument('Method must be one of ' + ', '.join(METHODS))
+    if method!='k_means_cluster' and labels is None:
+        raise config.InvalidArgument(method + ' needs labels.')
+    if nfolds < 2 or nfolds > len(projections):
+        raise config.InvalidArgument('Number of folds must be in [2, # of projections].')
+    tasks = [(method, p, nfolds, seed, r, f) for p in params
+             for r in range(repeats) for f in range(nfolds)]
+    shared = (_share(projections), None if labels is None else _share(labels),
+              config.DT_FLOAT)
+    if nprocs is None:
+        nprocs = multiprocessing.cpu_count()
+    nprocs = max(1, min(nprocs, len(tasks)))
+    if nprocs==1:
+        _init_worker(cls, *shared)
+        try:
+            scores = [_score_fold(t) for t in tasks]
+        finally:
+            _SHARED.clear()
+    else:
+        pool = multiprocessing.get_context('spawn').Pool(nprocs, _init_worker,
+                                                         (cls,) + shared)
+        try:
+            scores = pool.map(_score_fold, tasks, chunksize=max(1, len(tasks)//(4*nprocs)))
+        finally:
+            pool.close()
+            pool.join()
+    return np.array(scores).reshape((len(params), repeats * nfolds))
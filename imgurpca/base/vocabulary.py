@@ -0,0 +1,110 @@
+from __future__ import unicode_literals
+from __future__ import absolute_import
+from . import config
+import numpy as np
+import threading
+
+# The Vocabulary class interns words into compact integer ids. Wordcounts are
+# stored as arrays of dtype=config.DT_ID_WEIGHT so that filtering, sorting and
+# set operations on them work on integers instead of fixed-length unicode
+# strings. A single shared instance, VOCABULARY, is used by Atomic, Molecular and
+# BaseLearner so ids are comparable across all objects in a process.
+
+class Vocabulary(object):
+
+    def __init__(self, words=()):
+        """
+        @param words (list/array): OPTIONAL. words to intern at instantiation.
+        """
+        self._index = {}                # word -> id
+        self._words = np.zeros(64, dtype=config.DT_WORD['word'])   # id -> word
+        self._lock = threading.Lock()   # intern() may be called from threads
+        if len(words):
+            self.intern(words)
+
+    def __len__(self):
+        return len(self._index)
+
+    def __contains__(self, word):
+        return word[:config.MAX_WORD_LENGTH] in self._index
+
+    def __getitem__(self, ids):
+        """returns word[s] for id[s].
+        """
+        return self._words[:len(self._index)][ids]
+
+    def __reduce__(self):
+        # the shared instance is pickled by reference so objects sent to other
+        # processes do not carry a copy of the entire vocabulary.
+        if self is VOCABULARY:
+            return (_shared_vocabulary, ())
+        return (Vocabulary, (self.words,))
+
+    @property
+    def words(self):
+        """returns an array of all words where index == id.
+        """
+        return self._words[:len(self._index)]
+
+
+    def intern(self, words):
+        """get ids for words. Words not in the vocabulary are added.
+        @param words (list/array): a collection of words in unicode.
+        Returns a 1D array of ids of dtype=config.DT_ID['id'].
+        """
+        ids = np.zeros(len(words), dtype=config.DT_ID['id'])
+        with self._lock:
+            index = self._index
+            for i, w in enumerate(words):
+                w = w[:config.MAX_WORD_LENGTH]
+                try:
+                    ids[i] = index[w]
+                except KeyError:
+                    n = len(index)
+                    if n==len(self._words):         # grow storage geometrically
+                        self._words = np.concatenate((self._words,
+                                        np.zeros(n, dtype=self._words.dtype)))
+                    self._words[n] = w
+                    index[w] = ids[i] = n
+        return ids
+
+
+    def lookup(self, words):
+        """get ids for words without adding new words.
+        @param words (list/array): a collection of words in unicode.
+        Returns a 1D array of ids. Words not in the vocabulary have id -1.
+        """
+        index = self._index
+        return np.array([index.get(w[:config.MAX_WORD_LENGTH], -1) for w in words],
+                        dtype=config.DT_ID['id'])
+
+
+    def encode(self, wordcount):
+        """convert a wordcount to dtype=config.DT_ID_WEIGHT.
+        @param wordcount (ndarray): array of dtype=config.DT_WORD_WEIGHT or
+                                config.DT_ID_WEIGHT
+        Returns a new array of dtype=config.DT_ID_WEIGHT.
+        """
+        counts = np.zeros(len(wordcount), dtype=config.DT_ID_WEIGHT)
+        if 'id' in wordcount.dtype.names:
+            counts['id'] = wordcount['id']
+        else:
+            counts['id'] = self.intern(wordcount['word'])
+        counts['weight'] = wordcount['weight']
+        return counts
+
+
+    def decode(self, counts):
+        """convert an array of dtype=config.DT_ID_WEIGHT to config.DT_WORD_WEIGHT.
+        """
+        wordcount = np.zeros(len(counts), dtype=config.DT_WORD_WEIGHT)
+        wordcount['word'] = self[counts['id']]
+        wordcount['weight'] = counts['weight']
+        return wordcount
+
+
+
+def _shared_vocabulary():
+    return VOCABULARY
+
+VOCABULARY = Vocabulary()
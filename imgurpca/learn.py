@@ -3,9 +3,9 @@ from __future__ import unicode_literals
 from __future__ import absolute_import
 from .base import BaseLearner
 from .base import Atomic
-from . import Post
-from . import Parser
-from csv import reader, writer
+from .base import CSRMatrix
+from .base import utils
+import numpy as np
 
 # The Learner class performs analysis on the data (particularly wordcounts) generated
 # by the Post/Parser/User classes. It first reduces the dimensionality of the data
@@ -24,28 +24,58 @@ class Learner(BaseLearner):
 
 
     def get_comment_axes(self, child_comments=False, comment_votes=True,
-                            comment_level=True):
+                            comment_level=True, n=-1, solver='auto', seed=None):
         """get eigenvectors describing wordcounts of individual parent/parent+child
-        comments on a Post/ by a User.
+        comments on a Post/ by a User. All comments are tokenized in one pass into
+        a sparse [comments x words] matrix, on which PCA is done directly.
         @param child_comments (bool): whether to parse child comments or not
         @param comment_votes (bool): whether to pass comment votes to self.word_weight,
                                     False passes 1 for all comments.
         @param comment_level (bool): whether to pass comment nest level to
                                     self.word_weight, False passes 1 for all comments.
+        @param n (int): Number of axes to get. Defaults to all eigenvectors.
+        @param solver (str): 'full', 'gram', 'randomized' or 'auto'. See get_axes().
+        @param seed (int/RandomState): OPTIONAL. For 'randomized'. See get_axes().
         Returns and sets self.axes (2D array) as the principal components (column -> axis)
         """
-        if isinstance(self.source, Atomic):
-            temp = [Post('x', client=self.source.client, comments=[c], points=1) for c in self.source.comments]
-            for p in temp:
-                p.word_weight = self.source.word_weight
-                p.generate_word_counts(child_comments, comment_votes, comment_level)
-            P = Parser(client=self.source.client, items=temp)
-            P.consolidate()
-            L = Learner(source=P)
-            self.axes = L.get_axes()
-            self._custom_words = P.words    # since child_comments might be
-                                            # different b/w source.generate_word_counts
-                                            # and self.get_comment_axes
-            return self.axes
-        else:
+        if not isinstance(self.source, Atomic):
             raise Exception('get_comment_axes only for Post/User objects.')
+        # PREPROCESSING
+        # Each top level element of source.comments is a row, weighted as if it
+        # were the only comment in a Post with 1 point.
+        words, weights, lengths = [], [], []
+        word_weight = self.source.word_weight
+        for comment in self.source.comments:
+            if child_comments:
+                iterable = utils.flatten([comment])
+            else:
+                iterable = [(comment, 1)]
+            nwords = 0
+            for c in iterable:      # c => (comment, nest level)
+                vote = c[0].points if comment_votes else 1
+                level = c[1] if comment_level else 1
+                tokens = utils.sanitize(c[0].comment)
+                words.extend(tokens)
+                weights.extend([word_weight(1, vote, level)] * len(tokens))
+                nwords += len(tokens)
+            lengths.append(nwords)
+        ids, columns = np.unique(self.vocabulary.intern(words), return_inverse=True)
+        order = utils.word_order(ids, np.bincount(columns, weights=weights,
+                                 minlength=len(ids)), self.vocabulary)
+        ids, columns = ids[order], np.argsort(order)[columns]
+        rows = np.repeat(np.arange(len(lengths)), lengths)
+        # repeated words in a comment are summed into one element
+        cells, inverse = np.unique(rows * len(ids) + columns, return_inverse=True)
+        data = np.bincount(inverse, weights=np.asarray(weights, dtype=float),
+                           minlength=len(cells))
+        indptr = np.zeros(len(lengths)+1, dtype=np.intp)
+        np.cumsum(np.bincount(cells // max(1, len(ids)), minlength=len(lengths)),
+                  out=indptr[1:])
+        matrix = CSRMatrix(data, cells % max(1, len(ids)), indptr, (len(lengths), len(ids)))
+        # CALCULATIONS
+        self._ipca = None
+        self.axes = self._pca(matrix, n, solver, seed)
+        self._custom_ids = ids          # since child_comments might be
+                                        # different b/w source.generate_word_counts
+                                        # and self.get_comment_axes
+        return self.axes
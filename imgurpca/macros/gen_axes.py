@@ -40,10 +40,10 @@ def gen_axes(cs, cid, output=None, remove=[], pages=(0,3), n=150, axes=2, topn=5
     # For each post, tabulate word frequencies and normalize
     for post in p.items:                    # get word counts for each post
         post.generate_word_counts(child_comments, comment_votes, comment_level)
-        post.filter_by_word(remove, reverse=True)
-        post.normalize()
+    p.filter_by_word(remove, reverse=True)  # filter/normalize all posts at once
+    p.normalize()
 
-    p.items = [post for post in p.items if len(post.wordcount)]  # in case rate limit prevents comment download
+    p.items = [post for post in p.items if len(post.counts)]  # in case rate limit prevents comment download
     if len(p.items)==0:
         print('No posts could be downloaded.')
         exit(-1)
@@ -10,10 +10,12 @@ from . import Post
 from . import User
 from . import Query
 from . import imutils
+from .aclient import AsyncClient
 from .base import Molecular
 from . import utils
 from . import config
 import numpy as np
+import asyncio
 import sys
 
 # The Parser class performs operations on a collection of Post or User objects
@@ -46,6 +48,7 @@ class Parser(Molecular):
         """
         imutils.set_up_client(self, **kwargs)
         super(Parser, self).__init__(**kwargs)
+        self.nthreads = nthreads
 
         self._query_to_client = {Query.GALLERY_TOP: self.client.gallery,
                                 Query.GALLERY_HOT: self.client.gallery,
@@ -57,6 +60,40 @@ class Parser(Molecular):
                                 Query.MEMES: self.client.memes_subgallery}
 
 
+    async def adownload(self, connections=64, base_url=None, *args, **kwargs):
+        """coroutine that downloads all items in self.items concurrently. All
+        requests for all items share an event loop and a pool of at most
+        'connections' open connections, instead of a thread per item.
+        @param connections (int): maximum number of requests in flight.
+        @param base_url (str): OPTIONAL. API root URL, defaults to imgur's.
+        *args and **kwargs are passed to each item's adownload() (e.g. pages
+        for User objects).
+        """
+        aclient = AsyncClient(self.client, connections, base_url)
+        try:
+            await asyncio.gather(*[self._adownload_item(i, aclient, *args, **kwargs)
+                                   for i in self.items])
+        finally:
+            await aclient.close()
+
+
+    async def _adownload_item(self, item, aclient, *args, **kwargs):
+        try:
+            await item.adownload(aclient, *args, **kwargs)
+        except ImgurClientRateLimitError:
+            print('Rate limit exceeded. Download unfinished.', file=sys.stderr)
+        except KeyError:
+            print("imgurpython library couldn't access children", file=sys.stderr)
+
+
+    def download_async(self, connections=64, base_url=None, *args, **kwargs):
+        """downloads all items in self.items on an asyncio event loop. Blocks
+        until done. See adownload(). Use 'await parser.adownload()' from within
+        a running event loop instead.
+        """
+        asyncio.run(self.adownload(connections, base_url, *args, **kwargs))
+
+
     def content(self, flatten=True):
         """returns a generator (optionally flattened) of content attributes of
         User/Post objects in self.items.
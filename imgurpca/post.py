@@ -4,6 +4,7 @@ from . import utils
 from . import config
 from . import imutils
 from .base import Atomic
+from .aclient import gather
 import numpy as np
 
 # The Post class represents a single gallery item on imgur.com. Each post is
@@ -53,6 +54,22 @@ class Post(Atomic):
         self.comments = self.client.gallery_item_comments(self.id)
 
 
+    async def adownload(self, aclient):
+        """coroutine version of download(). The post and its comments are
+        requested concurrently, then the user.
+        @param aclient (AsyncClient): see aclient.py.
+        """
+        post_obj, comments = await gather(aclient.gallery_item(self.id),
+                                          aclient.gallery_item_comments(self.id))
+        for attr in post_obj.__dict__:
+            setattr(self, attr, post_obj.__dict__[attr])
+
+        if post_obj.account_url:
+            self.user = await aclient.get_account(post_obj.account_url)
+
+        self.comments = comments
+
+
     def get_user_ids(self, replies=False):
         """return a list of usernames (url) that commented on post.
         @param replies (boolean): True-> include child comments
@@ -74,8 +91,8 @@ class Post(Atomic):
 
     def generate_word_counts(self, child_comments=False, comment_votes=True,
                             comment_level=True):
-        """generate a numpy array of words and their weights as determined by
-        self.word_weight function.
+        """generate a numpy array of word ids and their weights as determined by
+        self.word_weight function. Stored in self.counts.
         @param child_comments (bool): whether to parse child comments or not
         @param comment_votes (bool): whether to pass comment votes to self.word_weight,
                                     False passes 1 for all comments.
@@ -98,4 +115,6 @@ class Post(Atomic):
                 except KeyError:
                     words[w] = weight
 
-        self.wordcount = np.array(list(words.items()), dtype=config.DT_WORD_WEIGHT)
+        self.counts = np.zeros(len(words), dtype=config.DT_ID_WEIGHT)
+        self.counts['id'] = self.vocabulary.intern(list(words.keys()))
+        self.counts['weight'] = list(words.values())
@@ -3,6 +3,7 @@ from __future__ import absolute_import
 from . import Post
 from . import utils
 from . import config
+from .aclient import gather
 
 # User is a subclass of Post which represents comments made by an imgur user.
 # Each user is identified by the url attribute (alias: username) which must be
@@ -68,6 +69,31 @@ class User(Post):
             self.favourites.extend(res)
 
 
+    async def adownload(self, aclient, pages=0):
+        """coroutine version of download(). The account, posts, comments and
+        favourites are requested concurrently. Each list is paged in order and
+        stops at the first empty page, as in download().
+        @param aclient (AsyncClient): see aclient.py.
+        @param pages (int/tuple): page number or range of pages (inclusive) to get
+        """
+        if isinstance(pages, int):
+            pages = (pages, pages+1)
+
+        async def paginate(func, dest):
+            for i in range(*pages):
+                res = await func(self.username, page=i)
+                if len(res)==0:
+                    break
+                dest.extend(res)
+
+        account_obj, _, _, _ = await gather(aclient.get_account(self.username),
+                        paginate(aclient.get_account_submissions, self.posts),
+                        paginate(aclient.get_account_comments, self.comments),
+                        paginate(aclient.get_gallery_favorites, self.favourites))
+        for attr in account_obj.__dict__:
+            setattr(self, attr, account_obj.__dict__[attr])
+
+
     def get_post_ids(self):
         """return string ids for posts by user. Requires download() first.
         """
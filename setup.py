@@ -3,12 +3,13 @@ from setuptools import setup, find_packages
 
 setup(
     name='imgurpca',
-    version='2.3.0',
+    version='2.4.0',
     description='Machine learning and bots on imgur.com.',
     author='Ibrahim A.',
     author_email='ibrahim78786@gmail.com',
     packages=find_packages(),
     install_requires=['requests', 'numpy', 'imgurpython'],
+    python_requires='>=3.7',
     url='https://github.com/hazrmard/imgurPCA',
     classifiers=['Development Status :: 3 - Alpha'],
 )
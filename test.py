@@ -3,15 +3,25 @@ from __future__ import unicode_literals
 from __future__ import absolute_import
 from imgurpca import *
 from imgurpca.base import Parallel
+from imgurpca import base
 from imgurpca.macros import Chatter
 from imgurpython import ImgurClient
 from imgurpython.client import ImgurClientError
 import pickle
+import itertools
+import contextlib
+import io
+import threading
 import numpy as np
 import os
 import time
 import sys
 import requests
+import json
+try:
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+except ImportError:
+    ThreadingHTTPServer = None
 
 SAMPLE_POST = None
 SAMPLE_USER = None
@@ -175,6 +185,48 @@ def test_word_counts(c):
     SAMPLE_USER.generate_word_counts()      # User has no child_comments option
     SAMPLE_POST.generate_word_counts(child_comments=True)
 
+@test
+def test_vocabulary(c):
+    v = base.Vocabulary()
+    ids = v.intern(['the', 'quick', 'the', 'fox'])
+    assert np.array_equal(ids, [0,1,0,2]) and len(v)==3, 'Incorrect word ids.'
+    assert np.array_equal(v.lookup(['fox', 'dog']), [2,-1]), 'Incorrect lookup.'
+    assert np.array_equal(v[ids], ['the', 'quick', 'the', 'fox']), 'Incorrect words.'
+    arr = np.array([('a',1),('b',2)],dtype=config.DT_WORD_WEIGHT)
+    p = Post(id='xyz', client=c, wordcount=arr)
+    assert p.counts.dtype==config.DT_ID_WEIGHT, 'Wordcount not stored as ids.'
+    assert np.array_equal(p.wordcount, arr), 'Wordcount not decoded.'
+    assert pickle.loads(pickle.dumps(p.vocabulary)) is p.vocabulary, \
+            'Shared vocabulary not pickled by reference.'
+
+@test
+def test_vocabulary_pickling(c):
+    words = np.array(['hello', 'world', 'there', 'general'])
+    items = [base.Atomic(wordcount=np.array(list(zip(words, w)), dtype=config.DT_WORD_WEIGHT))
+             for w in np.random.RandomState(0).uniform(1, 2, size=(5, 4))]
+    m = base.Molecular(items=items)
+    m.consolidate(words=words[:3])
+    l = Learner(source=m)
+    l.partial_fit(m, 2)
+    data = pickle.dumps((items[0], m, l))
+    expected = (items[0].wordcount, m.wordcount, l.words, l.project(m))
+    fresh = base.Vocabulary(['hen', 'ibis', 'jay'])   # same ids, other words
+    classes = (base.Atomic, base.Molecular, base.BaseLearner)
+    try:
+        for cls in classes:
+            cls.vocabulary = fresh
+        a, n, k = pickle.loads(data)
+        assert np.array_equal(a.wordcount, expected[0]), 'Atomic words changed.'
+        assert np.array_equal(n.wordcount, expected[1]), 'Molecular words changed.'
+        assert np.array_equal(k.words, expected[2]), 'Learner words changed.'
+        assert np.allclose(k.project(n), expected[3]), 'Projections changed.'
+        assert np.array_equal(fresh[n._filter[0]], words[:3]), 'Filter words changed.'
+        k.partial_fit(n, 2)
+        assert np.array_equal(k.words, expected[2]), 'Incremental PCA words changed.'
+    finally:
+        for cls in classes:
+            cls.vocabulary = base.VOCABULARY
+
 @test
 def test_normalization(c):
     arr = np.array([('a',1),('b',2),('c',3),('d',4),('e',5)],dtype=config.DT_WORD_WEIGHT)
@@ -223,6 +275,17 @@ def test_sorting(c):
     p.sort_by_weight()
     if not np.array_equal(p.wordcount, arr):
         raise ValueError('Sorted array incorrect.')
+    arr = np.array([('zeta',1),('alpha',3),('mu',2)],dtype=config.DT_WORD_WEIGHT)
+    m = base.Molecular(items=[base.Atomic(wordcount=arr), base.Atomic(wordcount=arr[:1])])
+    m.consolidate()                 # default sort order is by word
+    assert list(m.words)==['alpha', 'mu', 'zeta'], 'Consolidated words not sorted.'
+    assert list(m.items[1].words)==list(m.words), 'Item words not sorted.'
+    try:
+        config.DEFAULT_SORT_ORDER = 'weight'
+        m.consolidate(sparse=True)
+        assert list(m.words)==['zeta', 'mu', 'alpha'], 'Words not sorted by weight.'
+    finally:
+        config.DEFAULT_SORT_ORDER = 'word'
 
 @test
 def test_parallel_func(c):
@@ -242,6 +305,200 @@ def test_parallel_func(c):
     if not r==square_list:
         raise ValueError('Result list incorrect.')
 
+@test
+def test_parallel_pool(c):
+    class myParallel(Parallel):
+        def parallel_process(self, pkg, common):
+            return (pkg**2, threading.current_thread())
+
+    pool = base.WorkerPool(size=3)
+    threads = set()
+    for burst in range(5):      # repeated bursts reuse the pool's threads
+        p = myParallel(range(20), nthreads=3, pool=pool)
+        p.start()
+        p.wait_for_threads()
+        r = p.get_results()
+        assert sorted(x for x, _ in r)==[n**2 for n in range(20)], 'Result list incorrect.'
+        threads.update(t for _, t in r)
+    assert 0 < len(threads) <= 3 and set(threads)<=set(pool.threads), \
+            'Pool threads not reused.'
+    job = pool.submit(lambda: 1 / 0)
+    try:
+        job.result(timeout=5)
+        raise AssertionError('Job error not raised.')
+    except ZeroDivisionError:
+        pass
+    pool.shutdown()
+    assert not any(t.is_alive() for t in threads), 'Threads alive after shutdown.'
+    assert pool.submit(sum, [1, 2]).result(timeout=5)==3, 'Pool not usable after shutdown.'
+    pool.shutdown()
+
+    class Item(base.Atomic):
+        def download(self):
+            self.thread = threading.current_thread()
+    m = base.Molecular(items=[Item() for _ in range(10)], nthreads=2, pool=pool)
+    m.download()
+    m.download()
+    assert set(i.thread for i in m.items)<=set(pool.threads) and \
+            len(pool.threads)<=2, 'Downloads did not reuse pool threads.'
+    pool.shutdown()
+
+    class Outer(Parallel):          # each task runs a Parallel on the same pool
+        def parallel_process(self, pkg, common):
+            p = myParallel(range(pkg), nthreads=2, pool=common)
+            p.start()
+            p.wait_for_threads()
+            return sorted(x for x, _ in p.get_results())
+    pool = base.WorkerPool(size=2)
+    p = Outer(range(1, 6), common=pool, nthreads=2, pool=pool)
+    done = threading.Event()
+    p.set_callback(done.set)
+    p.start()
+    assert done.wait(10), 'Nested Parallel deadlocked on pool.'
+    assert p.get_results()==[[n**2 for n in range(k)] for k in range(1, 6)], \
+            'Nested results incorrect.'
+    started = threading.Barrier(6, timeout=10)
+    class Waiting(Parallel):        # all workers must run at once to pass barrier
+        def parallel_process(self, pkg, common):
+            started.wait()
+    p = Waiting(range(6), nthreads=6, pool=pool)
+    p.start()
+    p.wait_for_threads()
+    assert len(pool.threads)>=6, 'Pool did not spawn nthreads workers.'
+    pool.shutdown()
+
+class SleepParallel(Parallel):     # module level, so it can be pickled
+    def parallel_process(self, pkg, common):
+        time.sleep(pkg * common)
+        if pkg < 0:
+            raise ValueError(pkg)
+        return pkg**2
+
+@test
+def test_parallel_results(c):
+    pkgs = [5, 0, 3, 1, 4, 2]
+    p = SleepParallel(pkgs, common=0.05, nthreads=6)
+    r = list(p.iter_results())
+    assert [x for x, _ in r]==sorted(pkgs) and all(y==x**2 for x, y in r), \
+            'Results not yielded as completed.'
+    assert p.get_results()==[], 'Results not consumed.'
+    for kwargs in ({}, {'pool': base.WorkerPool(size=2)}, {'backend': 'processes'}):
+        p = SleepParallel(pkgs, common=0.01, nthreads=2, **kwargs)
+        assert list(p.iter_results(ordered=True))==[(x, x**2) for x in pkgs], \
+                'Ordered results incorrect.'
+        p = SleepParallel([0, -1, 2], common=0, nthreads=1, **kwargs)
+        try:
+            list(p.iter_results())
+            raise AssertionError('Error in worker not raised.')
+        except ValueError:
+            pass
+
+    class Item(base.Atomic):
+        def download(self):
+            time.sleep(0.01 * self.delay)
+            self.downloaded = time.time()
+    m = base.Molecular(items=[Item(delay=d) for d in (8, 0, 4)], nthreads=3)
+    first = None
+    for item in m.iter_download():
+        first = first or time.time()
+    assert first < m.items[0].downloaded, 'Downloads not streamed.'
+    assert [i.delay for i in m.iter_download(ordered=True)]==[8, 0, 4], \
+            'Downloads not in order.'
+
+DRAWN = []                          # pkgs drawn from a generator by Parallel
+
+def drawn_pkgs(n=None):
+    for i in (itertools.count() if n is None else range(n)):
+        DRAWN.append(i)
+        yield i
+
+class LazyParallel(Parallel):      # module level, so it can be pickled
+    def parallel_process(self, pkg, common):
+        time.sleep(0.002)
+        if pkg==common:
+            raise ValueError(pkg)
+        return len(DRAWN) - pkg     # pkgs read ahead, in thread workers
+
+@test
+def test_parallel_lazy_input(c):
+    bound = 2*2 + 2 + 1                 # queue, one per worker, one in feeder
+    for kwargs in ({}, {'pool': base.WorkerPool(size=2)}, {'backend': 'processes'}):
+        del DRAWN[:]
+        p = LazyParallel(drawn_pkgs(100), common=-1, nthreads=2, **kwargs)
+        assert not DRAWN, 'Input read before start().'
+        for k, (pkg, ahead) in enumerate(p.iter_results()):
+            if 'backend' in kwargs:     # 2 pkgs per process in flight
+                assert len(DRAWN) <= k + 1 + bound + 4, 'Input not bounded.'
+            else:
+                assert ahead <= bound + 2, 'Input not bounded.'  # + pkgs taken meanwhile
+        assert k==99 and len(DRAWN)==100, 'Not all pkgs processed.'
+        del DRAWN[:]
+        p = LazyParallel(drawn_pkgs(), common=50, nthreads=2, **kwargs)
+        p.start()
+        try:
+            p.wait_for_threads()
+            raise AssertionError('Error in worker not raised.')
+        except ValueError:
+            pass
+        p.feeder_thread.join(5)
+        assert not p.feeder_thread.is_alive(), 'Feeder not stopped after error.'
+        assert len(DRAWN) <= 50 + bound + 4 + 1, 'Input read after error.'
+
+class SquareProcess(Parallel):     # module level, so it can be pickled
+    def parallel_process(self, pkg, common):
+        return pkg, pkg**common, os.getpid()
+
+class InternProcess(Parallel):
+    def parallel_process(self, pkg, common):
+        return base.VOCABULARY.intern([pkg])[0], config.DT_FLOAT
+
+@test
+def test_parallel_processes(c):
+    p = SquareProcess(range(30), common=2, nthreads=2, backend='processes')
+    p.start()
+    p.wait_for_threads()
+    r = p.get_results()
+    assert sorted((x, y) for x, y, _ in r)==[(n, n**2) for n in range(30)], \
+            'Result list incorrect.'
+    assert os.getpid() not in set(pid for _, _, pid in r), 'Not run in other processes.'
+    with base.VOCABULARY._lock:         # a lock held by another thread at start
+        config.set_precision(np.float32)
+        p = InternProcess(['a', 'b'], nthreads=2, backend='processes')
+        done = threading.Event()
+        p.set_callback(done.set)
+        p.start()
+        finished = done.wait(60)
+        config.set_precision(np.float64)
+    assert finished, 'Worker processes deadlocked on inherited lock.'
+    assert all(d==np.float32 for _, d in p.get_results()), 'Precision not passed on.'
+    p = SquareProcess(range(3), common='x', nthreads=2, backend='processes')
+    p.start()
+    try:
+        p.wait_for_threads()
+        raise AssertionError('Error in process not raised.')
+    except TypeError:
+        pass
+    obj = os.path.dirname(os.path.abspath(__file__)) + os.path.sep + 'testdata'+os.path.sep+'test_comment.object'
+    with open(obj, 'rb') as f:
+        comments = pickle.load(f)             # a serialized comment object w/ known values
+    posts = [Post(str(i), client=c, comments=comments[i:], points=i) for i in range(10)]
+    m = base.Molecular(items=posts)
+    m.generate_word_counts(child_comments=True)
+    serial = [np.sort(p.wordcount, order='word') for p in posts]
+    for p in posts:
+        p.counts = None
+    m.generate_word_counts(nprocs=2, child_comments=True)
+    assert all(np.array_equal(np.sort(p.wordcount, order='word'), s)
+               for p, s in zip(posts, serial)), 'Word counts from processes do not match.'
+    for p in posts:
+        p.set_word_weight_func(lambda post, votes, level: votes)
+        p.generate_word_counts(False, False)
+    novotes = [np.sort(p.wordcount, order='word') for p in posts]
+    m.generate_word_counts(True, True)      # positional args go to items
+    m.generate_word_counts(False, False)
+    assert all(np.array_equal(np.sort(p.wordcount, order='word'), s)
+               for p, s in zip(posts, novotes)), 'Positional arguments not passed on.'
+
 @test
 def test_query_class(c):
     q = Query(Query.GALLERY_HOT).sort_by(Query.TOP).over(Query.WEEK).construct()
@@ -268,6 +525,16 @@ def test_query_class(c):
 def test_parser_instance(c):
     P = Parser(client=c)
 
+@test
+def test_parser_pickling(c):
+    P = Parser(client=c, items=[Post('xyz', client=c)])
+    P.pool = base.WorkerPool(size=2)
+    Q = pickle.loads(pickle.dumps(P))
+    assert Q.pool is base.POOL and len(Q.items)==1, 'Parser not unpickled.'
+    l = pickle.loads(pickle.dumps(Learner(source=P)))
+    assert l.source.pool is base.POOL, 'Learner source not unpickled.'
+    P.pool.shutdown()
+
 @test
 def test_parser_population(c):
     global SAMPLE_PARSER
@@ -315,6 +582,70 @@ def test_parser_consolidation(c):
     SAMPLE_PARSER.consolidate()
     assert len(SAMPLE_PARSER.words), 'No wordcount generated.'
 
+@test
+def test_parser_sparse_consolidation(c):
+    arr = np.array([('a',1),('b',2),('c',3),('d',4),('e',5)],dtype=config.DT_WORD_WEIGHT)
+    brr = np.array([('c',3),('a',1),('f', 6)],dtype=config.DT_WORD_WEIGHT)
+    crr = np.array([('a',2),('b',2),('c',6),('d',4),('e',5), ('f', 6)],dtype=config.DT_WORD_WEIGHT)
+    P = Parser(client=c,items=[Post(id=1,client=c,wordcount=np.copy(arr)),
+                               Post(id=2,client=c,wordcount=np.copy(brr))])
+    P.consolidate(sparse=True)
+    assert np.array_equal(P.wordcount, crr), "Unexpected array output."
+    assert P.matrix.shape==(2,6) and P.matrix.nnz==8, "Unexpected matrix shape."
+    Q = Parser(client=c,items=[Post(id=1,client=c,wordcount=np.copy(arr)),
+                               Post(id=2,client=c,wordcount=np.copy(brr))])
+    Q.consolidate()
+    assert np.allclose(P.matrix.toarray(), np.vstack([i.weights for i in Q.items])),\
+            "Sparse matrix does not match padded wordcounts."
+    for x, y in zip(P.get_baseline(), Q.get_baseline()):
+        assert np.allclose(x, y), "Sparse baseline does not match."
+    L, M = Learner(source=P), Learner(source=Q)
+    assert np.allclose(np.abs(L.get_axes()), np.abs(M.get_axes())), "Sparse axes do not match."
+    assert np.allclose(L.project(P), M.project(Q)), "Sparse projection does not match."
+
+@test
+def test_parser_incremental_consolidation(c):
+    arr = np.array([('a',1),('b',2),('c',3)],dtype=config.DT_WORD_WEIGHT)
+    brr = np.array([('c',3),('d',4)],dtype=config.DT_WORD_WEIGHT)
+    crr = np.array([('e',5),('a',1)],dtype=config.DT_WORD_WEIGHT)
+    for sparse in (False, True):
+        P = Parser(client=c,items=[Post(id=1,client=c,wordcount=arr),
+                                   Post(id=2,client=c,wordcount=brr)])
+        P.consolidate(sparse=sparse)
+        P.add_items([Post(id=3,client=c,wordcount=crr)])
+        Q = Parser(client=c,items=[Post(id=1,client=c,wordcount=arr),
+                                   Post(id=2,client=c,wordcount=brr),
+                                   Post(id=3,client=c,wordcount=crr)])
+        Q.consolidate(sparse=sparse)
+        order = utils.positions(P.ids, Q.ids)   # Q's words in P's order
+        assert np.array_equal(P.wordcount[order], Q.wordcount), 'Unexpected array output.'
+        assert P._consolidated and len(P.items)==3, 'Items not consolidated.'
+        for x, y in zip(P.get_baseline(), Q.get_baseline()):
+            assert np.allclose(x[order], y), 'Incremental baseline does not match.'
+        if not sparse:
+            assert all(np.array_equal(i.ids, P.ids) for i in P.items), \
+                    'Items not padded.'
+
+@test
+def test_parser_filters(c):
+    arr = np.array([('e',1),('a',2),('c',3)],dtype=config.DT_WORD_WEIGHT)
+    brr = np.array([('d',4),('b',5),('a',6),('f',7)],dtype=config.DT_WORD_WEIGHT)
+    P = Parser(client=c,items=[Post(id=1,client=c,wordcount=arr),
+                               Post(id=2,client=c,wordcount=brr)])
+    P.filter_by_word(['a', 'b', 'c', 'd', 'e'])
+    P.filter_by_weight(2, 5)
+    P.normalize()
+    P.sort(order='word')
+    p, q = P.items
+    assert np.array_equal(p.words, ['a', 'c']) and np.array_equal(q.words, ['b', 'd']),\
+            'Filtered array not as expected.'
+    assert np.allclose(p.weights, [0.4, 0.6]) and np.allclose(q.weights, [5/9., 4/9.]),\
+            'Incorrect normalization.'
+    P.filter_by_weight(0.5, 0.6, reverse=True)
+    p, q = P.items
+    assert np.array_equal(p.words, ['a']) and np.array_equal(q.words, ['d']),\
+            'Filtered array not as expected.'
+
 @test
 def test_parser_baseline(c):
     global SAMPLE_PARSER
@@ -322,6 +653,96 @@ def test_parser_baseline(c):
     assert len(a)==len(SAMPLE_PARSER.words) and len(a)==len(v),\
             'Incorrect output dimensions.'
 
+class ImgurStandIn(BaseHTTPRequestHandler if ThreadingHTTPServer else object):
+    """local stand-in for the imgur API, serving generated JSON.
+    """
+    protocol_version = 'HTTP/1.1'           # keep-alive connections
+    lock = threading.Lock()
+    active = peak = served = 0
+
+    def route(self, parts):
+        comment = lambda i, children: {'id': i, 'comment': 'word%d spam' % i,
+                            'author': 'u%d' % (i % 3), 'points': i, 'children': children}
+        if parts[0]=='gallery' and len(parts)==2:
+            i = int(parts[1][1:])
+            return {'id': parts[1], 'is_album': False, 'points': i, 'title': 't',
+                    'account_url': 'u%d' % (i % 3) if i % 4 else None}
+        if parts[0]=='gallery':
+            return [comment(0, [comment(1, [])]), comment(2, [])]
+        if parts[0]=='account' and parts[1]=='limited':
+            return None
+        if parts[0]=='account' and len(parts)==2:
+            return {'id': 7, 'url': parts[1], 'bio': None, 'reputation': 3,
+                    'created': 0, 'pro_expiration': False}
+        page = int(parts[-1])
+        if page >= 2:                       # two pages per user list
+            return []
+        if parts[2]=='comments':
+            return [comment(page, [])]
+        return [{'id': '%s%d' % (parts[2], page), 'is_album': page==1}]
+
+    def do_GET(self):
+        with self.lock:
+            ImgurStandIn.active += 1
+            ImgurStandIn.served += 1
+            ImgurStandIn.peak = max(ImgurStandIn.peak, ImgurStandIn.active)
+        time.sleep(0.01)
+        data = self.route(self.path.split('/')[2:])
+        status = 429 if data is None else 200
+        body = json.dumps({'data': data, 'success': True, 'status': status}).encode('utf-8')
+        with self.lock:
+            ImgurStandIn.active -= 1
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+@test
+def test_parser_async_download(c):
+    server = ThreadingHTTPServer(('127.0.0.1', 0), ImgurStandIn)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = 'http://127.0.0.1:%d/' % server.server_address[1]
+    nthreads = threading.active_count()
+    try:
+        p = Parser(client=c)
+        p.populate_posts(['p%d' % i for i in range(100)])
+        p.download_async(connections=16, base_url=url)
+        assert ImgurStandIn.served==300 - 25, 'Wrong number of requests.'
+        assert 1 < ImgurStandIn.peak <= 16, 'Requests not concurrent or not bounded.'
+        assert threading.active_count() - nthreads <= 16, 'Too many threads.'
+        for i, post in enumerate(p.items):
+            assert post.points==i and post.title=='t', 'Post attributes not set.'
+            assert (post.user is None)==(i % 4==0), 'Post user not set.'
+            assert post.user is None or post.user.url=='u%d' % (i % 3), 'Wrong user.'
+            assert [x.comment for x in post.comments]==['word0 spam', 'word2 spam'] \
+                and post.comments[0].children[0].comment=='word1 spam', 'Wrong comments.'
+        p.generate_word_counts()
+        assert sorted(p.items[1].words)==sorted(['word0', 'word2', 'spam']), \
+                'Word counts from downloaded comments incorrect.'
+
+        p.populate_users(['a', 'b'])
+        served = ImgurStandIn.served
+        p.download_async(base_url=url, pages=(0, 50))
+        assert ImgurStandIn.served - served==2 * (1 + 3*3), \
+                'User pages requested past first empty page.'
+        user = p.items[0]
+        assert user.reputation==3 and user.id==7, 'User attributes not set.'
+        assert [x.id for x in user.posts]==['submissions0', 'submissions1'] and \
+            [x.id for x in user.favourites]==['gallery_favorites0', 'gallery_favorites1'] \
+            and [x.comment for x in user.comments]==['word0 spam', 'word1 spam'], \
+            'User pages incorrect.'
+        p.populate_users(['limited'])
+        p.download_async(base_url=url, pages=(0, 50))
+        assert p.items[0].posts==[], 'Rate limited user not skipped.'
+    finally:
+        server.shutdown()
+        server.server_close()
+
 @test
 def test_parser_split(c):
     global SAMPLE_PARSER
@@ -380,6 +801,194 @@ def test_learner_axes(c):
     assert np.array_equal(m.words, l.words), 'Loaded axes words do not match.'
     assert np.array_equal(m.axes, l.axes), 'Loaded axes do not match'
 
+def random_molecular(nitems, nwords, rank=3, sparse=False):
+    """returns a consolidated base.Molecular with low rank random wordcounts"""
+    counts = np.abs(np.dot(np.random.normal(size=(nitems, rank)),
+                           np.random.normal(size=(rank, nwords))))
+    return counts_molecular(counts, sparse)
+
+def counts_molecular(counts, sparse=False):
+    """returns a consolidated base.Molecular with an item per row of counts"""
+    words = np.array(['rw%d' % i for i in range(counts.shape[1])])
+    items = [base.Atomic(wordcount=np.array(list(zip(words, row)),
+                         dtype=config.DT_WORD_WEIGHT)) for row in counts]
+    m = base.Molecular(items=items)
+    m.consolidate(sparse=sparse)
+    return m
+
+@test
+def test_learner_solvers(c):
+    m = random_molecular(100, 600)
+    l = Learner(source=m)
+    full = l.get_axes(n=3, solver='full')
+    rand = l.get_axes(n=3, solver='randomized')
+    assert full.shape==rand.shape==(600,3), 'Unexpected axes dimensions.'
+    assert np.allclose(full, rand, atol=1e-6), 'Randomized axes do not match.'
+    state = np.random.get_state()
+    rand = l.get_axes(n=3, solver='randomized', seed=5)
+    assert np.array_equal(np.random.get_state()[1], state[1]), \
+            'Randomized solver changed the global random state.'
+    assert np.array_equal(rand, l.get_axes(n=3, solver='randomized', seed=5)), \
+            'Seeded randomized axes differ.'
+    m.consolidate(sparse=True)
+    assert np.allclose(full, l.get_axes(n=3), atol=1e-6), 'Sparse axes do not match.'
+    assert np.allclose(full, l.get_axes(n=3, solver='gram'), atol=1e-6), \
+            'Gram axes do not match.'
+    m = random_molecular(20, 300)
+    l = Learner(source=m)
+    full = l.get_axes(solver='full')
+    gram = l.get_axes(solver='gram')
+    assert gram.shape[1] < 20, 'Gram axes exceed rank of data.'
+    assert np.allclose(full[:, :3], gram[:, :3], atol=1e-6), 'Gram axes do not match.'
+    m = random_molecular(30, 80)
+    l = Learner(source=m)
+    assert l._auto_solver(30, 80)=='gram' and l._auto_solver(10000, 20000)=='gram', \
+            'Gram solver not picked for fewer items than words.'
+    assert l._auto_solver(80, 30)=='full' and l._auto_solver(20000, 10000)=='full', \
+            'Wrong solver picked.'
+    auto = l.get_axes()
+    assert auto.shape[1] < 30, 'Auto axes exceed rank of data.'
+    assert np.allclose(l.get_axes(solver='full')[:, :3], auto[:, :3], atol=1e-6), \
+            'Auto axes do not match.'
+    # weak topics in Poisson noise: variance decays slowly over many axes
+    rng = np.random.RandomState(0)
+    topics = rng.gamma(0.3, size=(5, 600)) * 0.1 * np.arange(5, 0, -1)[:, None]
+    counts = rng.poisson(np.dot(rng.dirichlet(np.ones(5), 1500), topics) + 1.)
+    l = Learner(source=counts_molecular(counts, sparse=True))
+    assert np.allclose(l.get_axes(n=2), l.get_axes(n=2, solver='full'), atol=1e-6), \
+            'Auto axes of noisy counts do not match.'
+    try:
+        l.get_axes(n=3, solver='magic')
+        raise Exception('InvalidArgument expected.')
+    except config.InvalidArgument:
+        pass
+
+@test
+def test_learner_partial_fit(c):
+    m = random_molecular(30, 100)
+    full = Learner(source=m).get_axes(n=3, solver='full')
+    l = Learner()
+    for i in range(0, 30, 10):
+        l.partial_fit(base.Molecular(items=m.items[i:i+10]), 30)
+    axes = l.axes[utils.positions(l.ids, m.ids)]
+    assert np.allclose(full, axes[:, :3], atol=1e-6), 'Incremental axes do not match.'
+    words = np.array(['new word'], dtype=config.DT_WORD['word'])
+    item = base.Atomic(wordcount=np.array([('new word', 1.)], dtype=config.DT_WORD_WEIGHT))
+    l.partial_fit(base.Molecular(items=[item]), 3)
+    assert l.axes.shape==(101, 3) and np.array_equal(l.words[-1:], words), \
+            'New words not added to axes.'
+
+@test
+def test_learner_axes_files(c):
+    l = Learner(source=random_molecular(20, 50))
+    l.get_axes(n=3)
+    for fname in ('sample_axes.csv', 'sample_axes.npy'):
+        l.save_axes(fname)
+        m = Learner()
+        m.load_axes(fname)
+        assert np.array_equal(m.words, l.words), 'Loaded axes words do not match.'
+        assert np.allclose(m.axes, l.axes), 'Loaded axes do not match'
+        assert np.allclose(m.project(l.source), l.project(l.source)), \
+                'Loaded axes projections do not match.'
+    assert isinstance(m.axes, np.memmap), 'Binary axes not memory-mapped.'
+    del m
+    os.remove('sample_axes.csv')
+    os.remove('sample_axes.npy')
+    os.remove('sample_axes.words.npy')
+
+@test
+def test_learner_model_bundle(c):
+    l = Learner(source=random_molecular(40, 50))
+    l.get_axes(n=3)
+    proj = l.project(l.source)
+    l.k_means_cluster(proj, 3)
+    l.linear_regression(proj, proj[:,0])
+    labels = (proj[:,0] > 0).astype(int)
+    l.logistic_regression(proj, labels)
+    l.decision_tree(proj, labels, quantiles=8)
+    l.save_model('sample_model.npz')
+    m = Learner()
+    m.load_model('sample_model.npz')
+    assert 'dtree' not in m.__dict__, 'Model sections not loaded lazily.'
+    assert np.array_equal(m.words, l.words), 'Loaded words do not match.'
+    assert isinstance(m.axes, np.memmap), 'Axes not memory-mapped.'
+    assert np.allclose(m.project(l.source), proj), 'Loaded axes do not match.'
+    assert np.array_equal(m.assign_to_cluster(proj), l.assign_to_cluster(proj)), \
+            'Loaded cluster centers do not match.'
+    assert np.allclose(m.linear_prediction(proj), l.linear_prediction(proj)), \
+            'Loaded linear regression does not match.'
+    assert np.array_equal(m.logistic_prediction(proj), l.logistic_prediction(proj)), \
+            'Loaded logistic regression does not match.'
+    assert np.array_equal(m.decision_prediction(proj), l.decision_prediction(proj)), \
+            'Loaded decision tree does not match.'
+    n = Learner()
+    n.load_model('sample_model.npz')
+    n = pickle.loads(pickle.dumps(n))
+    assert np.array_equal(n.lrf, l.lrf), 'Pickled model does not match.'
+    del m
+    os.remove('sample_model.npz')
+
+@test
+def test_learner_comment_axes(c):
+    obj = os.path.dirname(os.path.abspath(__file__)) + os.path.sep + 'testdata'+os.path.sep+'test_comment.object'
+    with open(obj, 'rb') as f:
+        comments = pickle.load(f)             # a serialized comment object w/ known values
+    p = Post('asd', client=c, comments=comments, points=100)
+    p.set_word_weight_func(lambda points, votes, level: votes / level)
+    l = Learner(source=p)
+    l.get_comment_axes(comment_votes=True)
+    posts = [Post('x', client=c, comments=[cm], points=1) for cm in comments]
+    for q in posts:                 # each comment as a separate item
+        q.set_word_weight_func(p.word_weight)
+        q.generate_word_counts(comment_votes=True)
+    m = base.Molecular(items=posts)
+    m.consolidate()
+    ref = Learner(source=m)
+    ref.get_axes()
+    assert np.array_equal(l.words, ref.words), 'Comment axes words do not match.'
+    assert np.allclose(l.axes[:, :10], ref.axes[:, :10]), 'Comment axes do not match.'
+    assert l.get_comment_axes(n=3).shape==(len(l.words), 3), 'Unexpected number of axes.'
+
+@test
+def test_learner_projection_sources(c):
+    m = random_molecular(20, 50)
+    axes = [np.array(list(zip(m.words[::-1], w)), dtype=config.DT_WORD_WEIGHT)
+            for w in np.random.normal(size=(2, 50))]
+    axes.append(np.array([('unseen', 1.)], dtype=config.DT_WORD_WEIGHT))
+    l = Learner()
+    l.set_axes(axes)
+    dense = l.project(m)
+    assert dense.shape==(20, 3), 'Unexpected dimensions in result projections.'
+    assert np.allclose(dense[0], l.project(m.items[0])), 'Atomic projection does not match.'
+    u = base.Molecular(items=[base.Atomic(wordcount=i.wordcount) for i in m.items])
+    assert np.allclose(dense, l.project(u)), 'Unconsolidated projection does not match.'
+    m.consolidate(sparse=True)
+    assert np.allclose(dense, l.project(m)), 'Sparse projection does not match.'
+    assert np.allclose(dense, l.project(m.matrix, ids=m.ids)), \
+            'CSRMatrix projection does not match.'
+
+@test
+def test_learner_neighbours(c):
+    l = Learner()
+    proj = np.random.normal(size=(500, 3))
+    queries = np.random.normal(size=(20, 3))
+    l.build_neighbour_index(proj)
+    indices, dist = l.nearest_neighbours(queries, k=5)
+    brute = ((queries[:, None, :] - proj[None, :, :])**2).sum(axis=2)
+    assert np.array_equal(indices, np.argsort(brute, axis=1)[:, :5]), \
+            'Exact neighbours do not match.'
+    assert np.allclose(dist, np.sort(brute, axis=1)[:, :5]), 'Distances do not match.'
+    l.build_neighbour_index(proj, nlists=8)
+    assert np.array_equal(l.nearest_neighbours(queries, k=5, nprobe=8)[0], indices), \
+            'Approximate search over all lists does not match exact.'
+    l.nindex.add(queries)
+    assert np.array_equal(l.nearest_neighbours(queries, k=1, nprobe=1)[0][:, 0],
+            np.arange(500, 520)), 'Added points not found.'
+    l.build_neighbour_index(np.arange(3))
+    indices, dist = l.nearest_neighbours(np.array([2.2]), k=5)
+    assert np.array_equal(indices[0], [2, 1, 0, -1, -1]) and np.isinf(dist[0, -1]), \
+            'Missing neighbours not padded.'
+
 @test
 def test_learner_projection(c):
     global SAMPLE_LEARNER
@@ -408,6 +1017,23 @@ def test_learner_clustering(c):
     proj = np.array([[0.5,0],[0,0.5],[-0.1,0],[5,0]])
     res = l.assign_to_cluster(proj, centers)
     assert np.array_equal(res, np.array([0,1,2,0])), 'Incorrect clustering.'
+    res = l.assign_to_cluster(proj, centers, tree=True)
+    assert np.array_equal(res, np.array([0,1,2,0])), 'Incorrect tree clustering.'
+    res = l.assign_to_cluster(np.array([0.9, 5, -3]), np.array([1, 4, -1]))
+    assert np.array_equal(res, np.array([0,1,2])), 'Incorrect 1D clustering.'
+    centers = np.random.normal(size=(300,3))
+    proj = np.random.normal(size=(2000,3))
+    assert np.array_equal(l.assign_to_cluster(proj, centers, chunk=1000),
+                          l.assign_to_cluster(proj, centers, tree=True)), \
+            'Tree assignments do not match.'
+
+    true = np.array([[0,0],[10,0],[0,10],[10,10]])
+    proj = np.vstack([t + np.random.normal(size=(500,2)) for t in true])
+    for batch_size in (None, 200):
+        centers, assignments = l.k_means_cluster(proj, 4, batch_size=batch_size)
+        assert len(np.unique(assignments))==4, 'Empty clusters.'
+        dist = np.sqrt(l._sq_distances(true, centers))
+        assert np.all(np.min(dist, axis=1) < 0.5), 'Cluster centers not found.'
 
 @test
 def test_learner_regression(c):
@@ -423,16 +1049,33 @@ def test_learner_regression(c):
     res2 = l.linear_prediction(np.array([[3,4,5]]))
     assert len(res2)==1 and res[0]+(3*res[1]+4*res[2]+5*res[3])==res2[0], \
                 'Incorrect linear regression prediction.'
+    assert np.allclose(l.linear_prediction(3, np.array([1, 2])), [7]), \
+                'Incorrect prediction for a scalar projection.'
+    assert len(l.linear_regression(2, [4], store=False))==2, \
+                'Unexpected result dimensions for a scalar projection.'
 
     proj = np.arange(10).reshape((5,2))
     lbl = np.array([0,0,0,1,1])
     res = l.logistic_regression(proj, lbl)
-    assert res(np.array([0,1])) in [0,1], 'Wrong regression function.'
+    assert len(res)==3 and np.all(np.isfinite(res)), 'Wrong regression coefficients.'
+    assert np.array_equal(l.logistic_prediction(proj), lbl), 'Wrong separable fit.'
     proj = np.random.randint(0,100,size=(3,2))
     res = l.logistic_prediction(proj)
     assert len(res)==len(proj) and max(res)<=1 and min(res)>=0, \
             'Wrong logistic regression prediction.'
 
+    true = np.array([0.5, 2, -1])
+    rng = np.random.RandomState(0)      # fixed sample, tolerances are for its size
+    proj = rng.normal(size=(20000,2))
+    prob = 1 / (1 + np.exp(-(true[0] + np.dot(proj, true[1:]))))
+    lbl = (rng.uniform(size=len(prob)) < prob).astype(int)
+    res = l.logistic_regression(proj, lbl)
+    assert np.allclose(res, true, atol=0.15), 'Logistic coefficients not recovered.'
+    prob2 = l.logistic_prediction(proj, probabilities=True)
+    assert np.allclose(prob, prob2, atol=0.05), 'Wrong logistic probabilities.'
+    assert np.array_equal(pickle.loads(pickle.dumps(l)).lrf, l.lrf), \
+            'Logistic regression not picklable.'
+
 @test
 def test_learner_decision_tree(c):
     l = Learner()
@@ -455,6 +1098,26 @@ def test_learner_decision_tree(c):
     res = l.decision_prediction(np.array([[1,1,0]]))
     assert np.array_equal(res, np.array([[[0.,0.5],[1.,0.5]]])), 'Incorrect decision.'
 
+    data = np.random.normal(size=(1000,3))
+    labels = ((data[:,0]>0) ^ (data[:,2]>0.5)).astype(int)
+    dt = l.decision_tree(data, labels, branches=[[0],[0],[0.5]])
+    res = l.decision_prediction(data)
+    assert res.shape==(1000,2,2) and np.array_equal(res[0,:,0], [0,1]), \
+            'Unexpected prediction dimensions.'
+    assert np.array_equal(np.argmax(res[:,:,1], axis=1), labels), \
+            'Incorrect decision on deeper tree.'
+    dt2 = base.DTree.from_arrays(dt.to_arrays())
+    assert np.array_equal(dt2.classify(data), res), 'Tree arrays do not match.'
+
+    data = np.vstack((data, np.random.normal(size=(1000,3))))
+    labels = ((data[:,0]>0) ^ (data[:,2]>0.5)).astype(int)
+    dt = l.decision_tree(data, labels, quantiles=64)
+    res = l.decision_prediction(data)
+    assert np.mean(np.argmax(res[:,:,1], axis=1)==labels) > 0.99, \
+            'Incorrect decision with quantile bins.'
+    dt = l.decision_tree(data, labels, quantiles=64, max_depth=1)
+    assert len(dt.axis)==3 and dt.axis[0] in (0,2), 'Incorrect depth limited tree.'
+
 @test
 def test_bot_instance(c):
     global SAMPLE_BOT
@@ -517,6 +1180,97 @@ def test_bot_scheduler(c):
     SAMPLE_BOT.stop(force=False)
     assert len(k)==2, 'Unexpected scheduler frequency result.'
 
+@test
+def test_scheduler_errors(c):
+    called = threading.Event()
+    def fail(n):
+        called.set()
+        raise ValueError('task %d failed' % n)
+    e = base.Electronic()
+    stderr = io.StringIO()
+    with contextlib.redirect_stderr(stderr):
+        e.every(Bot.SECOND).do(fail).using([7]).go()
+        assert not e._task.threads[0].daemon, 'Task does not keep program alive.'
+        called.wait(10)
+        try:
+            e.stop()
+        except ValueError as err:
+            assert str(err)=='task 7 failed', 'Unexpected error.'
+        else:
+            raise AssertionError('Task error not re-raised by stop().')
+    assert 'task 7 failed' in stderr.getvalue(), 'Task traceback not printed.'
+
+@test
+def test_learner_cross_validation(c):
+    l = Learner()
+    proj = np.random.normal(size=(200, 3))
+    labels = (proj[:,0] + 0.1 * np.random.normal(size=200) > 0).astype(int)
+    params = [{'alpha': 1e-4}, {'alpha': 1e4}]
+    scores = l.cross_validate(proj, labels, 'logistic_regression', params,
+                              folds=4, repeats=2, nprocs=1, seed=0)
+    assert scores.shape==(2, 8), 'Unexpected dimensions of scores.'
+    assert np.array_equal(scores, l.cross_validate(proj, labels, 'logistic_regression',
+                            params, folds=4, repeats=2, nprocs=2, seed=0)), \
+            'Scores depend on number of processes.'
+    assert l.lrf is None, 'Cross-validation changed stored coefficients.'
+    best, mean, model = l.select_model(proj, labels, 'logistic_regression', params, seed=0)
+    assert best==params[0] and mean[0] > 0.8, 'Best configuration not selected.'
+    assert np.array_equal(l.lrf, model), 'Best configuration not trained.'
+    scores = l.cross_validate(proj, labels, 'decision_tree', {'quantiles': 8},
+                              folds=3, nprocs=2, seed=1)
+    assert np.all(scores > 0.7), 'Decision tree scores too low.'
+    state = np.random.get_state()
+    scores = l.cross_validate(proj, method='k_means_cluster',
+                              params=[{'nclusters': 1}, {'nclusters': 4}], nprocs=1, seed=3)
+    assert np.all(scores[1] > scores[0]), 'More clusters should fit closer.'
+    assert np.array_equal(np.random.get_state()[1], state[1]), 'Global random state changed.'
+    again = l.cross_validate(proj, method='k_means_cluster',
+                             params=[{'nclusters': 1}, {'nclusters': 4}], nprocs=1, seed=3)
+    assert np.array_equal(scores, again), 'Cross-validation not reproducible.'
+
+@test
+def test_precision(c):
+    config.set_precision(np.float32)
+    try:
+        m = random_molecular(30, 40)
+        assert m.counts['weight'].dtype==np.float32, 'Weights not float32.'
+        assert m.items[0].weights.dtype==np.float32, 'Item weights not float32.'
+        assert m.get_baseline()[0].dtype==np.float32, 'Baseline not float32.'
+        l = Learner(source=m)
+        for solver in ('full', 'gram', 'randomized'):
+            assert l.get_axes(n=3, solver=solver).dtype==np.float32, 'Axes not float32.'
+        proj = l.project(m)
+        assert proj.dtype==np.float32, 'Projections not float32.'
+        m.consolidate(sparse=True)
+        assert l.project(m).dtype==np.float32, 'Sparse projections not float32.'
+        assert l.k_means_cluster(proj, 3)[0].dtype==np.float32, 'Centers not float32.'
+        assert np.array_equal(l.assign_to_cluster(proj, tree=True), l.assign_to_cluster(proj)), \
+                'Tree assignments differ in float32.'
+        assert l._ctree[1].points.dtype==np.float32 and \
+                l._ctree[1].query(proj)[1].dtype==np.float32, 'KDTree not float32.'
+        assert l.linear_regression(proj, proj[:,0]).dtype==np.float32, \
+                'Linear regression not float32.'
+        labels = (proj[:,0] > np.median(proj[:,0])).astype(int)
+        assert l.logistic_regression(proj, labels).dtype==np.float32, \
+                'Logistic regression not float32.'
+        assert np.mean(l.logistic_prediction(proj)==labels) > 0.9, \
+                'Logistic regression inaccurate in float32.'
+        params = [{'nclusters': 3}]
+        assert np.array_equal(l.cross_validate(proj, method='k_means_cluster',
+                                               params=params, nprocs=1, seed=0),
+                              l.cross_validate(proj, method='k_means_cluster',
+                                               params=params, nprocs=2, seed=0)), \
+                'Cross-validation processes not float32.'
+    finally:
+        config.set_precision(float)
+    assert random_molecular(5, 5).counts['weight'].dtype==np.float64, \
+            'Precision not restored.'
+    try:
+        config.set_precision(np.int32)
+        raise AssertionError('Integer precision accepted.')
+    except config.InvalidArgument:
+        pass
+
 @test
 def test_chatter(c):
     obj = os.path.dirname(os.path.abspath(__file__)) + os.path.sep + 'testdata'+os.path.sep+'test_comment.object'
@@ -553,10 +1307,16 @@ if __name__=='__main__':
     test_sentence_sanitation('Testing sentence decomposition:', c=CLIENT)
     test_structure_flattening('Testing flattening nested comments:', c=CLIENT)
     test_word_counts('Testing word count generation:', c=CLIENT)
+    test_vocabulary('Testing word id vocabulary:', c=CLIENT)
+    test_vocabulary_pickling('Testing pickling with another vocabulary:', c=CLIENT)
     test_normalization('Testing wordcount normalization:', c=CLIENT)
     test_weight_filters('Testing word count filters by weight:', c=CLIENT)
     test_word_filters('Testing word count filters by words:', c=CLIENT)
     test_parallel_func('Testing parallel execution:', c=CLIENT)
+    test_parallel_pool('Testing reusable worker pool:', c=CLIENT)
+    test_parallel_processes('Testing parallel processes:', c=CLIENT)
+    test_parallel_results('Testing streamed parallel results:', c=CLIENT)
+    test_parallel_lazy_input('Testing lazy parallel input:', c=CLIENT)
     test_sorting('Testing for wordcount sorting:', c=CLIENT)
 
 #   Query class only
@@ -564,18 +1324,32 @@ if __name__=='__main__':
 
 #   Parser class only
     test_parser_instance('Testing Parser class instantiation:', c=CLIENT)
+    test_parser_pickling('Testing Parser pickling:', c=CLIENT)
     test_parser_population('Testing query, post, user population:', c=CLIENT)
     test_parser_consolidation('Testing for parser consolidation:', c=CLIENT)
+    test_parser_sparse_consolidation('Testing sparse parser consolidation:', c=CLIENT)
+    test_parser_incremental_consolidation('Testing incremental consolidation:', c=CLIENT)
+    test_parser_filters('Testing parser-wide filters:', c=CLIENT)
     test_parser_baseline('Testing baseline generation:', c=CLIENT)
     test_parser_split('Testing item splitting for test/learn:', c=CLIENT)
+    test_parser_async_download('Testing asyncio downloads:', c=CLIENT)
 
 #   Learner instance only
     test_learner_instance('Testing Learner class instantiation:', c=CLIENT)
     test_learner_axes('Testing eigenvector generation:', c=CLIENT)
+    test_learner_solvers('Testing PCA solvers:', c=CLIENT)
+    test_learner_partial_fit('Testing incremental PCA:', c=CLIENT)
+    test_learner_axes_files('Testing saving/loading axes:', c=CLIENT)
+    test_learner_model_bundle('Testing saving/loading learner state:', c=CLIENT)
+    test_learner_comment_axes('Testing comment level axes:', c=CLIENT)
+    test_learner_projection_sources('Testing projection of different sources:', c=CLIENT)
+    test_learner_neighbours('Testing nearest neighbour index:', c=CLIENT)
     test_learner_projection('Testing projection to axes:', c=CLIENT)
     test_learner_clustering('Testing k-means clustering:', c=CLIENT)
     test_learner_regression('Testing learner regression:', c=CLIENT)
     test_learner_decision_tree('Testing decision tree: ', c=CLIENT)
+    test_learner_cross_validation('Testing cross-validation:', c=CLIENT)
+    test_precision('Testing float32 precision:', c=CLIENT)
 
 #   Bot instance only
     test_bot_instance('Testing Bot class instantiation:', c=CLIENT)
@@ -584,6 +1358,7 @@ if __name__=='__main__':
     test_bot_image_io('Testing image upload/delete:', c=CLIENT)
     test_bot_messaging('Testing bot messaging:', c=CLIENT)
     test_bot_scheduler('Testing Bot scheduler:', c=CLIENT)
+    test_scheduler_errors('Testing errors in scheduled tasks:', c=CLIENT)
 
 #   Test macros
     test_chatter('Testing random chatter:', c=CLIENT)